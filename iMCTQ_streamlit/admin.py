@@ -0,0 +1,286 @@
+# Admin page: browse the latest responses without opening the raw sheet.
+#
+# Served by app.py at /admin (st.navigation with a hidden menu, so respondents
+# never see a link to it) and protected by st.secrets [admin] password. It uses
+# app.py's shared SheetsConnection (one authorized client per process). Its
+# reads share the sheet's per-user read quota (60 requests per minute) but are
+# not admitted by the write limiter and circuit breaker (admission.py), which
+# guard writes only; instead every view is kept to a few bounded calls, and a
+# 429 shows a notice rather than an error.
+#
+# Responses are shown newest first, one page at a time; a page is a single
+# bounded values:batchGet over the partition worksheets (sheets.py), cached
+# for PAGE_TTL with at most MAX_PAGES pages kept. Where each partition ends is
+# found with a few single-cell probes (SheetsConnection.last_row), so the cost
+# of a page does not grow with the size of the sheet. Filters search the
+# newest FILTER_WINDOW responses (across partitions): only the filtered
+# columns are read, FILTER_WINDOW / EXPORT_CHUNK calls at most, and the
+# matching row numbers are cached and paged like the unfiltered rows. The
+# full history is filtered by the CSV export or on the sync.py snapshot.
+# The CSV export reads the chosen date range in chunks into a temporary file,
+# only when the download button is clicked.
+#
+#   [admin]
+#   password = "..."
+import datetime
+import hmac
+import os
+import tempfile
+
+import streamlit as st
+from gspread.utils import rowcol_to_a1
+
+import metrics
+import sheets
+import storage
+
+PAGE_SIZES = [50, 100, 250, 500, 1000]
+# Page contents, filter matches and partition sizes are re-read after this many seconds
+PAGE_TTL = 300
+SIZES_TTL = 60
+MAX_PAGES = 200
+EXPORT_CHUNK = 5_000
+# Filters look at this many of the newest responses (a bounded number of reads per filter change)
+FILTER_WINDOW = 20_000
+
+YES_NO = {'vše': None, 'ano': 1, 'ne': 0}
+NA_OPTIONS = ['vše', 'jen N/A chronotyp', 'bez N/A chronotypu']
+
+
+def get_secret(key, default=None):
+    try:
+        return st.secrets.get(key, default)
+    except FileNotFoundError:
+        return default
+
+
+@st.cache_data(ttl=SIZES_TTL, show_spinner=False)
+def partition_sizes(_connection):
+    """[(worksheet title, last filled row)], newest partition first."""
+    return [(title, _connection.last_row(title)) for title in reversed(_connection.partition_titles())]
+
+
+def page_ranges(sizes, page, page_size):
+    """(title, first_row, last_row) slices holding page `page` (0 = newest rows), newest partition first."""
+    skip, need, ranges = page * page_size, page_size, []
+    for title, last in sizes:
+        rows = last - 1
+        if skip >= rows:
+            skip -= rows
+            continue
+        top = last - skip
+        bottom = max(2, top - need + 1)
+        ranges.append((title, bottom, top))
+        need -= top - bottom + 1
+        skip = 0
+        if not need:
+            break
+    return tuple(ranges)
+
+
+def position_ranges(positions):
+    """(title, first_row, last_row) runs of consecutive rows in `positions` ((title, row) pairs, newest first)."""
+    ranges = []
+    for title, row in positions:
+        if ranges and ranges[-1][0] == title and ranges[-1][1] == row + 1:
+            ranges[-1] = (title, row, ranges[-1][2])
+        else:
+            ranges.append((title, row, row))
+    return tuple(ranges)
+
+
+@st.cache_data(ttl=PAGE_TTL, max_entries=MAX_PAGES, show_spinner="Načítám stránku…")
+def read_page(_connection, ranges):
+    """Records of the row slices, newest first, with their sheet position; one API call for all slices."""
+    import pandas as pd
+
+    titles = list(dict.fromkeys(title for title, _, _ in ranges))
+    request = [(title, "1:1") for title in titles] + [(title, f"{first}:{last}") for title, first, last in ranges]
+    got = _connection.batch_get(request) if ranges else []
+    headers = {title: [str(h) for h in (got[k][0] if got[k] else [])] for k, title in enumerate(titles)}
+    records = []
+    for (title, first, last), rows in zip(ranges, got[len(titles):]):
+        header = headers[title]
+        block = [dict(zip(header, list(r) + [''] * (len(header) - len(r))), sheet=title, row=first + i)
+                 for i, r in enumerate(rows)]
+        records.extend(reversed(block))
+    return pd.DataFrame.from_records(records)
+
+
+def filter_fields(wd, shift, travel, na):
+    """Columns the active filters look at (none: no filter is active)."""
+    return [field for field, active in (('WD', wd), ('Shift', shift is not None),
+                                        ('Travel', travel is not None), ('MSFsc', na != NA_OPTIONS[0])) if active]
+
+
+def apply_filters(df, wd, shift, travel, na):
+    """Rows of `df` matching the filters (vectorized)."""
+    import pandas as pd
+
+    if df.empty:
+        return df
+    keep = pd.Series(True, index=df.index)
+
+    def flag(name):
+        return pd.to_numeric(df.get(name, pd.Series(index=df.index, dtype=object)), errors='coerce')
+
+    if wd:
+        keep &= flag('WD').isin(wd)
+    if shift is not None:
+        keep &= flag('Shift') == shift
+    if travel is not None:
+        keep &= flag('Travel') == travel
+    if na != NA_OPTIONS[0]:
+        missing = df.get('MSFsc', pd.Series('', index=df.index)).astype(str).isin(['N/A', '', 'nan'])
+        keep &= missing if na == NA_OPTIONS[1] else ~missing
+    return df[keep]
+
+
+@st.cache_data(ttl=PAGE_TTL, max_entries=20, show_spinner="Filtruji odpovědi…")
+def matching_rows(_connection, sizes, filters, window=FILTER_WINDOW):
+    """
+    (title, row) of the responses among the newest `window` that match the
+    filters, newest first. Reads only the filtered columns, EXPORT_CHUNK rows
+    per call (plus one header read per partition).
+    """
+    import pandas as pd
+
+    fields = filter_fields(*filters)
+    positions = []
+    letters = {}
+    for title, first, last in page_ranges(sizes, 0, window):
+        if title not in letters:
+            header = [str(h) for h in (_connection.batch_get(["1:1"], title)[0] or [[]])[0]]
+            letters[title] = {f: rowcol_to_a1(1, header.index(f) + 1)[:-1] for f in fields if f in header}
+        columns = letters[title]
+        # Newest rows first, EXPORT_CHUNK at a time
+        for end in range(last, first - 1, -EXPORT_CHUNK):
+            start = max(first, end - EXPORT_CHUNK + 1)
+            got = _connection.batch_get([f"{c}{start}:{c}{end}" for c in columns.values()], title) if columns else []
+            values = {f: [r[0] if r else '' for r in g] + [''] * (end - start + 1 - len(g)) for f, g in zip(columns, got)}
+            chunk = pd.DataFrame(values, index=pd.RangeIndex(start, end + 1))
+            positions.extend((title, int(row)) for row in reversed(apply_filters(chunk, *filters).index))
+    return positions
+
+
+def export_csv(connection, start, end, filters):
+    """
+    CSV (UTF-8 with BOM, for Excel) of all responses from `start` to `end`
+    that match the filters, written chunk by chunk to a temporary file.
+    """
+    import pandas as pd
+
+    out = tempfile.TemporaryFile(mode='w+', encoding='utf-8', newline='')
+    out.write('\ufeff')
+    columns = None
+
+    def flush(chunk):
+        nonlocal columns
+        df = pd.DataFrame.from_records(chunk)
+        if columns is None:
+            # Older partitions may lack fields added later; keep one set of columns throughout
+            columns = list(dict.fromkeys(list(storage.RECORD_FIELDS) + list(df.columns)))
+            pd.DataFrame(columns=columns).to_csv(out, index=False)
+        apply_filters(df, *filters).reindex(columns=columns).to_csv(out, index=False, header=False)
+
+    chunk = []
+    for record in connection.read_records(start, end, chunk_size=EXPORT_CHUNK):
+        chunk.append(record)
+        if len(chunk) == EXPORT_CHUNK:
+            flush(chunk)
+            chunk = []
+    if chunk or columns is None:
+        flush(chunk)
+    out.seek(0)
+    return out
+
+
+# --- Page ---
+
+def quota_notice(error):
+    """Stops the page with a notice if `error` is the Sheets read quota (429); re-raises anything else."""
+    if not metrics.is_quota_error(error):
+        raise error
+    st.warning("Kvóta Google Sheets pro čtení je na chvíli vyčerpána. Zkuste to prosím za minutu.")
+    st.stop()
+
+
+def render(get_connection):
+    """The admin page; `get_connection` is app.py's cached SheetsConnection factory."""
+    st.set_page_config(page_title="iMCTQ – administrace", layout="wide")
+    st.title("Administrace: poslední odpovědi")
+
+    password = (get_secret("admin") or {}).get("password")
+    if not password:
+        st.info("Administrace není nastavena (chybí `[admin] password` v secrets).")
+        st.stop()
+    if not st.session_state.get('admin_ok'):
+        entered = st.text_input("Heslo:", type="password")
+        if entered and hmac.compare_digest(entered.encode(), str(password).encode()):
+            st.session_state['admin_ok'] = True
+            st.rerun()
+        elif entered:
+            st.error("Nesprávné heslo.")
+        st.stop()
+
+    if get_secret("gcp_service_account") is None and not os.environ.get(sheets.EMULATOR_ENV):
+        st.info("Google Sheets nejsou nastaveny (chybí `gcp_service_account`).")
+        st.stop()
+    connection = get_connection()
+
+    with st.sidebar:
+        st.header("Filtry")
+        wd = st.multiselect("Pracovní / volné dny:", list(range(0, 9)),
+                            format_func=lambda d: f"WD {d} / FD {max(0, 7 - d)}")
+        shift = YES_NO[st.radio("Práce na směny:", list(YES_NO), horizontal=True)]
+        travel = YES_NO[st.radio("Cestování přes časová pásma:", list(YES_NO), horizontal=True)]
+        na = st.radio("Chronotyp:", NA_OPTIONS)
+        if st.button("🔄 Načíst znovu"):
+            partition_sizes.clear()
+            read_page.clear()
+            matching_rows.clear()
+    filters = (wd, shift, travel, na)
+
+    try:
+        sizes = partition_sizes(connection)
+        stored = sum(last - 1 for _, last in sizes)
+        positions = matching_rows(connection, sizes, filters) if filter_fields(*filters) else None
+    except Exception as e:
+        quota_notice(e)
+    total = stored if positions is None else len(positions)
+    col_size, col_page = st.columns(2)
+    with col_size:
+        page_size = st.selectbox("Řádků na stránku:", PAGE_SIZES, index=1)
+    pages = max(1, -(-total // page_size))
+    with col_page:
+        page = st.number_input(f"Stránka (z {pages}):", min_value=1, max_value=pages, value=1, step=1)
+
+    first = (page - 1) * page_size
+    if positions is None:
+        ranges = page_ranges(sizes, page - 1, page_size)
+    else:
+        ranges = position_ranges(positions[first:first + page_size])
+    try:
+        df = read_page(connection, ranges)
+    except Exception as e:
+        quota_notice(e)
+    caption = f"Odpovědi {min(total, first + 1)}–{first + len(df)} z {total} (nejnovější první)"
+    if positions is not None:
+        searched = min(stored, FILTER_WINDOW)
+        caption += f"; filtrům odpovídá {total} z {searched} nejnovějších"
+        if searched < stored:
+            caption += f" (uloženo {stored}; celou historii filtruje export CSV)"
+    st.caption(caption + ".")
+    st.dataframe(df, hide_index=True, width="stretch")
+
+    st.subheader("Export CSV")
+    today = datetime.date.today()
+    col_from, col_to = st.columns(2)
+    with col_from:
+        start = st.date_input("Od:", today - datetime.timedelta(days=30))
+    with col_to:
+        end = st.date_input("Do:", today)
+    st.download_button(
+        "⬇️ Stáhnout CSV (s filtry)", data=lambda: export_csv(connection, start, end, filters),
+        file_name=f"imctq_{start:%Y%m%d}-{end:%Y%m%d}.csv", mime="text/csv", on_click="ignore",
+    )
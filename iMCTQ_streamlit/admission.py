@@ -0,0 +1,180 @@
+# Admission control for writes to a rate-limited sink (Google Sheets).
+#
+# The Sheets API allows a fixed number of write requests per minute per
+# project/user; past that, every call fails with 429. Two process-wide guards
+# sit in front of the sheet's spool flusher (spool.Flusher):
+#   TokenBucket    - spends one token per API call and refills at the quota
+#                    rate, so a burst is smoothed instead of hitting 429s
+#   CircuitBreaker - opens after `failure_threshold` consecutive failures or
+#                    calls slower than `latency_budget`; while open, nothing is
+#                    sent and records simply stay in the local spool. After
+#                    `reset_timeout` one trial call is let through (half-open).
+# Neither guard ever blocks a Streamlit request thread: submits only write to
+# the spool, and a deferred batch is picked up again by the flusher.
+#
+# The guards of a sink are created once per process (shared()), so re-creating
+# its flusher, e.g. after st.cache_resource.clear(), does not grant a fresh quota.
+#
+# Configured from st.secrets (all optional):
+#   [sheets]
+#   write_quota_per_minute = 60
+#   failure_threshold = 5
+#   latency_budget = 10.0
+#   reset_timeout = 60.0
+import threading
+import time
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+# Numeric values of the breaker state gauge
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+DEFAULT_WRITE_QUOTA = 60  # Sheets API: write requests per minute per user
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, at most `capacity` stored. `try_acquire()`
+    never waits; `wait_time()` tells how long until a token is available.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate * 60))
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, quota, burst=None):
+        """Bucket for a quota given per minute; `burst` defaults to the full minute."""
+        return cls(quota / 60.0, burst if burst is not None else quota)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def try_acquire(self, n=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= n:
+                self._tokens -= n
+                return True
+            return False
+
+    def wait_time(self, n=1):
+        """Seconds until `n` tokens are available (0 if they are now)."""
+        with self._lock:
+            self._refill()
+            missing = n - self._tokens
+            return max(0.0, missing / self.rate) if self.rate else float("inf")
+
+    def drain(self):
+        """Empties the bucket, e.g. after the API reported 429 despite the limiter."""
+        with self._lock:
+            self._refill()
+            self._tokens = 0.0
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive bad calls (errors or
+    calls over `latency_budget` seconds); open -> half-open after
+    `reset_timeout`; a good trial call closes it again, a bad one re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, latency_budget=10.0, reset_timeout=60.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.latency_budget = latency_budget
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0  # number of times the breaker opened
+        self._clock = clock
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current()
+
+    def _current(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def allow(self):
+        """True if a call may go out now (in half-open state, only one trial call)."""
+        with self._lock:
+            state = self._current()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def cancel(self):
+        """Gives back an allowed call that was not made (frees the half-open trial)."""
+        with self._lock:
+            self._trial = False
+
+    def retry_after(self):
+        """Seconds until the open breaker lets a trial call through (0 otherwise)."""
+        with self._lock:
+            if self._current() != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def record(self, ok, duration=0.0):
+        """Reports the outcome of an allowed call; a slow success counts as a failure."""
+        if ok and self.latency_budget and duration > self.latency_budget:
+            ok = False
+        with self._lock:
+            state = self._current()
+            if ok:
+                self.failures = 0
+                self._state = CLOSED
+            else:
+                self.failures += 1
+                if state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    self._state = OPEN
+                    self._opened_at = self._clock()
+                    self.opened += 1
+            self._trial = False
+        return ok
+
+
+def from_config(config=None):
+    """(TokenBucket, CircuitBreaker) from the [sheets] secrets section."""
+    config = dict(config or {})
+    limiter = TokenBucket.per_minute(float(config.get("write_quota_per_minute", DEFAULT_WRITE_QUOTA)))
+    breaker = CircuitBreaker(
+        failure_threshold=int(config.get("failure_threshold", 5)),
+        latency_budget=float(config.get("latency_budget", 10.0)),
+        reset_timeout=float(config.get("reset_timeout", 60.0)),
+    )
+    return limiter, breaker
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(sink, config=None):
+    """The process-wide (TokenBucket, CircuitBreaker) of `sink`, built by from_config on first use."""
+    with _shared_lock:
+        if sink not in _shared:
+            _shared[sink] = from_config(config)
+        return _shared[sink]
@@ -0,0 +1,311 @@
+# Headless HTTP scoring API (WSGI, no Streamlit).
+#
+# Scores MCTQ responses with the same engine and validation as the form and
+# the batch re-scorer (mctq.score_batch via rescore.score_chunk):
+#   POST /score    one response as a JSON object, or a batch as a JSON list
+#                  (or {"responses": [...]}); add ?persist=1 (or "persist": true)
+#                  to store valid responses through the configured sinks, which
+#                  needs the API key ("Authorization: Bearer <key>" or
+#                  "X-Api-Key: <key>"); without a configured key persisting is off
+#   GET  /health   liveness + build
+#   GET  /metrics  Prometheus metrics of this worker
+#
+# Input fields use the names of the stored records: WD, SPrepw, SLatwi, SEw,
+# SPrepf, SLatfi, SEf, Alarmf, BAlarmf, BAlarmw, Bastart, Baend_time,
+# Baend_past_midnight (times as "HH:MM" or "HH-MM"), plus any of the other
+# questionnaire fields (age, sex, ...), which are stored as given. Persisted
+# records get district/region/lon/MSFsc_sun from `postal` like the form's.
+#
+# Run it under any WSGI server (behind a reverse proxy), e.g. with several worker processes:
+#   cd iMCTQ_streamlit && gunicorn -w 4 -b 127.0.0.1:8000 api:application
+# or, for local development and load tests, with the standard library:
+#   python api.py --port 8000
+# Every worker spools its records, but one process drains each spool file and
+# spends the sheet's write quota (spool.WriterLock): keep the default
+# spool_path (or the app's) so the workers and the app share one writer.
+# Storage settings come from the same secrets.toml as the app
+# ($IMCTQ_SECRETS, or .streamlit/secrets.toml in the working or home directory)
+# or the IMCTQ_* variables. The API key for persisting:
+#   [api]
+#   key = "..."                  # or $IMCTQ_API_KEY
+import argparse
+import hmac
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import tomllib
+from pathlib import Path
+from urllib.parse import parse_qs
+
+import numpy as np
+import pandas as pd
+
+import buildinfo
+import geo
+import metrics
+import rescore
+import spool
+import storage
+import thresholds
+
+log = logging.getLogger("imctq.api")
+
+# Largest accepted batch and request body
+MAX_BATCH = 10_000
+MAX_BODY = 16 * 1024 * 1024
+
+API_REQUESTS = metrics.Counter(
+    "imctq_api_requests_total", "Scoring API requests by endpoint and HTTP status.", ["endpoint", "status"])
+API_RESPONSES = metrics.Counter(
+    "imctq_api_responses_total", "Responses scored by the API, by outcome (scored, invalid, persisted).", ["outcome"])
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        self.status = status
+        super().__init__(message)
+
+
+# --- Configuration and storage (per worker process) ---
+
+def load_secrets():
+    """The app's secrets.toml as a dict ({} if there is none), looked up where Streamlit looks."""
+    env = os.environ.get("IMCTQ_SECRETS")
+    candidates = [Path(env)] if env else [Path.cwd() / ".streamlit" / "secrets.toml",
+                                          Path.home() / ".streamlit" / "secrets.toml"]
+    for path in candidates:
+        if path.exists():
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+    return {}
+
+
+def api_key():
+    """The shared secret that allows ?persist=1, or None (persisting disabled)."""
+    return os.environ.get("IMCTQ_API_KEY") or (load_secrets().get("api") or {}).get("key") or None
+
+
+def check_persist_allowed(environ, key):
+    """Raises ApiError unless the request carries `key` (Bearer token or X-Api-Key), compared in constant time."""
+    if not key:
+        raise ApiError(403, "Persisting is disabled: no API key is configured.")
+    auth = environ.get("HTTP_AUTHORIZATION", "")
+    given = auth[7:].strip() if auth[:7].lower() == "bearer " else environ.get("HTTP_X_API_KEY", "")
+    if not given or not hmac.compare_digest(given.encode(), str(key).encode()):
+        raise ApiError(401, "Persisting needs a valid API key.")
+
+
+_flushers = None
+_flushers_lock = threading.Lock()
+
+
+def get_flushers():
+    """
+    Spools + flushers of the configured sinks, started on first use in each
+    worker (after fork); only the flusher holding a spool's writer lock
+    writes, the others stand by.
+    """
+    global _flushers
+    with _flushers_lock:
+        if _flushers is None:
+            secrets = load_secrets()
+            gcp_sa = secrets.get("gcp_service_account")
+            names = storage.sink_names(secrets.get("storage"), has_google_credentials=gcp_sa is not None)
+            connection = None
+            if "sheets" in names:
+                import sheets
+
+                connection = sheets.SheetsConnection(
+                    gcp_sa, partition=(secrets.get("sheets") or {}).get("partition", sheets.DEFAULT_PARTITION))
+            _flushers = storage.start_flushers(
+                names, secrets.get("storage"), spool_base=secrets.get("spool_path"),
+                sheets_connection=connection, sheets_config=secrets.get("sheets"))
+        return _flushers
+
+
+# --- Scoring ---
+
+def _score_value(v, digits=3):
+    return 'N/A' if v is None or math.isnan(v) else round(float(v), digits)
+
+
+def _stored_value(field, value):
+    if field in storage.TIME_FIELDS and isinstance(value, str):
+        return value.replace(':', '-')
+    return value
+
+
+_thresholds = None
+
+
+def get_thresholds():
+    """The live threshold table (thresholds.py), re-read when the published file changes."""
+    global _thresholds
+    if _thresholds is None:
+        _thresholds = thresholds.ThresholdReloader(load_secrets().get("thresholds_path"))
+    return _thresholds.current()
+
+
+def score_responses(responses):
+    """
+    Scores a list of response dicts; returns one result dict per response with
+    MSFsc, SJL, Bamid, SDweek (hours, None if not determinable), the class
+    indices (-1 if not determinable), `thresholds_version` (the cut-offs that
+    classified it) and `error` (validation labels, '' if valid).
+    """
+    table = get_thresholds()
+    with metrics.PHASE_SECONDS.time(phase="api_scoring"):
+        scored = rescore.score_chunk(pd.DataFrame.from_records(responses), table['thresholds'], table['version'])
+    out = []
+    for row in scored[rescore.SCORE_COLUMNS].itertuples(index=False):
+        r = row._asdict()
+        for name in ('MSFsc', 'SJL', 'Bamid', 'SDweek'):
+            r[name] = None if np.isnan(r[name]) else float(r[name])
+        for name in ('chronotype', 'bamid_class', 'sjl_class'):
+            r[name] = int(r[name])
+        out.append(r)
+    return out
+
+
+def build_record(response, result):
+    """The stored record (same fields and formats as the form's `vd`) for a valid response."""
+    record = {f: _stored_value(f, response.get(f)) for f in storage.RECORD_FIELDS}
+    record['ID'] = spool.new_record_id()
+    if record['FD'] is None and record['WD'] is not None:
+        record['FD'] = 7 - int(record['WD'])
+    record['MSFsc'] = _score_value(result['MSFsc'])
+    record['SJL'] = _score_value(result['SJL'])
+    record['SDweek'] = _score_value(result['SDweek'])
+    record['Bamid'] = _score_value(result['Bamid'])
+    record['thresholds_version'] = result['thresholds_version']
+    record.update(geo.record_fields(record['postal'], record['MSFsc']))
+    return record
+
+
+def persist(responses, results):
+    """Spools every valid response for all sinks; sets result['ID'] on those."""
+    flushers = list(get_flushers().values())
+    records = []
+    for response, result in zip(responses, results):
+        if not result['error']:
+            record = build_record(response, result)
+            result['ID'] = record['ID']
+            records.append(record)
+    with metrics.PHASE_SECONDS.time(phase="spool_put"):
+        for flusher in flushers:
+            for record in records:
+                flusher.spool.put(record)
+            flusher.wake()
+    API_RESPONSES.inc(len(records), outcome="persisted")
+
+
+# --- WSGI ---
+
+def _read_json(environ):
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > MAX_BODY:
+        raise ApiError(413, f"Request body larger than {MAX_BODY} bytes.")
+    try:
+        return json.loads(environ["wsgi.input"].read(length) or b"null")
+    except ValueError as e:
+        raise ApiError(400, f"Invalid JSON: {e}")
+
+
+def handle_score(environ):
+    payload = _read_json(environ)
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+    persist_flag = query.get("persist", ["0"])[0].lower() in ("1", "true", "yes")
+
+    single = isinstance(payload, dict) and "responses" not in payload
+    if isinstance(payload, dict):
+        persist_flag = persist_flag or bool(payload.get("persist"))
+    responses = [payload] if single else payload["responses"] if isinstance(payload, dict) else payload
+    if not isinstance(responses, list) or not all(isinstance(r, dict) for r in responses):
+        raise ApiError(400, "Expected a response object, a list of them or {\"responses\": [...]}.")
+    if len(responses) > MAX_BATCH:
+        raise ApiError(413, f"At most {MAX_BATCH} responses per request.")
+    if persist_flag:
+        check_persist_allowed(environ, api_key())
+    if not responses:
+        return {"results": []}
+
+    results = score_responses(responses)
+    invalid = sum(1 for r in results if r['error'])
+    API_RESPONSES.inc(len(results) - invalid, outcome="scored")
+    if invalid:
+        API_RESPONSES.inc(invalid, outcome="invalid")
+    if persist_flag:
+        persist(responses, results)
+    return results[0] if single else {"results": results}
+
+
+def _respond(start_response, status, body, content_type="application/json"):
+    if not isinstance(body, bytes):
+        body = json.dumps(body, ensure_ascii=False).encode()
+    reasons = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+    start_response(f"{status} {reasons.get(status, '')}".strip(), [
+        ("Content-Type", content_type), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def application(environ, start_response):
+    path = environ.get("PATH_INFO", "/").rstrip("/") or "/"
+    method = environ.get("REQUEST_METHOD", "GET")
+    status = 200
+    try:
+        if path == "/score":
+            if method != "POST":
+                raise ApiError(405, "Use POST.")
+            body = handle_score(environ)
+        elif path == "/health":
+            body = {"status": "ok", "build": buildinfo.commit_hash()}
+        elif path == "/metrics":
+            API_REQUESTS.inc(endpoint=path, status=200)
+            return _respond(start_response, 200, metrics.REGISTRY.render().encode(),
+                            "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            raise ApiError(404, f"No endpoint {path}.")
+    except ApiError as e:
+        status, body = e.status, {"error": str(e)}
+    except Exception:
+        log.exception("API request failed", extra={"path": path})
+        status, body = 500, {"error": "Internal error."}
+    API_REQUESTS.inc(endpoint=path if status != 404 else "other", status=status)
+    return _respond(start_response, status, body)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Development server for the scoring API (use gunicorn in production).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    metrics.configure_json_logging()
+    server = make_server(args.host, args.port, application, ThreadingWSGIServer, QuietHandler)
+    print(f"Scoring API on http://{args.host}:{args.port}/score", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,50 +1,345 @@
 # v.2025.10.24.1250
 import streamlit as st
-import datetime
 # import pandas as pd
-import numpy as np
-from datetime import time, timedelta, datetime as dt
-import gspread
-import subprocess
+import logging
+import math
+from datetime import time
+import buildinfo
+import metrics
+import spool
+# mctq (numpy) and sheets (gspread) are imported on first use, see below
+
+log = logging.getLogger("imctq.app")
+
+# Show the current GitHub commit hash for clarity (resolved once per process)
+commit_hash = buildinfo.commit_hash()
+
+def get_secret(key, default=None):
+    """st.secrets.get that also works when no secrets.toml exists (local development)."""
+    try:
+        return st.secrets.get(key, default)
+    except FileNotFoundError:
+        return default
+
+
+# --- Opt-in profiling (profiling.py): [profiling] enabled = true, or ?profile=<[profiling] token> ---
+# Without a [profiling] secret nothing is imported and nothing is wrapped.
+profiling_config = get_secret("profiling")
+profile_run = None
+show_profile = False
+if profiling_config:
+    import profiling
+
+    profile_run = profiling.begin(st.session_state, profiling_config, st.query_params.get("profile"))
+    # The report (hot spots, file path) is for admins only, never for respondents
+    show_profile = profile_run is not None and profiling.authorized(profiling_config, st.query_params.get("profile"))
 
-# Show the current GitHub commit hash for clarity
-try:
-    commit_hash = subprocess.getoutput("git rev-parse --short HEAD")
-except Exception:
-    commit_hash = "unknown"
 
 # Sidebar or top-right "Reload" button
-st.sidebar.markdown(f"**🧬 Build version:** `{commit_hash}`")
-
-if st.sidebar.button("🔄 Reload app from GitHub"):
-    st.cache_data.clear()
-    st.cache_resource.clear()
-    st.rerun()
-
-
-# --- Helper Function to handle cross-midnight time subtraction ---
-def time_to_datetime(t, base_date):
-    """Converts a datetime.time object to a datetime.datetime object on a base date."""
-    # Handle the case where the input might be None if the block was skipped
-    if t is None:
-        return None
-    return dt.combine(base_date, t)
-
-def calculate_sleep_duration(time_start, time_end):
-    """
-    Calculates sleep duration (timedelta) handling cross-midnight sleep.
-    time_start and time_end are datetime.time objects from st.time_input.
-    """
-    base_date = datetime.date(2000, 1, 1) # Arbitrary base date
-    start_dt = time_to_datetime(time_start, base_date)
-    end_dt = time_to_datetime(time_end, base_date)
-    
-    # If end time is earlier than start time, it means sleep crossed midnight.
-    if end_dt <= start_dt:
-        end_dt += timedelta(days=1)
-    
-    duration = end_dt - start_dt
-    return duration, end_dt # Return both duration and corrected end time
+# (a fragment: sidebar interactions rerun only this function, not the whole form)
+@st.fragment
+def sidebar_panel():
+    st.markdown(f"**🧬 Build version:** `{commit_hash}`")
+
+    if st.button("🔄 Reload app from GitHub"):
+        st.cache_data.clear()
+        st.cache_resource.clear()
+        st.rerun()
+
+
+def render_profile(summary):
+    """Hot spots of the profiled rerun, under the build version."""
+    st.markdown(f"**⏱️ Profil ({summary['kind']}):** {summary['ms']} ms")
+    st.dataframe(summary['top'], hide_index=True, column_order=['function', 'self_ms', 'total_ms', 'calls'])
+    st.caption(f"`{summary['path']}`")
+
+
+with st.sidebar:
+    sidebar_panel()
+    # Filled at the end of the rerun, once its profile is complete
+    profile_slot = st.empty() if show_profile else None
+
+
+def finish_profile(kind="rerun"):
+    """Ends this rerun's profile (frees the process-wide profiler slot) and shows it to admins; once per rerun."""
+    global profile_run
+    if profile_run is None:
+        return
+    run, profile_run = profile_run, None
+    summary = profiling.end(st.session_state, run, kind=kind)
+    if show_profile:
+        with profile_slot.container():
+            render_profile(summary)
+
+
+def stop(kind="rerun"):
+    """st.stop() for this script: ends the profile first, so an early exit does not hold the profiler slot."""
+    finish_profile(kind)
+    st.stop()
+
+
+# --- Metrics export (Prometheus endpoint/file, JSON logs), started once per process ---
+@st.cache_resource
+def start_metrics():
+    return metrics.start_exporters(port=get_secret("metrics_port"), path=get_secret("metrics_file"))
+
+
+start_metrics()
+
+
+# --- Shared Google Sheets connection (one per process, reused by all sessions) ---
+@st.cache_resource
+def get_sheets_connection():
+    import sheets
+    # One worksheet per year (or month, [sheets] partition = "month"), created on rollover
+    partition = get_secret("sheets", {}).get("partition", sheets.DEFAULT_PARTITION)
+    return sheets.SheetsConnection(get_secret("gcp_service_account"), partition=partition)
+
+
+def active_sink_names():
+    import storage
+
+    return storage.sink_names(get_secret("storage", {}), has_google_credentials=get_secret("gcp_service_account") is not None)
+
+
+# --- Pages: the questionnaire (the rest of this script) and the admin page (admin.py) at /admin ---
+# The menu is hidden, so respondents never see a link to the admin page
+def questionnaire():
+    """Rendered by the rest of this script."""
+
+
+def admin_page():
+    import admin
+
+    admin.render(get_sheets_connection)
+
+
+current_page = st.navigation(
+    [st.Page(questionnaire, title="Dotazník", default=True),
+     st.Page(admin_page, title="Administrace", url_path="admin")],
+    position="hidden",
+)
+if current_page.url_path == "admin":
+    try:
+        current_page.run()
+    finally:
+        # The admin page ends its reruns with st.stop() / st.rerun() too
+        finish_profile("admin")
+    st.stop()
+
+
+# --- Storage: each configured sink (storage.py) gets a write-behind spool and a background flusher ---
+def stop_flushers(flushers):
+    """Releases the cached flushers ("Reload" clears the cache); their threads would keep draining the spools."""
+    for flusher in flushers.values():
+        flusher.stop()
+
+
+@st.cache_resource(on_release=stop_flushers)
+def get_spool_flushers():
+    import storage
+
+    names = active_sink_names()
+    return storage.start_flushers(
+        names, get_secret("storage", {}),
+        spool_base=get_secret("spool_path"),
+        sheets_connection=get_sheets_connection() if "sheets" in names else None,
+        # Write quota limiter + circuit breaker (admission.py), shared by all sessions
+        sheets_config=get_secret("sheets", {}),
+        # Population statistics follow the first (primary) sink only, so nothing is counted twice
+        on_saved=get_population_stats().add_batch,
+    )
+
+
+# --- Running population statistics (stats.py), one object per process shared by all sessions ---
+@st.cache_resource
+def get_population_stats():
+    import stats
+    import storage
+
+    def stored_records():
+        # No stats file yet: whatever a local sink already holds is added in the background
+        local = [n for n in active_sink_names() if n != "sheets"]
+        return storage.build_sink(local[0], get_secret("storage", {})).iter_records() if local else []
+
+    return stats.shared(records=stored_records)
+
+
+# Population slices (stats.slices_for) the respondent can be compared with
+COMPARE_SLICES = {
+    'all': 'se všemi respondenty',
+    'sex': 's respondenty stejného pohlaví',
+    'age': 's respondenty stejné věkové skupiny',
+    'educ': 's respondenty se stejným vzděláním',
+}
+
+
+def compare_slice(vd):
+    """The slice chosen in the "Porovnat" radio, among those the record belongs to."""
+    import stats
+
+    keys = dict(stats.slices_for(vd))
+    dim = st.radio("Porovnat:", [d for d in COMPARE_SLICES if d in keys],
+                   format_func=COMPARE_SLICES.get, horizontal=True, key='compare_slice')
+    return dim, keys[dim]
+
+
+def show_population_position(metric, value, text, slice_key=('all', '')):
+    """Shows where `value` falls among respondents (of the slice) so far, with a small histogram."""
+    import altair as alt
+    import pandas as pd
+
+    try:
+        population = get_population_stats()
+        rank = population.rank(metric, value, slice_key)
+    except Exception:
+        # The comparison is a nice-to-have; never let it break the results page
+        return
+    if rank is None:
+        if slice_key[0] != 'all':
+            st.caption("Ve vybrané skupině je zatím málo respondentů pro srovnání.")
+        return
+    st.write(text.format(pct=round(rank * 100)))
+    if slice_key[0] != 'all':
+        st.caption(f"Srovnání {COMPARE_SLICES[slice_key[0]]} ({slice_key[1]}).")
+    hist = pd.DataFrame(population.histogram(metric, slice_key), columns=['hodiny', 'respondenti'])
+    bars = alt.Chart(hist).mark_bar().encode(
+        x=alt.X('hodiny:Q', bin=alt.BinParams(binned=True, step=0.5), title=metric),
+        x2='konec:Q', y=alt.Y('respondenti:Q', title='počet respondentů'),
+    ).transform_calculate(konec='datum.hodiny + 0.5')
+    you = alt.Chart(pd.DataFrame({'hodiny': [value]})).mark_rule(color='red', size=2).encode(x='hodiny:Q')
+    st.altair_chart(bars + you, width="stretch")
+
+
+# --- Classification cut-offs (thresholds.py): the published table, re-read when its file changes ---
+@st.cache_resource
+def get_thresholds():
+    import thresholds
+
+    return thresholds.ThresholdReloader(get_secret("thresholds_path"))
+
+
+# --- What-if explorer: the respondent's schedule re-scored over shifted wake/bed times ---
+WHAT_IF_SHIFTS = list(range(-120, 121, 15))  # minutes
+WHAT_IF_METRICS = {'SJL': 'sociální jetlag (h)', 'MSFsc': 'chronotyp MSFsc', 'SDweek': 'průměrná délka spánku (h)'}
+
+
+@st.cache_data(max_entries=1000)
+def what_if_grid(inputs):
+    """mctq.what_if over WHAT_IF_SHIFTS for one respondent (cached per answers, so sliders only index it)."""
+    import mctq
+
+    with metrics.PHASE_SECONDS.time(phase="what_if"):
+        return mctq.what_if(dict(inputs), WHAT_IF_SHIFTS, WHAT_IF_SHIFTS)
+
+
+@st.fragment
+def what_if_explorer(inputs, current):
+    """Sliders + heatmap; moving a slider reruns only this fragment and reads the cached grid."""
+    import altair as alt
+    import numpy as np
+    import pandas as pd
+
+    grid = what_if_grid(inputs)
+    col_w, col_b = st.columns(2)
+    with col_w:
+        wake = st.select_slider("Posun vstávání ve všední dny:", options=WHAT_IF_SHIFTS, value=0,
+                                format_func=lambda m: f"{m:+d} min", key='whatif_wake')
+    with col_b:
+        bed = st.select_slider("Posun ulehnutí ve volné dny:", options=WHAT_IF_SHIFTS, value=0,
+                               format_func=lambda m: f"{m:+d} min", key='whatif_bed')
+    i, j = WHAT_IF_SHIFTS.index(wake), WHAT_IF_SHIFTS.index(bed)
+
+    for column, name in zip(st.columns(3), ('SJL', 'MSFsc', 'SDweek')):
+        value, base = grid[name][i, j], current[name]
+        with column:
+            if math.isnan(value):
+                st.metric(name, "N/A")
+            else:
+                delta = None if math.isnan(base) else f"{value - base:+.2f}"
+                # Less social jetlag is better; for the chronotype and sleep length the direction is neutral
+                st.metric(name, f"{value:.2f}", delta=delta, delta_color='inverse' if name == 'SJL' else 'off')
+
+    metric = st.radio("Barva mapy:", list(WHAT_IF_METRICS), format_func=WHAT_IF_METRICS.get,
+                      horizontal=True, key='whatif_metric')
+    cells = pd.DataFrame({
+        'vstávání': np.repeat(WHAT_IF_SHIFTS, len(WHAT_IF_SHIFTS)),
+        'ulehnutí': np.tile(WHAT_IF_SHIFTS, len(WHAT_IF_SHIFTS)),
+        metric: grid[metric].ravel(),
+    })
+    heat = alt.Chart(cells).mark_rect().encode(
+        x=alt.X('ulehnutí:O', title='posun ulehnutí ve volné dny (min)'),
+        y=alt.Y('vstávání:O', title='posun vstávání ve všední dny (min)', sort='descending'),
+        color=alt.Color(f'{metric}:Q', title=metric,
+                        scale=alt.Scale(scheme='redyellowgreen', reverse=True) if metric == 'SJL' else alt.Scale(scheme='viridis')),
+        tooltip=['vstávání', 'ulehnutí', alt.Tooltip(f'{metric}:Q', format='.2f')],
+    )
+    chosen = alt.Chart(pd.DataFrame({'vstávání': [wake], 'ulehnutí': [bed]})).mark_rect(
+        fill=None, stroke='black', strokeWidth=2).encode(x='ulehnutí:O', y=alt.Y('vstávání:O', sort='descending'))
+    st.altair_chart(heat + chosen, width="stretch")
+
+
+# --- Background saving: the submit only hands the record over; the status is polled by a fragment ---
+def stop_save_worker(pool):
+    """Releases the cached save worker; queued saves still finish, then its threads exit."""
+    pool.shutdown(wait=False)
+
+
+@st.cache_resource(on_release=stop_save_worker)
+def get_save_worker():
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="imctq-save")
+
+
+def save_in_background(vd):
+    """Queues the record into every sink's spool on the save worker; returns the Future."""
+    flushers = list(get_spool_flushers().values())
+
+    def put():
+        with metrics.PHASE_SECONDS.time(phase="spool_put"):
+            for flusher in flushers:
+                flusher.spool.put(vd)
+        # The primary sink decides what the respondent sees
+        return flushers[0]
+
+    return get_save_worker().submit(put)
+
+
+def render_save_status(result):
+    """Shows queued / saved / retrying for the current result; returns True once that is final."""
+    future = result['save']
+    if not future.done():
+        st.info("⏳ Odpověď čeká na uložení…")
+        return False
+    if future.exception() is not None:
+        # Details go to the JSON log; the respondent only gets a reference to quote
+        log.error("saving response failed", exc_info=future.exception(), extra={"record_id": result['vd']['ID']})
+        st.error(f"Chyba při ukládání odpovědi. Pokud nás budete kontaktovat, uveďte prosím kód `{result['vd']['ID']}`.")
+        return True
+
+    flusher = future.result()
+    status = flusher.spool.status(result['vd']['ID'])
+    if status == spool.SAVED:
+        st.success("Data byla anonymně uložena pro další analýzu. Děkujeme!")
+        return True
+    if flusher.deferred:
+        st.warning("🕒 Úložiště je momentálně přetížené. Vaše odpověď je bezpečně uložena na serveru a odešle se automaticky.")
+    elif status == spool.RETRYING:
+        st.warning("🔁 Ukládání se opakuje. Vaše odpověď je zatím bezpečně uložena na serveru.")
+    else:
+        st.info("⏳ Ukládáme vaši odpověď…")
+    return False
+
+
+@st.fragment(run_every=1.0)
+def poll_save_status():
+    result = st.session_state['result']
+    if render_save_status(result):
+        # Final state reached: one full rerun renders it without the polling fragment
+        result['save_done'] = True
+        st.rerun()
+
 
 # --- Options Dictionaries ---
 educ_options = {
@@ -55,6 +350,27 @@ slequal_options = {
     1:'velmi dobrá', 2:'spíše dobrá', 3:'spíše špatná', 4:'velmi špatná'
 }
 
+# --- Result messages, indexed by the class from mctq.classify_* ---
+chronotype_messages = [
+    'Jste **extrémní skřivan** (Early Morning).',
+    'Jste **skřivan** (Morning).',
+    'Jste **spíše skřivan** (Slightly Morning).',
+    'Máte **průměrný chronotyp** (Intermediate).',
+    'Jste **spíše sova** (Slightly Evening).',
+    'Jste **sova** (Evening).',
+    'Jste **extrémní sova** (Late Evening).',
+]
+bamid_messages = [
+    'Jste spíše **skřivan**.',
+    'Máte spíše **průměrný chronotyp**.',
+    'Jste spíše **sova**.',
+]
+sjl_messages = [
+    (st.info, 'Váš vnitřní časový systém je v souladu s vaším rozvrhem.'),
+    (st.warning, 'Trpíte obvyklým sociálním jetlagem, doporučujeme úpravu vašeho rozvrhu.'),
+    (st.error, 'Trpíte velkým sociálním jetlagem, doporučujeme úpravu vašeho rozvrhu a životního stylu.'),
+]
+
 
 # --- Streamlit UI Setup ---
 
@@ -261,161 +577,39 @@ with st.form("mctq_form"):
 # --- Calculation and Output Block ---
 
 if submit_button:
+    st.session_state.pop('result', None)
     
     if WD == 8:
+        metrics.SUBMITS.inc(outcome="invalid")
         st.error("Výpočet nelze provést, protože máte zcela nepravidelný rozvrh.")
-        st.stop()
+        stop("submit")
         
     try:
-        # --- 1. Preparation of Time Variables ---
-        base_date = datetime.date(2000, 1, 1)
-
-        # --- Working Day Calculations ---
-        if WD > 0:
-            SLatw = timedelta(minutes=SLatwi)
-            SPrepw_dt = time_to_datetime(SPrepw, base_date)
-            SOw_dt = SPrepw_dt + SLatw
-            SOw = SOw_dt.time()
-            SDw, SEw_dt = calculate_sleep_duration(SOw, SEw)
-            SDw_i = SDw.total_seconds() / 3600
-            
-            # Check for extreme duration
-            if SDw_i < 4 or SDw_i > 14:
-                st.error(f"Vypočtená délka spánku ve všední dny ({round(SDw_i, 2)} h) není reálná. Zkontrolujte prosím časy.")
-                st.stop()
-
-            # Mid-Sleep (MS) in hours
-            MSW_dt = SOw_dt + (SDw / 2)
-            MSW = MSW_dt.hour + MSW_dt.minute/60
-        else:
-            SDw = timedelta(0)
-            SDw_i = 0.0
-            MSW = 0.0 # Placeholder for MSW when WD=0
-
-        # --- Free Day Calculations ---
-        if FD > 0:
-            SLatf = timedelta(minutes=SLatfi)
-            SPrepf_dt = time_to_datetime(SPrepf, base_date)
-            SOf_dt = SPrepf_dt + SLatf
-            SOf = SOf_dt.time()
-            SDf, SEf_dt = calculate_sleep_duration(SOf, SEf)
-            SDf_i = SDf.total_seconds() / 3600
-            
-            # Check for extreme duration
-            if SDf_i < 4 or SDf_i > 14:
-                st.error(f"Vypočtená délka spánku ve volné dny ({round(SDf_i, 2)} h) není reálná. Zkontrolujte prosím časy.")
-                st.stop()
-
-            # Mid-Sleep (MS) in hours
-            MSF_dt = SOf_dt + (SDf / 2)
-            MSF = MSF_dt.hour + MSF_dt.minute/60
-        else:
-            SDf = timedelta(0)
-            SDf_i = 0.0
-            MSF = 0.0 # Placeholder for MSF when FD=0
-
-        # --- Shared Calculations ---
-        
-        # Mid-point of most active time
-        Bastart_dt = time_to_datetime(Bastart, base_date)
-        Baend_dt = time_to_datetime(Baend_time, base_date)
-        if Baend_past_midnight:
-             Baend_dt += timedelta(days=1)
-
-        Bamid_dt = Bastart_dt + (Baend_dt - Bastart_dt)/2
-        Bamid = Bamid_dt.hour + Bamid_dt.minute/60 # In hours (0-24+)
-
-        # Average weekly sleep duration, in h
-        SDweek = round(((SDw.total_seconds() * WD + SDf.total_seconds() * FD)/7) / 3600, 3)
-
-        # Corrected Mid-Sleep on Free Day (MSFsc) - The Chronotype
-        # if using alarm on free days, need waking before both Alarmw and Alarmf
-        MSFsc = np.nan
-        if FD > 0 and (Alarmf == 0 or (Alarmf == 1 and (BAlarmf == 0 and BAlarmw == 1))):
-            if SDf_i <= SDw_i:
-                MSFsc = MSF
-            else:
-                MSFsc = MSF - (SDf_i - SDweek)/2
-        
-        # Social jetlag
-        SJL = np.nan
-        if WD > 0 and FD > 0:
-            SJLrel = MSF - MSW
-            SJL = abs(SJLrel)
-        
-        
-        # --- 2. Display Results ---
-                
-        st.subheader("VÝSLEDKY VÝPOČTU")
-        st.markdown("---")
-        
-        # Chronotype Display
-        if not np.isnan(MSFsc):
-            st.success(f'Váš **chronotyp** (MSFsc) je: **{round(MSFsc, 2)}**')
-            st.write("")
-            
-            # Classification
-            if MSFsc <= 1.50584:
-                st.info('Jste **extrémní skřivan** (Early Morning).')
-            elif MSFsc <= 1.935:
-                st.info('Jste **skřivan** (Morning).')
-            elif MSFsc <= 2.3984:
-                st.info('Jste **spíše skřivan** (Slightly Morning).')
-            elif MSFsc <= 3.5817:
-                st.info('Máte **průměrný chronotyp** (Intermediate).')
-            elif MSFsc <= 4.145:
-                st.info('Jste **spíše sova** (Slightly Evening).')
-            elif MSFsc <= 4.66584:
-                st.info('Jste **sova** (Evening).')
-            else:
-                st.info('Jste **extrémní sova** (Late Evening).')
-            
-            if Shift == 1:            
-                st.warning("Z důvodu nedávné práce na směny není váš chronotyp ustálený.")
-            if Travel == 1:            
-                st.warning("Z důvodu nedávného cestování není váš chronotyp ustálený.")
-            
-                
-        else:
-            st.warning('Váš přesný chronotyp nelze určit, protože máte nepravidelný režim, nebo se budíte až s budíkem i během víkendu.')
-            
-            # Bamid estimate
-            if not np.isnan(Bamid):
-                st.info(f'Nicméně, lze přibližně odhadnout subjektivní chronotyp: **{round(Bamid, 2)}**')
-                if Bamid <= 10.72:
-                    st.info('Jste spíše **skřivan**.')
-                elif Bamid <= 13.204:
-                    st.info('Máte spíše **průměrný chronotyp**.')
-                else:
-                    st.info('Jste spíše **sova**.')
-            else:
-                st.error('Ani váš přibližný chronotyp nelze odhadnout.')
-
-        st.markdown("---")
-        
-        # Social Jetlag
-        if not np.isnan(SJL):
-            st.success(f'Váš **sociální jetlag** (SJL) je: **{round(SJL, 2)} hodin**')
-            st.caption("(Rozdíl mezi středem spánku ve volné dny a ve všední dny)")
-            
-            if SJL < 0.65:
-                st.info('Váš vnitřní časový systém je v souladu s vaším rozvrhem.')
-            elif SJL <= 1.67:
-                st.warning('Trpíte obvyklým sociálním jetlagem, doporučujeme úpravu vašeho rozvrhu.')
-            else:
-                st.error('Trpíte velkým sociálním jetlagem, doporučujeme úpravu vašeho rozvrhu a životního stylu.')
-        else:
-             st.warning('Váš sociální jetlag nelze určit, protože nemáte volné a všední dny, nebo máte nepravidelný režim.')
-             
-        st.markdown("---")
-        st.info('Děkujeme za vyplnění MCTQ dotazníku.')
+        import mctq
 
-
-        # --- 3. Data Storage ---
+        # --- 1. Scoring (see mctq.py), classified by the current threshold table ---
+        cutoffs = get_thresholds().current()
+        try:
+            with metrics.PHASE_SECONDS.time(phase="scoring"):
+                res = mctq.score(
+                    WD, SPrepw, SLatwi, SEw, SPrepf, SLatfi, SEf,
+                    Alarmf, BAlarmf, BAlarmw, Bastart, Baend_time, Baend_past_midnight,
+                    thresholds=cutoffs['thresholds'],
+                )
+        except mctq.SleepDurationError as e:
+            metrics.SUBMITS.inc(outcome="invalid")
+            days = "všední dny" if e.day == 'w' else "volné dny"
+            st.error(f"Vypočtená délka spánku ve {days} ({round(e.hours, 2)} h) není reálná. Zkontrolujte prosím časy.")
+            stop("submit")
+
+        MSFsc, SJL, Bamid, SDweek = res['MSFsc'], res['SJL'], res['Bamid'], res['SDweek']
+
+
+        # --- 2. Data Storage ---
                 
-        # 3.1. Create a dictionary of results
+        # 2.1. Create a dictionary of results
         vd = {
-            'ID': dt.now().strftime('%Y-%m-%d_%H-%M-%S.%f'), # Unique ID
+            'ID': spool.new_record_id(), # Unique ID (timestamp + random suffix, safe to replay)
             'age': age,
             'sex': sex,
             'height': height,
@@ -444,81 +638,116 @@ if submit_button:
             'Bastart': Bastart.strftime('%H-%M'),
             'Baend_time': Baend_time.strftime('%H-%M'),
             'Baend_past_midnight': Baend_past_midnight,
-            'MSFsc': round(MSFsc, 3) if not np.isnan(MSFsc) else 'N/A',
-            'SJL': round(SJL, 3) if not np.isnan(SJL) else 'N/A',
+            'MSFsc': round(MSFsc, 3) if not math.isnan(MSFsc) else 'N/A',
+            'SJL': round(SJL, 3) if not math.isnan(SJL) else 'N/A',
+            'SDweek': round(SDweek, 3) if not math.isnan(SDweek) else 'N/A',
             'Bamid': round(Bamid, 3),
             'Shift': Shift,
             'Shifts': Shifts.strftime('%H-%M') if Shifts else None,
             'Shifts_past_midnight': Shifts_past_midnight,
             'Shifte': Shifte.strftime('%H-%M') if Shifte else None,
             'Shifte_past_midnight': Shifte_past_midnight,
-            'Travel': Travel
+            'Travel': Travel,
+            'thresholds_version': cutoffs['version'],
             # Add any other variables you want to save
         }
-        
-        # --- 3.2. Connect and Save to Google Sheets (robust) ---
-        import json
-        import traceback
-
-        header_keys = []  # ensure defined for later error messages
-
+        # 2.2. District, region and sun-time MSFsc from the PSČ (geo.py, index loaded once per process)
         try:
-            # Load credentials from st.secrets
-            gcp_sa = st.secrets.get("gcp_service_account")
-            if gcp_sa is None:
-                raise RuntimeError("st.secrets['gcp_service_account'] not found. See instructions for setting secrets.")
-
-            # gspread.service_account_from_dict expects a dict. If it's a JSON string, parse it.
-            if isinstance(gcp_sa, str):
-                try:
-                    gcp_sa = json.loads(gcp_sa)
-                except Exception:
-                    raise RuntimeError("gcp_service_account in st.secrets is a string but not valid JSON.")
-
-            # Use gspread helper
-            gc = gspread.service_account_from_dict(gcp_sa)
-
-            # Open workbook
-            SHEET_ID = "10FfTOk_hLShUk1EEQi9ndBlZcbsME1ORfs7btm6IjDc"  # keep your value
-            workbook = gc.open_by_key(SHEET_ID)
-
-            # Try to get worksheet by name; if missing, list available sheets for debugging
-            SHEET_NAME = "iMCTQ_streamlit_responses_2025"
-            try:
-                worksheet = workbook.worksheet(SHEET_NAME)
-            except gspread.exceptions.WorksheetNotFound:
-                # helpful debug info
-                available = [s.title for s in workbook.worksheets()]
-                raise RuntimeError(f"Worksheet named '{SHEET_NAME}' not found. Available sheets: {available}")
-
-            # read header row (guaranteed defined now)
-            header_keys = worksheet.row_values(1)
-            if not header_keys:
-                raise RuntimeError("Header row (row 1) is empty. Please add header names to the first row in the sheet.")
-
-            # map vd keys into the order of header
-            row_to_save = [vd.get(key, "") for key in header_keys]
-
-            # Append row (use USER_ENTERED so Google parses numbers/dates)
-            worksheet.append_row(row_to_save, value_input_option='USER_ENTERED')
-
-            st.success("Data byla anonymně uložena pro další analýzu. Děkujeme!")
-
-        except Exception as sheet_error:
-            # Provide rich diagnostics
-            st.error("Chyba při ukládání do Google Sheets.")
-            st.write("**Diagnostika chyby (pro vývojáře):**")
-            st.write(str(sheet_error))
-            # show traceback for debugging (remove in production)
-            tb = traceback.format_exc()
-            st.text(tb)
-            # helpful hints
-            st.warning(
-                "Zkontrolujte: 1) že jste sdíleli Google Sheet s e-mailem service accountu (Editor), "
-                "2) že v GCP máte povolenou Google Sheets API, "
-                "3) že SHEET_NAME existuje a header je ve 1. řádku a nakonec "
-                "4) že st.secrets['gcp_service_account'] má správný obsah (viz instrukce)."
-            )
+            import geo
+
+            vd.update(geo.record_fields(postal, vd['MSFsc']))
+        except Exception:
+            log.exception("PSČ lookup failed")
+        
+        # 2.3. Hand the record to the background save worker; results are shown right away
+        # The scoring inputs (minutes) for the what-if explorer
+        inputs = (
+            ('WD', WD), ('SPrepw', mctq.to_minutes(SPrepw)), ('SLatw', SLatwi), ('SEw', mctq.to_minutes(SEw)),
+            ('SPrepf', mctq.to_minutes(SPrepf)), ('SLatf', SLatfi), ('SEf', mctq.to_minutes(SEf)),
+            ('Alarmf', Alarmf), ('BAlarmf', BAlarmf), ('BAlarmw', BAlarmw), ('Bastart', mctq.to_minutes(Bastart)),
+            ('Baend', mctq.to_minutes(Baend_time)), ('Baend_past_midnight', int(Baend_past_midnight)),
+        )
+        st.session_state['result'] = {
+            'res': res, 'vd': vd, 'Shift': Shift, 'Travel': Travel, 'inputs': inputs,
+            'save': save_in_background(vd), 'save_done': False,
+        }
+        metrics.SUBMITS.inc(outcome="scored")
         
     except Exception as e:
+        metrics.SUBMITS.inc(outcome="error")
+        log.exception("scoring failed")
         st.error(f"Při výpočtu došlo k neočekávané chybě. Zkontrolujte prosím zadaná data. Detaily chyby: {e}")
+
+
+# --- 3. Display Results (kept in session state, so unrelated reruns don't recompute anything) ---
+
+result = st.session_state.get('result')
+if result is not None:
+    res = result['res']
+    MSFsc, SJL, Bamid = res['MSFsc'], res['SJL'], res['Bamid']
+
+    st.subheader("VÝSLEDKY VÝPOČTU")
+    population_slice = compare_slice(result['vd'])
+    st.markdown("---")
+    
+    # Chronotype Display
+    if not math.isnan(MSFsc):
+        st.success(f'Váš **chronotyp** (MSFsc) je: **{round(MSFsc, 2)}**')
+        st.write("")
+        
+        sun = result['vd'].get('MSFsc_sun', 'N/A')
+        if sun != 'N/A':
+            st.caption(f"Po korekci na místní sluneční čas ({result['vd']['district']}, {result['vd']['lon']}° v. d.): **{round(sun, 2)}**")
+
+        # Classification
+        st.info(chronotype_messages[res['chronotype']])
+        show_population_position('MSFsc', MSFsc, 'Váš chronotyp je pozdější než u **{pct} %** dosavadních respondentů.',
+                                 population_slice)
+        
+        if result['Shift'] == 1:            
+            st.warning("Z důvodu nedávné práce na směny není váš chronotyp ustálený.")
+        if result['Travel'] == 1:            
+            st.warning("Z důvodu nedávného cestování není váš chronotyp ustálený.")
+        
+            
+    else:
+        st.warning('Váš přesný chronotyp nelze určit, protože máte nepravidelný režim, nebo se budíte až s budíkem i během víkendu.')
+        
+        # Bamid estimate
+        if not math.isnan(Bamid):
+            st.info(f'Nicméně, lze přibližně odhadnout subjektivní chronotyp: **{round(Bamid, 2)}**')
+            st.info(bamid_messages[res['bamid_class']])
+        else:
+            st.error('Ani váš přibližný chronotyp nelze odhadnout.')
+
+    st.markdown("---")
+    
+    # Social Jetlag
+    if not math.isnan(SJL):
+        st.success(f'Váš **sociální jetlag** (SJL) je: **{round(SJL, 2)} hodin**')
+        st.caption("(Rozdíl mezi středem spánku ve volné dny a ve všední dny)")
+        
+        show, message = sjl_messages[res['sjl_class']]
+        show(message)
+        show_population_position('SJL', SJL, 'Váš sociální jetlag je větší než u **{pct} %** dosavadních respondentů.',
+                                 population_slice)
+    else:
+         st.warning('Váš sociální jetlag nelze určit, protože nemáte volné a všední dny, nebo máte nepravidelný režim.')
+
+    # What if the respondent woke later on workdays / went to bed earlier on free days?
+    if not math.isnan(SJL):
+        with st.expander("🔧 Co kdybych posunul(a) svůj rozvrh?"):
+            what_if_explorer(result['inputs'], {k: res[k] for k in ('SJL', 'MSFsc', 'SDweek')})
+
+    st.markdown("---")
+    st.info('Děkujeme za vyplnění MCTQ dotazníku.')
+
+    # Save status: polled in an isolated fragment until the primary sink confirms the write
+    if result['save_done']:
+        render_save_status(result)
+    else:
+        poll_save_status()
+
+
+# --- Profile of this rerun (only in profiling mode) ---
+finish_profile("submit" if submit_button else "rerun")
@@ -0,0 +1,108 @@
+# Cold-start and rerun latency of app.py.
+#
+# Each measurement runs in a fresh interpreter so the module cache is cold,
+# drives app.py through Streamlit's AppTest harness and reports (as JSON):
+#   first_run_ms   - first script run including the app's own imports
+#   rerun_ms       - p50/p95 of subsequent reruns (what every widget interaction costs)
+#   heavy_modules  - storage/analytics modules loaded before anyone submitted
+#
+# Usage:
+#   python benchmarks/bench_startup.py [--repeat 5] [--reruns 20] [--output startup.json]
+#   python benchmarks/bench_startup.py --max-first-run-ms 1500 --max-rerun-ms 150   # regression guard
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+APP = Path(__file__).resolve().parent.parent / "app.py"
+
+# Only the submit path may need these
+HEAVY_MODULES = ("gspread", "numpy", "pandas", "pyarrow", "google.auth")
+
+
+def _child(reruns):
+    import time
+
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(str(APP), default_timeout=60)
+    t0 = time.perf_counter()
+    at.run()
+    first = (time.perf_counter() - t0) * 1000
+    heavy = sorted(m for m in HEAVY_MODULES if m in sys.modules)
+
+    times = []
+    for _ in range(reruns):
+        t0 = time.perf_counter()
+        at.run()
+        times.append((time.perf_counter() - t0) * 1000)
+
+    json.dump({"first_run_ms": first, "rerun_ms": times, "heavy_modules": heavy,
+               "exception": [str(e.value) for e in at.exception]}, sys.stdout)
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def measure(repeat=5, reruns=20):
+    """Runs `repeat` fresh processes and aggregates their timings."""
+    firsts, reruns_all, heavy = [], [], set()
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--reruns", str(reruns)],
+            capture_output=True, text=True, check=True, cwd=APP.parent,
+        )
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        if res["exception"]:
+            raise RuntimeError(f"app.py raised: {res['exception']}")
+        firsts.append(res["first_run_ms"])
+        reruns_all.extend(res["rerun_ms"])
+        heavy.update(res["heavy_modules"])
+    return {
+        "benchmark": "startup",
+        "python": sys.version.split()[0],
+        "repeat": repeat,
+        "first_run_ms": {"median": statistics.median(firsts), "min": min(firsts), "max": max(firsts)},
+        "rerun_ms": {"p50": _percentile(reruns_all, 0.5), "p95": _percentile(reruns_all, 0.95), "n": len(reruns_all)},
+        "heavy_modules": sorted(heavy),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold-start and rerun latency of app.py.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    parser.add_argument("--max-first-run-ms", type=float, help="Fail if the median first run is slower")
+    parser.add_argument("--max-rerun-ms", type=float, help="Fail if the p95 rerun is slower")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(args.reruns)
+        return 0
+
+    result = measure(args.repeat, args.reruns)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text)
+
+    failures = []
+    if result["heavy_modules"]:
+        failures.append(f"heavy modules imported before submit: {result['heavy_modules']}")
+    if args.max_first_run_ms and result["first_run_ms"]["median"] > args.max_first_run_ms:
+        failures.append(f"first run {result['first_run_ms']['median']:.0f} ms > {args.max_first_run_ms:.0f} ms")
+    if args.max_rerun_ms and result["rerun_ms"]["p95"] > args.max_rerun_ms:
+        failures.append(f"rerun p95 {result['rerun_ms']['p95']:.0f} ms > {args.max_rerun_ms:.0f} ms")
+    for f in failures:
+        print(f"FAIL: {f}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
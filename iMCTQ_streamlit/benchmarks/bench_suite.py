@@ -0,0 +1,233 @@
+# Offline benchmark suite for the iMCTQ app.
+#
+# Benchmarks (select with --only):
+#   scoring   - mctq.score for one respondent, mctq.score_batch for synthetic populations
+#   rerun     - app.py through Streamlit's AppTest: first run, plain reruns, a submit
+#   storage   - the save path against FakeWorksheet with injected latency/failures:
+#               direct append per submit vs. spool + batched flusher
+#
+# Results are JSON (tagged with the build commit) so runs can be compared:
+#   python benchmarks/bench_suite.py --output before.json
+#   python benchmarks/bench_suite.py --compare before.json
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+from datetime import time as dtime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import numpy as np  # noqa: E402
+
+import buildinfo  # noqa: E402
+import mctq  # noqa: E402
+import spool  # noqa: E402
+from fake_sheets import FakeConnection, FakeSpreadsheet, FakeWorksheet  # noqa: E402
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 4)
+
+
+def _summary(samples):
+    """p50/p95/max in ms of a list of durations in seconds."""
+    s = sorted(samples)
+    return {"p50_ms": _ms(s[len(s) // 2]), "p95_ms": _ms(s[int(0.95 * (len(s) - 1))]), "max_ms": _ms(s[-1]), "n": len(s)}
+
+
+# --- Synthetic data ---
+
+def synthetic_population(n, seed=0):
+    """Keyword arguments for mctq.score_batch describing n plausible respondents."""
+    rng = np.random.default_rng(seed)
+    return dict(
+        WD=rng.integers(0, 8, n),
+        SPrepw=rng.normal(23 * 60, 45, n) % mctq.MINUTES_PER_DAY, SLatw=rng.integers(0, 45, n),
+        SEw=rng.normal(6.5 * 60, 40, n) % mctq.MINUTES_PER_DAY,
+        SPrepf=rng.normal(0.5 * 60, 60, n) % mctq.MINUTES_PER_DAY, SLatf=rng.integers(0, 45, n),
+        SEf=rng.normal(8.5 * 60, 60, n) % mctq.MINUTES_PER_DAY,
+        Alarmf=rng.integers(0, 2, n), BAlarmf=rng.integers(0, 2, n), BAlarmw=rng.integers(0, 2, n),
+        Bastart=rng.normal(9 * 60, 60, n) % mctq.MINUTES_PER_DAY, Baend=rng.normal(17 * 60, 90, n) % mctq.MINUTES_PER_DAY,
+        Baend_past_midnight=np.zeros(n, dtype=int),
+    )
+
+
+def synthetic_record(i):
+    """A record shaped like the `vd` dict app.py saves."""
+    return {
+        'ID': spool.new_record_id(), 'age': 20 + i % 50, 'sex': 'žena (f)', 'height': 170, 'weight': 70,
+        'postal': '14800', 'educ': 3, 'WD': 5, 'FD': 2,
+        'BTw': '23-00', 'SPrepw': '23-30', 'SLatwi': 15, 'SEw': '07-00', 'Alarmw': 1, 'BAlarmw': 0, 'SIw': 5, 'LEw': 0.5,
+        'BTf': '00-30', 'SPrepf': '01-00', 'SLatfi': 15, 'SEf': '09-00', 'Alarmf': 0, 'BAlarmf': 0, 'SIf': 10, 'LEf': 1.0,
+        'Slequal': 2, 'Bastart': '09-00', 'Baend_time': '17-00', 'Baend_past_midnight': False,
+        'MSFsc': 4.94, 'SJL': 1.75, 'Bamid': 13.0,
+        'Shift': 0, 'Shifts': '23-00', 'Shifts_past_midnight': False, 'Shifte': '03-00', 'Shifte_past_midnight': False,
+        'Travel': 0,
+    }
+
+
+# --- Benchmarks ---
+
+def bench_scoring(quick=False):
+    args = (5, dtime(23, 30), 15, dtime(7, 0), dtime(1, 0), 15, dtime(9, 0), 0, 0, 0, dtime(9, 0), dtime(17, 0), False)
+    n_single = 500 if quick else 5000
+    samples = []
+    for _ in range(n_single):
+        t0 = time.perf_counter()
+        mctq.score(*args)
+        samples.append(time.perf_counter() - t0)
+    out = {"single": _summary(samples)}
+
+    for n in ([1_000, 100_000] if quick else [1_000, 100_000, 1_000_000]):
+        pop = synthetic_population(n)
+        runs = []
+        for _ in range(3):
+            t0 = time.perf_counter()
+            mctq.score_batch(**pop)
+            runs.append(time.perf_counter() - t0)
+        out[f"batch_{n}"] = {"best_ms": _ms(min(runs)), "ns_per_row": round(min(runs) / n * 1e9, 2)}
+    return out
+
+
+def bench_rerun(quick=False):
+    from streamlit.testing.v1 import AppTest
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["IMCTQ_SPOOL_PATH"] = str(Path(tmp) / "spool.sqlite3")
+        os.environ["IMCTQ_DATA_DIR"] = tmp
+        at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=60)
+        t0 = time.perf_counter()
+        at.run()
+        first = time.perf_counter() - t0
+
+        reruns = []
+        for _ in range(5 if quick else 20):
+            t0 = time.perf_counter()
+            at.run()
+            reruns.append(time.perf_counter() - t0)
+
+        submits = []
+        for _ in range(3 if quick else 10):
+            button = next(b for b in at.button if b.proto.is_form_submitter)
+            t0 = time.perf_counter()
+            button.click().run()
+            submits.append(time.perf_counter() - t0)
+        errors = [e.value for e in at.exception]
+    return {"first_run_ms": _ms(first), "rerun": _summary(reruns), "submit": _summary(submits), "exceptions": errors}
+
+
+def _bench_direct(latency, failure_rate, n):
+    ws = FakeWorksheet("responses", list(synthetic_record(0)), latency, failure_rate, seed=1)
+    conn = FakeConnection(FakeSpreadsheet([ws]), sheet_name="responses")
+    samples, failed = [], 0
+    for i in range(n):
+        t0 = time.perf_counter()
+        try:
+            conn.append(synthetic_record(i))
+        except Exception:
+            failed += 1
+        samples.append(time.perf_counter() - t0)
+    return {"submit": _summary(samples), "lost": failed, "api_calls": sum(ws.calls.values())}
+
+
+def _bench_spooled(latency, failure_rate, n, tmp):
+    ws = FakeWorksheet("responses", list(synthetic_record(0)), latency, failure_rate, seed=1)
+    conn = FakeConnection(FakeSpreadsheet([ws]), sheet_name="responses")
+    sp = spool.Spool(Path(tmp) / f"spool-{latency}-{failure_rate}.sqlite3")
+    flusher = spool.Flusher(sp, conn, batch_size=200, interval=0.05, base_backoff=0.05, max_backoff=0.5).start()
+    samples = []
+    t_start = time.perf_counter()
+    for i in range(n):
+        t0 = time.perf_counter()
+        sp.put(synthetic_record(i))
+        samples.append(time.perf_counter() - t0)
+    deadline = time.perf_counter() + 120
+    while sp.counts().get(spool.SAVED, 0) < n and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    drained = time.perf_counter() - t_start
+    flusher.stop()
+    return {
+        "submit": _summary(samples),
+        "drain_ms": _ms(drained),
+        "saved": sp.counts().get(spool.SAVED, 0),
+        "rows_in_sheet": len(ws.rows) - 1,
+        "api_calls": sum(ws.calls.values()),
+    }
+
+
+def bench_storage(quick=False):
+    n = 100 if quick else 500
+    out = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for latency in (0.0, 0.05):
+            for failure_rate in (0.0, 0.2):
+                key = f"latency_{int(latency * 1000)}ms_fail_{int(failure_rate * 100)}pct"
+                n_direct = n if latency == 0 else n // 10
+                out[key] = {
+                    "direct": _bench_direct(latency, failure_rate, n_direct),
+                    "spooled": _bench_spooled(latency, failure_rate, n, tmp),
+                }
+    return out
+
+
+BENCHMARKS = {"scoring": bench_scoring, "rerun": bench_rerun, "storage": bench_storage}
+
+
+# --- Comparison ---
+
+def _flatten(d, prefix=""):
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, f"{prefix}{k}.")
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            yield f"{prefix}{k}", v
+
+
+def compare(old, new):
+    """Prints metrics present in both runs with their relative change."""
+    old_flat = dict(_flatten(old["results"]))
+    print(f"{'metric':60} {old.get('commit', '?'):>12} {new.get('commit', '?'):>12}  change")
+    for key, value in _flatten(new["results"]):
+        if key in old_flat:
+            before = old_flat[key]
+            change = f"{(value - before) / before * 100:+.1f}%" if before else ""
+            print(f"{key:60} {before:12.4g} {value:12.4g}  {change}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline iMCTQ benchmarks (JSON output).")
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="Run only these (repeatable)")
+    parser.add_argument("--quick", action="store_true", help="Smaller sizes, for CI smoke runs")
+    parser.add_argument("--output", help="Write the JSON result to this file")
+    parser.add_argument("--compare", help="Previous JSON result to compare against")
+    args = parser.parse_args(argv)
+
+    result = {
+        "commit": buildinfo.commit_hash(),
+        "timestamp": dt.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "results": {},
+    }
+    for name in args.only or BENCHMARKS:
+        print(f"running {name} ...", file=sys.stderr)
+        result["results"][name] = BENCHMARKS[name](quick=args.quick)
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
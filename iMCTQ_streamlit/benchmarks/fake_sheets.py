@@ -0,0 +1,152 @@
+# In-process stand-in for the parts of gspread the app uses.
+#
+# FakeWorksheet keeps rows in a list and implements the Worksheet calls used
+# by sheets.py / rescore.py. Every call can be slowed down (`latency`, seconds)
+# and made to fail at random (`failure_rate`, raising gspread's APIError with
+# `failure_code`, 429 by default), so the storage path can be benchmarked
+# offline. FakeConnection is a SheetsConnection wired to a FakeSpreadsheet.
+import random
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+import gspread
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sheets  # noqa: E402
+
+
+class _FakeResponse:
+    """Just enough of requests.Response for gspread.exceptions.APIError."""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._code = code
+        self._message = message
+
+    def json(self):
+        return {"error": {"code": self._code, "message": self._message, "status": "FAKE"}}
+
+
+def _cell(ref):
+    # 'B12' -> (row, col), both 1-based; a bare column ('B') or row ('12') gives None for the other
+    m = re.fullmatch(r"([A-Z]*)(\d*)", ref.upper())
+    col = 0
+    for ch in m.group(1):
+        col = col * 26 + ord(ch) - 64
+    return (int(m.group(2)) if m.group(2) else None), (col or None)
+
+
+class FakeWorksheet:
+    def __init__(self, title, header, latency=0.0, failure_rate=0.0, failure_code=429, seed=None):
+        self.title = title
+        self.rows = [list(header)] if header else []
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.calls = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            fail = self._rng.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise gspread.exceptions.APIError(_FakeResponse(self.failure_code, f"fake {name} failure"))
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def row_values(self, row):
+        self._call("row_values")
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col):
+        self._call("col_values")
+        return [r[col - 1] if col <= len(r) else "" for r in self.rows]
+
+    def append_row(self, values, value_input_option="RAW"):
+        self.append_rows([values], value_input_option)
+
+    def append_rows(self, values, value_input_option="RAW"):
+        self._call("append_rows")
+        with self._lock:
+            self.rows.extend(list(v) for v in values)
+
+    def get(self, range_name):
+        """A1 range read like 'A2:K100', 'A:A' or '1:1' (trailing empty rows are dropped, as the API does)."""
+        self._call("get")
+        return self._range(range_name)
+
+    def _range(self, range_name):
+        start, _, end = range_name.partition(":")
+        r0, c0 = _cell(start)
+        r1, c1 = _cell(end or start)
+        r0 = r0 or 1
+        r1 = r1 or len(self.rows)
+        out = [r[(c0 or 1) - 1:c1] for r in self.rows[r0 - 1:r1]]
+        while out and not any(v not in ("", None) for v in out[-1]):
+            out.pop()
+        return out
+
+    def batch_update(self, data, value_input_option="RAW"):
+        self._call("batch_update")
+        with self._lock:
+            for upd in data:
+                start, _, _ = upd["range"].partition(":")
+                r0, c0 = _cell(start)
+                c0 = c0 or 1
+                for i, vals in enumerate(upd["values"]):
+                    while len(self.rows) < r0 + i:
+                        self.rows.append([])
+                    row = self.rows[r0 + i - 1]
+                    row.extend([""] * (c0 - 1 + len(vals) - len(row)))
+                    row[c0 - 1:c0 - 1 + len(vals)] = vals
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheets=()):
+        self._worksheets = {ws.title: ws for ws in worksheets}
+
+    def worksheet(self, title):
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise gspread.exceptions.WorksheetNotFound(title)
+
+    def worksheets(self):
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=1, cols=1, **kwargs):
+        ws = FakeWorksheet(title, [])
+        self._worksheets[title] = ws
+        return ws
+
+
+class FakeConnection(sheets.SheetsConnection):
+    """SheetsConnection that talks to a FakeSpreadsheet instead of Google."""
+
+    def __init__(self, spreadsheet, sheet_name=sheets.SHEET_NAME, **kwargs):
+        super().__init__(None, sheet_name=sheet_name, **kwargs)
+        self.spreadsheet = spreadsheet
+
+    def _open_workbook(self):
+        return self.spreadsheet
+
+    def batch_get(self, ranges, title=None):
+        out = []
+        for i, r in enumerate(ranges):
+            ws_title, cells = r if isinstance(r, tuple) else (title or self.current_title, r)
+            ws = self.spreadsheet.worksheet(ws_title)
+            if i == 0:
+                ws._call("batch_get")
+            out.append(ws._range(cells))
+        return out
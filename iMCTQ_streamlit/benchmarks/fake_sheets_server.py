@@ -0,0 +1,307 @@
+# Local HTTP stand-in for the Google Sheets v4 API.
+#
+# Serves the REST calls gspread makes for the app (spreadsheet metadata,
+# values get/append/batchUpdate) on top of the in-memory FakeSpreadsheet, so
+# the real SheetsConnection -> gspread -> HTTP path can be exercised offline:
+#   IMCTQ_SHEETS_EMULATOR=http://127.0.0.1:8600  (see sheets.py)
+# Each request can be delayed (`latency` seconds plus up to `jitter`), fail at
+# random (`error_rate`, HTTP `error_code`) and is subject to per-minute read and
+# write quotas like the real API (HTTP 429 when exceeded; 0 = unlimited).
+#
+#   python benchmarks/fake_sheets_server.py --port 8600 --latency 0.2 --write-quota 60
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from fake_sheets import FakeSpreadsheet, FakeWorksheet
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import sheets  # noqa: E402
+
+_VALUES = re.compile(r"^/v4/spreadsheets/([^/:]+)/values/([^:]+)(:append)?$")
+_BATCH_VALUES = re.compile(r"^/v4/spreadsheets/([^/:]+)/values:batchUpdate$")
+_BATCH_GET = re.compile(r"^/v4/spreadsheets/([^/:]+)/values:batchGet$")
+_META = re.compile(r"^/v4/spreadsheets/([^/:]+)$")
+_BATCH_UPDATE = re.compile(r"^/v4/spreadsheets/([^/:]+):batchUpdate$")
+
+
+def _split_range(range_name):
+    """"'Sheet 1'!A1:B2" -> ('Sheet 1', 'A1:B2'); a bare sheet name gives an empty range."""
+    if "!" in range_name:
+        title, _, cells = range_name.rpartition("!")
+    elif re.fullmatch(r"[A-Za-z]*\d*(:[A-Za-z]*\d*)?", range_name):
+        title, cells = None, range_name
+    else:
+        title, cells = range_name, ""
+    if title and title.startswith("'") and title.endswith("'"):
+        title = title[1:-1].replace("''", "'")
+    return title, cells
+
+
+class _Quota:
+    """Sliding one-minute window of request times."""
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self._times = deque()
+        self._lock = threading.Lock()
+
+    def admit(self):
+        if not self.per_minute:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            while self._times and now - self._times[0] >= 60:
+                self._times.popleft()
+            if len(self._times) >= self.per_minute:
+                return False
+            self._times.append(now)
+            return True
+
+
+class FakeSheetsServer:
+    """
+    Threaded HTTP server emulating the Sheets API for one spreadsheet.
+    `stats` counts requests per kind and outcome ('append', 'ok'), ...
+    """
+
+    def __init__(self, spreadsheet=None, spreadsheet_id=sheets.SHEET_ID, host="127.0.0.1", port=0,
+                 latency=0.0, jitter=0.0, error_rate=0.0, error_code=503, read_quota=0, write_quota=0, seed=None):
+        self.spreadsheet = spreadsheet or FakeSpreadsheet()
+        self.spreadsheet_id = spreadsheet_id
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.read_quota = _Quota(read_quota)
+        self.write_quota = _Quota(write_quota)
+        self.stats = {}
+        self.arrivals = {}  # record ID -> time.monotonic() when it was appended
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-sheets-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _count(self, kind, outcome):
+        with self._lock:
+            key = f"{kind}.{outcome}"
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def ids(self, worksheet_title=None):
+        """Set of values in the ID column of a worksheet, or of all of them (to check which records arrived)."""
+        found = set()
+        for ws in self.spreadsheet.worksheets():
+            header = ws.rows[0] if ws.rows else []
+            if worksheet_title not in (None, ws.title) or "ID" not in header:
+                continue
+            col = header.index("ID")
+            found |= {r[col] for r in ws.rows[1:] if len(r) > col}
+        return found
+
+    # --- Request handling ---
+
+    def _admit(self, kind, write):
+        """None if the request may proceed, else (status, message)."""
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if not (self.write_quota if write else self.read_quota).admit():
+            kind_name = "Write" if write else "Read"
+            return 429, (f"Quota exceeded for quota metric '{kind_name} requests' and limit "
+                         f"'{kind_name} requests per minute per user'")
+        with self._lock:
+            fail = self._rng.random() < self.error_rate
+        if fail:
+            return self.error_code, "The service is currently unavailable."
+        return None
+
+    def _worksheet(self, title):
+        return self.spreadsheet.worksheet(title) if title else self.spreadsheet.worksheets()[0]
+
+    def _metadata(self):
+        return {
+            "spreadsheetId": self.spreadsheet_id,
+            "properties": {"title": "iMCTQ (fake)", "locale": "cs_CZ", "timeZone": "Europe/Prague"},
+            "sheets": [
+                {"properties": {
+                    "sheetId": i, "title": ws.title, "index": i, "sheetType": "GRID",
+                    "gridProperties": {"rowCount": max(1000, len(ws.rows)),
+                                       "columnCount": max(26, max((len(r) for r in ws.rows), default=0))},
+                }}
+                for i, ws in enumerate(self.spreadsheet.worksheets())
+            ],
+        }
+
+    def _add_sheets(self, body):
+        # Only the addSheet request of spreadsheets.batchUpdate (used by add_worksheet)
+        replies = []
+        for req in body.get("requests", []):
+            title = req["addSheet"]["properties"]["title"]
+            if title in {ws.title for ws in self.spreadsheet.worksheets()}:
+                raise ValueError(f"A sheet with the name \"{title}\" already exists.")
+            self.spreadsheet.add_worksheet(title)
+            index = len(self.spreadsheet.worksheets()) - 1
+            replies.append({"addSheet": {"properties": {
+                "sheetId": index, "title": title, "index": index, "sheetType": "GRID",
+                "gridProperties": {"rowCount": 1000, "columnCount": 26}}}})
+        return {"spreadsheetId": self.spreadsheet_id, "replies": replies}
+
+    def _value_range(self, title, cells, query):
+        ws = self._worksheet(title)
+        values = ws.get(cells or "A1:ZZ")
+        if query.get("majorDimension", [""])[0] == "COLUMNS":
+            width = max((len(r) for r in values), default=0)
+            values = [[r[j] if j < len(r) else "" for r in values] for j in range(width)]
+        out = {"range": f"'{ws.title}'!{cells}", "majorDimension": "ROWS", "values": values}
+        if not values:
+            del out["values"]
+        return out
+
+    def handle(self, method, path, query, body):
+        """Returns (status, JSON body) for one API request."""
+        m = _VALUES.match(path)
+        if m and m.group(1) == self.spreadsheet_id:
+            title, cells = _split_range(unquote(m.group(2)))
+            if m.group(3):
+                kind, write = "append", True
+            else:
+                kind, write = "get", False
+        elif _BATCH_VALUES.match(path):
+            kind, write = "batch_update", True
+        elif _BATCH_GET.match(path):
+            kind, write = "batch_get", False
+        elif _META.match(path) and method == "GET":
+            kind, write = "metadata", False
+        elif _BATCH_UPDATE.match(path):
+            kind, write = "add_sheet", True
+        else:
+            self._count("unknown", "404")
+            return 404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}}
+
+        refused = self._admit(kind, write)
+        if refused:
+            status, message = refused
+            self._count(kind, str(status))
+            state = "RESOURCE_EXHAUSTED" if status == 429 else "UNAVAILABLE"
+            return status, {"error": {"code": status, "message": message, "status": state}}
+
+        try:
+            if kind == "metadata":
+                out = self._metadata()
+            elif kind == "add_sheet":
+                out = self._add_sheets(body)
+            elif kind == "get":
+                out = self._value_range(title, cells, query)
+            elif kind == "batch_get":
+                out = {"spreadsheetId": self.spreadsheet_id, "valueRanges": [
+                    self._value_range(*_split_range(r), query) for r in query.get("ranges", [])]}
+            elif kind == "append":
+                ws = self._worksheet(title)
+                rows = [["" if v is None else str(v) for v in row] for row in body.get("values", [])]
+                first = len(ws.rows) + 1
+                ws.append_rows(rows)
+                if ws.rows and "ID" in ws.rows[0]:
+                    col, now = ws.rows[0].index("ID"), time.monotonic()
+                    with self._lock:
+                        for row in rows:
+                            if len(row) > col:
+                                self.arrivals.setdefault(row[col], now)
+                out = {"spreadsheetId": self.spreadsheet_id, "updates": {
+                    "updatedRange": f"'{ws.title}'!A{first}", "updatedRows": len(rows)}}
+            else:
+                for upd in body.get("data", []):
+                    title, cells = _split_range(upd["range"])
+                    values = [["" if v is None else str(v) for v in row] for row in upd["values"]]
+                    self._worksheet(title).batch_update([{"range": cells, "values": values}])
+                out = {"spreadsheetId": self.spreadsheet_id, "totalUpdatedRanges": len(body.get("data", []))}
+        except Exception as e:  # unknown worksheet, bad range, ...
+            self._count(kind, "400")
+            return 400, {"error": {"code": 400, "message": f"{type(e).__name__}: {e}", "status": "INVALID_ARGUMENT"}}
+        self._count(kind, "ok")
+        return 200, out
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                status, out = server.handle(self.command, url.path, parse_qs(url.query), body)
+                data = json.dumps(out).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def make_server(header, sheet_name=sheets.SHEET_NAME, **kwargs):
+    """A FakeSheetsServer with one worksheet holding `header` (not started)."""
+    return FakeSheetsServer(FakeSpreadsheet([FakeWorksheet(sheet_name, header)]), **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Google Sheets API server for offline tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many extra seconds, at random")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-code", type=int, default=503)
+    parser.add_argument("--read-quota", type=int, default=0, help="Read requests per minute (0 = unlimited)")
+    parser.add_argument("--write-quota", type=int, default=0, help="Write requests per minute (0 = unlimited)")
+    args = parser.parse_args(argv)
+
+    from bench_suite import synthetic_record
+
+    server = make_server(
+        list(synthetic_record(0)), host=args.host, port=args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, error_code=args.error_code,
+        read_quota=args.read_quota, write_quota=args.write_quota,
+    ).start()
+    print(f"Fake Sheets API on {server.url} (export {sheets.EMULATOR_ENV}={server.url})", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,260 @@
+# Concurrent-session load test of the app, fully offline.
+#
+# Starts the fake Sheets API server (fake_sheets_server.py), points the app
+# at it (IMCTQ_SHEETS_EMULATOR, sink "sheets") and drives N simulated
+# respondents at once, each in its own Streamlit AppTest session: load the
+# page, fill the mctq_form with random plausible answers, submit, wait for
+# the results. Each session runs in its own process: AppTest installs a
+# process-global Runtime for every run and removes it afterwards, so sessions
+# in threads of one process tear down each other's runtime. The sessions
+# share one spool file; this process holds its writer lock and is the one
+# flusher that drains it into the fake sheet (spool.WriterLock), as the app
+# and the API workers do.
+#
+# Reported per concurrency level: throughput, p50/p95/p99 of page load,
+# submit (click -> results rendered) and submit -> row in the sheet, plus an
+# error breakdown from the sessions and from the fake API (429s, 5xx).
+#
+#   python benchmarks/load_test.py --sessions 10 25 50 --submits 3
+#   python benchmarks/load_test.py --sessions 40 --latency 0.3 --error-rate 0.05 --write-quota 60
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from datetime import time as dtime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import buildinfo  # noqa: E402
+import sheets  # noqa: E402
+from bench_suite import synthetic_record  # noqa: E402
+from fake_sheets_server import make_server  # noqa: E402
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def percentiles(samples):
+    """p50/p95/p99/max in ms (nearest rank) of durations in seconds."""
+    if not samples:
+        return {"n": 0}
+    s = sorted(samples)
+
+    def p(q):
+        return _ms(s[min(len(s) - 1, max(0, int(round(q * len(s))) - 1))])
+
+    return {"p50_ms": p(0.50), "p95_ms": p(0.95), "p99_ms": p(0.99), "max_ms": _ms(s[-1]), "n": len(s)}
+
+
+def share_script_cache():
+    """
+    AppTest compiles app.py afresh on every run, while a real server compiles
+    it once and shares the bytecode between sessions, so all runs of a
+    session process get one shared ScriptCache.
+    """
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    shared = ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: shared
+    shared.get_bytecode(str(ROOT / "app.py"))
+
+
+def _clock(rng, hour, sd_minutes):
+    minutes = int(rng.gauss(hour * 60, sd_minutes)) % (24 * 60)
+    return dtime(minutes // 60, minutes % 60)
+
+
+def init_session_process():
+    """
+    Pool initializer: imports what a running server has already imported
+    and compiles app.py, so a session's page load is not charged with the
+    process start-up.
+    """
+    import altair  # noqa: F401
+    import gspread  # noqa: F401
+    import mctq  # noqa: F401
+    import pandas  # noqa: F401
+
+    share_script_cache()
+
+
+def fill_form(at, rng):
+    """Sets the form widgets to a random, plausible respondent."""
+    number = {w.label: w for w in at.number_input}
+    number["Věk:"].set_value(rng.randint(18, 70))
+    next(w for label, w in number.items() if label.startswith("Kolik dní v týdnu")).set_value(rng.randint(1, 6))
+    at.time_input(key="SPrepw").set_value(_clock(rng, 23, 40))
+    at.time_input(key="SEw").set_value(_clock(rng, 6.5, 30))
+    at.number_input(key="SLatwi").set_value(rng.randint(0, 40))
+    at.time_input(key="SPrepf").set_value(_clock(rng, 0.5, 50))
+    at.time_input(key="SEf").set_value(_clock(rng, 8.5, 50))
+    at.number_input(key="SLatfi").set_value(rng.randint(0, 40))
+    at.radio(key="Alarmf").set_value(rng.choice([0, 1]))
+    at.time_input(key="Bastart_time").set_value(_clock(rng, 9, 60))
+    at.time_input(key="Baend_time").set_value(_clock(rng, 17, 60))
+
+
+class Session:
+    """One simulated respondent: its own AppTest (in a pool process), `submits` questionnaires in a row."""
+
+    def __init__(self, index, submits, timeout, seed):
+        self.index = index
+        self.submits = submits
+        self.timeout = timeout
+        self.rng = random.Random(seed * 100_003 + index)
+        self.load = None
+        self.submit_times = []
+        self.saved = []  # (record ID, monotonic time of the click; the clock is system-wide)
+        self.errors = {}
+
+    def _error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def run(self, start_barrier):
+        from streamlit.testing.v1 import AppTest
+
+        start_barrier.wait()
+        try:
+            at = AppTest.from_file(str(ROOT / "app.py"), default_timeout=self.timeout)
+            t0 = time.perf_counter()
+            at.run()
+            self.load = time.perf_counter() - t0
+        except Exception as e:
+            self._error(f"load:{type(e).__name__}")
+            return self
+        for _ in range(self.submits):
+            try:
+                fill_form(at, self.rng)
+                button = next(b for b in at.button if b.proto.is_form_submitter)
+                clicked = time.monotonic()
+                t0 = time.perf_counter()
+                button.click().run()
+                elapsed = time.perf_counter() - t0
+            except Exception as e:
+                self._error(f"submit:{type(e).__name__}")
+                continue
+            if at.exception:
+                self._error("app_exception")
+                continue
+            result = at.session_state["result"] if "result" in at.session_state else None
+            if result is None:
+                # The form refused the answers (e.g. implausible sleep duration)
+                self._error("rejected" if at.error else "no_result")
+                continue
+            self.submit_times.append(elapsed)
+            self.saved.append((result["vd"]["ID"], clicked))
+        return self
+
+
+def run_level(n_sessions, args, server, manager):
+    """Runs `n_sessions` concurrent sessions; returns the report of this level."""
+    barrier = manager.Barrier(n_sessions + 1)
+    sessions = [Session(i, args.submits, args.timeout, args.seed) for i in range(n_sessions)]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=n_sessions, mp_context=context, initializer=init_session_process) as pool:
+        futures = [pool.submit(s.run, barrier) for s in sessions]
+        # Start the clock once every session process is up and waiting
+        barrier.wait()
+        t_start = time.perf_counter()
+        sessions = [f.result() for f in futures]
+        submitted = time.perf_counter() - t_start
+
+    # Wait for the flusher to deliver every accepted submit to the fake sheet
+    pending = [item for s in sessions for item in s.saved]
+    deadline = time.monotonic() + args.save_timeout
+    while any(i not in server.arrivals for i, _ in pending) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    total = time.perf_counter() - t_start
+
+    errors = {}
+    for s in sessions:
+        for kind, n in s.errors.items():
+            errors[kind] = errors.get(kind, 0) + n
+    saved_times = [server.arrivals[i] - clicked for i, clicked in pending if i in server.arrivals]
+    lost = len(pending) - len(saved_times)
+    if lost:
+        errors["not_saved_in_time"] = lost
+
+    accepted = sum(len(s.submit_times) for s in sessions)
+    return {
+        "sessions": n_sessions,
+        "submits_attempted": n_sessions * args.submits,
+        "submits_ok": accepted,
+        "throughput_submits_per_s": round(accepted / submitted, 2) if submitted else None,
+        "wall_s": round(submitted, 3),
+        "drain_s": round(total - submitted, 3),
+        "load": percentiles([s.load for s in sessions if s.load is not None]),
+        "submit": percentiles([t for s in sessions for t in s.submit_times]),
+        "submit_to_saved": percentiles(saved_times),
+        "errors": errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test: N concurrent sessions against a fake Sheets API.")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10], help="Concurrency levels to run, in order")
+    parser.add_argument("--submits", type=int, default=1, help="Questionnaires per session")
+    parser.add_argument("--latency", type=float, default=0.1, help="Fake API latency per request (s)")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API requests failing with --error-code")
+    parser.add_argument("--error-code", type=int, default=503)
+    parser.add_argument("--read-quota", type=int, default=0, help="Fake API read requests per minute (0 = unlimited)")
+    parser.add_argument("--write-quota", type=int, default=0, help="Fake API write requests per minute (0 = unlimited)")
+    parser.add_argument("--timeout", type=float, default=120, help="AppTest timeout per script run (s)")
+    parser.add_argument("--save-timeout", type=float, default=120, help="How long to wait for the sheet to catch up (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    server = make_server(
+        list(synthetic_record(0)), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_code=args.error_code, read_quota=args.read_quota, write_quota=args.write_quota, seed=args.seed,
+    ).start()
+    report = {
+        "commit": buildinfo.commit_hash(),
+        "timestamp": dt.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "levels": [],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update({
+            sheets.EMULATOR_ENV: server.url,
+            "IMCTQ_SINKS": "sheets",
+            "IMCTQ_SPOOL_PATH": str(Path(tmp) / "spool.sqlite3"),
+            "IMCTQ_DATA_DIR": tmp,
+        })
+        import storage
+
+        # The single writer of the shared spool; the session processes only spool
+        flushers = storage.start_flushers(["sheets"], sheets_connection=sheets.SheetsConnection(None))
+        for flusher in flushers.values():
+            flusher.writer_lock.acquire()
+        with multiprocessing.Manager() as manager:
+            for n in args.sessions:
+                print(f"running {n} concurrent sessions ...", file=sys.stderr)
+                report["levels"].append(run_level(n, args, server, manager))
+        for flusher in flushers.values():
+            flusher.stop()
+    server.stop()
+    report["fake_api"] = dict(sorted(server.stats.items()))
+
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
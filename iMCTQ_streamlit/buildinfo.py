@@ -0,0 +1,31 @@
+# Build metadata, resolved once per process.
+#
+# Streamlit re-executes app.py on every interaction, but imported modules stay
+# loaded, so the lookup below runs only once. A deploy can bake the version in
+# with the IMCTQ_BUILD environment variable or a BUILD file next to app.py;
+# otherwise git is asked once.
+import functools
+import os
+import subprocess
+from pathlib import Path
+
+BUILD_FILE = Path(__file__).resolve().parent / "BUILD"
+
+
+@functools.lru_cache(maxsize=None)
+def commit_hash():
+    """Short commit hash of the running code, or 'unknown'."""
+    if os.environ.get("IMCTQ_BUILD"):
+        return os.environ["IMCTQ_BUILD"].strip()
+    try:
+        return BUILD_FILE.read_text().strip()
+    except OSError:
+        pass
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BUILD_FILE.parent, capture_output=True, text=True, timeout=5,
+        )
+        return out.stdout.strip() if out.returncode == 0 and out.stdout.strip() else "unknown"
+    except Exception:
+        return "unknown"
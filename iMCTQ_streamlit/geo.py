@@ -0,0 +1,299 @@
+# Czech postal codes (PSČ) -> district, region and coordinates.
+#
+# psc_districts.csv maps PSČ ranges (by their first three digits, i.e. the
+# delivery area) to the district (okres), the region (kraj) and the
+# coordinates of the district seat. `python geo.py --build` compiles it into
+# psc_index.npz: sorted range starts and ends, coordinates and small name
+# tables, a few KB, loaded once per process. Lookups are a binary search
+# (np.searchsorted), for one code or for a whole column at once.
+#
+# Sources: the ranges are a hand-compiled map of delivery areas (the first
+# three digits of a PSČ) to okresy, not checked code by code against the
+# Česká pošta PSČ list; blocks that hold no delivery area (420xx,
+# 442xx-459xx) are left out, so those codes are unknown. The coordinates are the GeoNames position of the
+# district seat (cities1000, CC BY 4.0); Praha-východ/-západ, Brno-venkov and
+# Plzeň-sever/-jih use the city they surround. For one row per PSČ with the
+# coordinates of the place itself, rebuild the table from the GeoNames
+# postal-code dump (https://download.geonames.org/export/zip/CZ.zip):
+#   python geo.py --from-geonames CZ.txt && python geo.py --build
+#
+# The longitude feeds the sun-time correction of the chronotype. MSFsc is in
+# Czech clock time, UTC+1 (CET) or, in summer, UTC+2 (CEST), and local solar
+# time is UTC + lon / 15 hours, so
+#   MSFsc_sun = MSFsc - utc_offset + lon / 15
+# with the offset of the response date (Europe/Prague), i.e. MSFsc + (lon - 15) / 15
+# in winter and one hour less in summer.
+#
+#   python geo.py --build                    # psc_districts.csv -> psc_index.npz
+#   python geo.py --from-geonames CZ.txt     # GeoNames postal codes -> psc_districts.csv
+#   python geo.py 14800 "700 30"             # look codes up
+#   python geo.py --regions                  # respondents per region from the sync.py snapshot
+#   import geo; geo.lookup("148 00")         # {'district': 'Hlavní město Praha', 'region': ..., 'lat': ..., 'lon': ...}
+#   geo.add_region_columns(df)               # vectorized: district/region/lat/lon/MSFsc_sun columns
+import argparse
+import csv
+import datetime
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+
+HERE = Path(__file__).resolve().parent
+SOURCE_CSV = HERE / "psc_districts.csv"
+INDEX_PATH = HERE / "psc_index.npz"
+
+# Czech clock time (CET/CEST, by date)
+TIMEZONE = "Europe/Prague"
+
+# Fields added to a stored record
+RECORD_FIELDS = ['district', 'region', 'lon', 'MSFsc_sun']
+
+
+def parse_psc(value):
+    """'148 00', 14800 or '14800' -> 14800; None if it is not a five-digit PSČ."""
+    text = str(value if value is not None else '').replace(' ', '').strip()
+    if text.endswith('.0'):
+        # Sheets returns numeric cells as 14800.0
+        text = text[:-2]
+    return int(text) if len(text) == 5 and text.isdigit() else None
+
+
+def parse_many(values):
+    """Vectorized parse_psc: int64 array, -1 where the value is not a PSČ."""
+    import pandas as pd
+
+    text = pd.Series(values, dtype=object).astype(str).str.replace(r'\s+|\.0$', '', regex=True)
+    valid = text.str.fullmatch(r'\d{5}')
+    return pd.to_numeric(text.where(valid), errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+
+
+def utc_offset(when=None):
+    """UTC offset in hours of Czech clock time on a date (default today): 1 (CET) or 2 (CEST)."""
+    from zoneinfo import ZoneInfo
+
+    day = when.date() if isinstance(when, datetime.datetime) else when or datetime.date.today()
+    noon = datetime.datetime.combine(day, datetime.time(12), ZoneInfo(TIMEZONE))
+    return noon.utcoffset().total_seconds() / 3600
+
+
+def utc_offsets(record_ids):
+    """Vectorized utc_offset of the response dates in record IDs ('2025-10-24_...'); NaN where there is no date."""
+    import pandas as pd
+
+    days = pd.to_datetime(pd.Series(record_ids, dtype=object).astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    offsets = {day: utc_offset(day.date()) for day in days.dropna().unique()}
+    return days.map(offsets).to_numpy(dtype=float)
+
+
+def sun_time(msf, lon, offset=1.0):
+    """
+    Clock-time mid-sleep (hours) -> local solar time, for clock time at UTC+`offset`
+    (see utc_offset); works element-wise on arrays.
+    """
+    return msf - offset + lon / 15.0
+
+
+class PscIndex:
+    """
+    Sorted, non-overlapping PSČ ranges [starts[i], ends[i]] with the district
+    and region of each (codes into the `districts` / `regions` name tables)
+    and the coordinates of the district seat.
+    """
+
+    def __init__(self, starts, ends, district, region, lat, lon, districts, regions):
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.ends = np.asarray(ends, dtype=np.int32)
+        self.district = np.asarray(district, dtype=np.int16)
+        self.region = np.asarray(region, dtype=np.int8)
+        self.lat = np.asarray(lat, dtype=np.float32)
+        self.lon = np.asarray(lon, dtype=np.float32)
+        self.districts = np.asarray(districts, dtype=str)
+        self.regions = np.asarray(regions, dtype=str)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_csv(cls, path=SOURCE_CSV):
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = sorted(csv.DictReader(f), key=lambda r: int(r['psc_from']))
+        districts = sorted({r['district'] for r in rows})
+        regions = sorted({r['region'] for r in rows})
+        starts = [int(r['psc_from']) for r in rows]
+        ends = [int(r['psc_to']) for r in rows]
+        if any(s <= e_prev for s, e_prev in zip(starts[1:], ends)) or any(s > e for s, e in zip(starts, ends)):
+            raise ValueError(f"{path}: PSČ ranges must be non-empty and must not overlap.")
+        return cls(
+            starts, ends,
+            [districts.index(r['district']) for r in rows], [regions.index(r['region']) for r in rows],
+            [float(r['lat']) for r in rows], [float(r['lon']) for r in rows],
+            districts, regions,
+        )
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(**{k: data[k] for k in data.files})
+
+    def save(self, path=INDEX_PATH):
+        np.savez_compressed(
+            path, starts=self.starts, ends=self.ends, district=self.district, region=self.region,
+            lat=self.lat, lon=self.lon, districts=self.districts, regions=self.regions,
+        )
+
+    def positions(self, codes):
+        """Range index of each PSČ (int array), -1 where the code is in no range."""
+        codes = np.asarray(codes, dtype=np.int64)
+        pos = np.searchsorted(self.starts, codes, side='right') - 1
+        hit = (pos >= 0) & (codes <= self.ends[np.maximum(pos, 0)])
+        return np.where(hit, pos, -1)
+
+    def lookup(self, psc):
+        """{'district', 'region', 'lat', 'lon'} of one PSČ, or None if it is unknown or malformed."""
+        code = parse_psc(psc)
+        if code is None:
+            return None
+        pos = int(self.positions([code])[0])
+        if pos < 0:
+            return None
+        return {
+            'district': str(self.districts[self.district[pos]]),
+            'region': str(self.regions[self.region[pos]]),
+            'lat': round(float(self.lat[pos]), 4),
+            'lon': round(float(self.lon[pos]), 4),
+        }
+
+    def lookup_many(self, values):
+        """DataFrame (district, region, lat, lon) aligned with `values`; None/NaN where unknown."""
+        import pandas as pd
+
+        pos = self.positions(parse_many(values))
+        known = pos >= 0
+        p = np.maximum(pos, 0)
+        return pd.DataFrame({
+            'district': np.where(known, self.districts[self.district[p]], None),
+            'region': np.where(known, self.regions[self.region[p]], None),
+            'lat': np.where(known, self.lat[p], np.nan),
+            'lon': np.where(known, self.lon[p], np.nan),
+        })
+
+
+def from_geonames(path, out=SOURCE_CSV):
+    """
+    Rewrites psc_districts.csv from a GeoNames postal-code dump (CZ.txt,
+    tab-separated): one range per PSČ, at the mean position of its places.
+    Returns the number of codes written.
+    """
+    import pandas as pd
+
+    columns = ['country', 'psc', 'place', 'region', 'region_code', 'district', 'district_code',
+               'name3', 'code3', 'lat', 'lon', 'accuracy']
+    df = pd.read_csv(path, sep='\t', header=None, names=columns, dtype=str, keep_default_na=False)
+    df['code'] = parse_many(df['psc'])
+    df = df[(df['country'] == 'CZ') & (df['code'] >= 0)]
+    df['lat'] = pd.to_numeric(df['lat'], errors='coerce')
+    df['lon'] = pd.to_numeric(df['lon'], errors='coerce')
+    # GeoNames names the regions "Jihomoravský kraj"; the table uses "Jihomoravský"
+    df['region'] = df['region'].str.replace(r'\s+kraj$', '', regex=True)
+    table = df.groupby('code').agg(district=('district', 'first'), region=('region', 'first'),
+                                   lat=('lat', 'mean'), lon=('lon', 'mean')).reset_index()
+    table.insert(1, 'psc_to', table['code'])
+    table = table.rename(columns={'code': 'psc_from'}).round({'lat': 4, 'lon': 4})
+    table.to_csv(out, index=False, encoding='utf-8', lineterminator='\r\n')
+    return len(table)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """The process-wide index (psc_index.npz, or the CSV if the index has not been built)."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = PscIndex.load() if INDEX_PATH.exists() else PscIndex.from_csv()
+        return _index
+
+
+def lookup(psc):
+    return get_index().lookup(psc)
+
+
+def record_fields(postal, msfsc, when=None):
+    """The RECORD_FIELDS of a response given on `when` (default today); 'N/A' where the PSČ or MSFsc is unknown."""
+    place = lookup(postal)
+    if place is None:
+        return {'district': 'N/A', 'region': 'N/A', 'lon': 'N/A', 'MSFsc_sun': 'N/A'}
+    msf_sun = sun_time(msfsc, place['lon'], utc_offset(when)) if isinstance(msfsc, (int, float)) else float('nan')
+    return {
+        'district': place['district'],
+        'region': place['region'],
+        'lon': place['lon'],
+        'MSFsc_sun': round(msf_sun, 3) if not np.isnan(msf_sun) else 'N/A',
+    }
+
+
+def add_region_columns(df, postal='postal', msfsc='MSFsc', record_id='ID'):
+    """
+    `df` with district/region/lat/lon (from its PSČ column) and MSFsc_sun
+    added, in one vectorized pass. The clock-time offset comes from the date
+    in the `record_id` column (today's without that column).
+    """
+    import pandas as pd
+
+    places = get_index().lookup_many(df[postal].to_numpy(dtype=object))
+    out = df.drop(columns=[c for c in places.columns if c in df.columns]).reset_index(drop=True)
+    out = pd.concat([out, places], axis=1)
+    if msfsc in out.columns:
+        offset = utc_offsets(out[record_id].to_numpy(dtype=object)) if record_id in out.columns else utc_offset()
+        out['MSFsc_sun'] = sun_time(pd.to_numeric(out[msfsc], errors='coerce').to_numpy(dtype=float),
+                                    out['lon'].to_numpy(dtype=float), offset)
+    return out
+
+
+def region_summary(df):
+    """Respondents, mean longitude and median MSFsc / MSFsc_sun per region."""
+    import pandas as pd
+
+    df = add_region_columns(df)
+    df['MSFsc'] = pd.to_numeric(df['MSFsc'], errors='coerce')
+    df['region'] = df['region'].fillna('neznámý')
+    return df.groupby('region').agg(
+        respondents=('region', 'size'), lon=('lon', 'mean'),
+        MSFsc=('MSFsc', 'median'), MSFsc_sun=('MSFsc_sun', 'median'),
+    ).sort_values('respondents', ascending=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Czech postal code (PSČ) index.")
+    parser.add_argument('codes', nargs='*', help="PSČ to look up")
+    parser.add_argument('--build', action='store_true', help=f"Compile {SOURCE_CSV.name} into {INDEX_PATH.name}")
+    parser.add_argument('--from-geonames', metavar='CZ.txt',
+                        help=f"Regenerate {SOURCE_CSV.name} from the GeoNames postal-code dump")
+    parser.add_argument('--regions', nargs='?', const='', metavar='SNAPSHOT',
+                        help="Per-region summary of a sync.py snapshot (default directory if omitted)")
+    args = parser.parse_args(argv)
+
+    if args.from_geonames:
+        n = from_geonames(args.from_geonames)
+        print(f"{n} postal codes -> {SOURCE_CSV}", file=sys.stderr)
+    if args.build:
+        index = PscIndex.from_csv()
+        index.save()
+        print(f"{len(index)} ranges, {len(index.districts)} districts -> {INDEX_PATH}", file=sys.stderr)
+    for code in args.codes:
+        print(code, lookup(code))
+    if args.regions is not None:
+        import sync
+
+        table = sync.read_snapshot(args.regions or None, columns=['ID', 'postal', 'MSFsc'])
+        if table is None:
+            parser.error("the snapshot is empty; run sync.py first")
+        print(region_summary(table.to_pandas()).round(3).to_string())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
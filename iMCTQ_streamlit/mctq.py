@@ -0,0 +1,201 @@
+# MCTQ scoring engine (no Streamlit dependency).
+#
+# All times are minutes since midnight. `score_batch` works on NumPy arrays
+# (one element per respondent) in a single vectorized pass; `score` is the
+# scalar wrapper used by the Streamlit form.
+#
+# The arithmetic mirrors the original datetime-based calculation in app.py:
+#   SO = SPrep + SLat, SD = SE - SO (+1 day when sleep crosses midnight),
+#   MS = SO + SD/2 (clock time, whole minutes), SDweek = (SDw*WD + SDf*FD)/7,
+#   MSFsc = MSF - (SDf - SDweek)/2 when SDf > SDw, SJL = |MSF - MSW|.
+# `what_if` scores one respondent's schedule over a grid of shifted wake and
+# bed times, again as a single batch.
+import datetime
+
+import numpy as np
+
+MINUTES_PER_DAY = 24 * 60
+
+# Plausible sleep duration (hours); anything outside is treated as a typo
+SD_MIN, SD_MAX = 4, 14
+
+# Class upper bounds (inclusive) for MSFsc, in hours:
+# extreme lark, lark, slight lark, intermediate, slight owl, owl, (extreme owl above)
+MSFSC_THRESHOLDS = (1.50584, 1.935, 2.3984, 3.5817, 4.145, 4.66584)
+# Subjective chronotype from the most-active midpoint: lark, intermediate, (owl above)
+BAMID_THRESHOLDS = (10.72, 13.204)
+# Social jetlag: below the first is aligned, up to (and including) the second is usual, above is large
+SJL_THRESHOLDS = (0.65, 1.67)
+# Recalibrated tables (thresholds.py) are passed as {'MSFsc': (...), 'Bamid': (...), 'SJL': (...)}
+
+
+class SleepDurationError(ValueError):
+    """Raised by `score` when the computed sleep duration is outside SD_MIN..SD_MAX hours."""
+
+    def __init__(self, day, hours):
+        self.day = day  # 'w' (working days) or 'f' (free days)
+        self.hours = hours
+        super().__init__(f"Implausible sleep duration on {'working' if day == 'w' else 'free'} days: {hours:.2f} h")
+
+
+# --- Conversions ---
+
+def to_minutes(t):
+    """datetime.time -> minutes since midnight (float); None -> NaN."""
+    if t is None:
+        return np.nan
+    return t.hour * 60 + t.minute + t.second / 60
+
+
+def parse_hm(values):
+    """
+    Vectorized parse of stored 'HH-MM' (or 'HH:MM') strings into minutes since midnight.
+    Anything else ('', None, 'N/A', ...) becomes NaN.
+    """
+    a = np.asarray(values, dtype=object).astype(str).astype("U5")
+    # Reinterpret the fixed-width strings as code points: one row of 5 chars per value
+    codes = a.view(np.uint32).reshape(-1, 5).astype(np.int64) - ord("0")
+    digits = (codes >= 0) & (codes <= 9)
+    sep = (codes[:, 2] == ord("-") - ord("0")) | (codes[:, 2] == ord(":") - ord("0"))
+    ok = digits[:, [0, 1, 3, 4]].all(axis=1) & sep
+    minutes = (codes[:, 0] * 10 + codes[:, 1]) * 60 + codes[:, 3] * 10 + codes[:, 4]
+    return np.where(ok, minutes, np.nan).reshape(np.shape(values))
+
+
+def _clock_hours(minutes):
+    # Clock time of an absolute minute count, truncated to whole minutes (like dt.hour + dt.minute/60)
+    return np.floor(np.mod(minutes, MINUTES_PER_DAY)) / 60
+
+
+def _sleep(sprep, slat, se):
+    """Sleep onset (absolute minutes), duration (minutes) and mid-sleep (clock hours)."""
+    so = sprep + slat
+    sd = np.mod(se - so, MINUTES_PER_DAY)
+    # Waking at or before onset means the sleep crossed midnight
+    sd = np.where(sd == 0, MINUTES_PER_DAY, sd)
+    return so, sd, _clock_hours(so + sd / 2)
+
+
+# --- Classification ---
+
+def classify_msfsc(msfsc, thresholds=MSFSC_THRESHOLDS):
+    """0 (extreme lark) .. 6 (extreme owl); -1 where MSFsc is NaN."""
+    msfsc = np.asarray(msfsc, dtype=float)
+    return np.where(np.isnan(msfsc), -1, np.searchsorted(thresholds, msfsc, side="left"))
+
+
+def classify_bamid(bamid, thresholds=BAMID_THRESHOLDS):
+    """0 (lark), 1 (intermediate), 2 (owl); -1 where Bamid is NaN."""
+    bamid = np.asarray(bamid, dtype=float)
+    return np.where(np.isnan(bamid), -1, np.searchsorted(thresholds, bamid, side="left"))
+
+
+def classify_sjl(sjl, thresholds=SJL_THRESHOLDS):
+    """0 (aligned, < 0.65 h), 1 (usual, <= 1.67 h), 2 (large); -1 where SJL is NaN."""
+    sjl = np.asarray(sjl, dtype=float)
+    # The lower bound is exclusive and the upper inclusive, hence the two sides
+    cls = (np.searchsorted(thresholds[:1], sjl, side="right")
+           + np.searchsorted(thresholds[1:], sjl, side="left"))
+    return np.where(np.isnan(sjl), -1, cls)
+
+
+# --- Scoring ---
+
+def score_batch(WD, SPrepw, SLatw, SEw, SPrepf, SLatf, SEf,
+                Alarmf, BAlarmf, BAlarmw, Bastart, Baend, Baend_past_midnight, thresholds=None):
+    """
+    Scores N respondents at once. Times are minutes since midnight (NaN where
+    the form block was skipped), SLat in minutes, flags 0/1. Returns a dict of
+    arrays: SDw, SDf, SDweek (hours), MSW, MSF, MSFsc, SJL, Bamid (clock hours),
+    the masks `irregular` (WD == 8), `SDw_ok`, `SDf_ok`, `valid`, and the class
+    indices `chronotype`, `bamid_class`, `sjl_class` (by `thresholds`, the
+    cut-offs above where not given).
+    MSFsc, SJL and SDweek are NaN for rows that are not `valid`.
+    """
+    cut = thresholds or {}
+    WD = np.asarray(WD, dtype=float)
+    FD = 7 - WD
+    irregular = WD > 7
+    has_w = (WD > 0) & ~irregular
+    has_f = (FD > 0) & ~irregular
+
+    with np.errstate(invalid="ignore"):
+        _, sdw, msw = _sleep(np.asarray(SPrepw, dtype=float), np.asarray(SLatw, dtype=float), np.asarray(SEw, dtype=float))
+        _, sdf, msf = _sleep(np.asarray(SPrepf, dtype=float), np.asarray(SLatf, dtype=float), np.asarray(SEf, dtype=float))
+        SDw = np.where(has_w, sdw / 60, 0.0)
+        SDf = np.where(has_f, sdf / 60, 0.0)
+        MSW = np.where(has_w, msw, np.nan)
+        MSF = np.where(has_f, msf, np.nan)
+
+        SDw_ok = ~has_w | ((SDw >= SD_MIN) & (SDw <= SD_MAX))
+        SDf_ok = ~has_f | ((SDf >= SD_MIN) & (SDf <= SD_MAX))
+        valid = SDw_ok & SDf_ok & ~irregular
+
+        SDweek = np.round((SDw * WD + SDf * FD) / 7, 3)
+
+        # Chronotype only when free days are alarm-free, or the alarm on free days
+        # is not needed (BAlarmf == 0) and the respondent wakes before the workday alarm
+        Alarmf, BAlarmf, BAlarmw = (np.asarray(a) for a in (Alarmf, BAlarmf, BAlarmw))
+        eligible = has_f & ((Alarmf == 0) | ((Alarmf == 1) & (BAlarmf == 0) & (BAlarmw == 1)))
+        MSFsc = np.where(SDf <= SDw, MSF, MSF - (SDf - SDweek) / 2)
+        MSFsc = np.where(eligible & valid, MSFsc, np.nan)
+
+        SJL = np.where(has_w & has_f & valid, np.abs(MSF - MSW), np.nan)
+        SDweek = np.where(valid, SDweek, np.nan)
+
+        Bastart = np.asarray(Bastart, dtype=float)
+        Baend = np.asarray(Baend, dtype=float) + MINUTES_PER_DAY * np.asarray(Baend_past_midnight, dtype=float)
+        Bamid = _clock_hours(Bastart + (Baend - Bastart) / 2)
+
+    return {
+        'SDw': SDw, 'SDf': SDf, 'SDweek': SDweek,
+        'MSW': MSW, 'MSF': MSF, 'MSFsc': MSFsc, 'SJL': SJL, 'Bamid': Bamid,
+        'irregular': irregular, 'SDw_ok': SDw_ok, 'SDf_ok': SDf_ok, 'valid': valid,
+        'chronotype': classify_msfsc(MSFsc, cut.get('MSFsc', MSFSC_THRESHOLDS)),
+        'bamid_class': classify_bamid(Bamid, cut.get('Bamid', BAMID_THRESHOLDS)),
+        'sjl_class': classify_sjl(SJL, cut.get('SJL', SJL_THRESHOLDS)),
+    }
+
+
+def score(WD, SPrepw, SLatw, SEw, SPrepf, SLatf, SEf,
+          Alarmf, BAlarmf, BAlarmw, Bastart, Baend, Baend_past_midnight, thresholds=None):
+    """
+    Scores one respondent from form values (datetime.time or None, minutes, 0/1 flags).
+    Returns a dict of Python scalars with the same keys as `score_batch`.
+    Raises ValueError for WD == 8 and SleepDurationError for implausible durations.
+    """
+    if WD > 7:
+        raise ValueError("Chronotype cannot be determined for a fully irregular schedule (WD == 8).")
+
+    def m(t):
+        return to_minutes(t) if isinstance(t, datetime.time) or t is None else t
+
+    res = score_batch(
+        [WD], [m(SPrepw)], [SLatw], [m(SEw)], [m(SPrepf)], [SLatf], [m(SEf)],
+        [Alarmf], [BAlarmf], [BAlarmw], [m(Bastart)], [m(Baend)], [Baend_past_midnight], thresholds,
+    )
+    res = {k: v[0].item() for k, v in res.items()}
+    if not res['SDw_ok']:
+        raise SleepDurationError('w', res['SDw'])
+    if not res['SDf_ok']:
+        raise SleepDurationError('f', res['SDf'])
+    return res
+
+
+# --- What-if grid ---
+
+def what_if(inputs, wake_shifts, bed_shifts):
+    """
+    Re-scores one respondent with the workday wake time (SEw) moved by each
+    of `wake_shifts` and the free-day bedtime (SPrepf) by each of `bed_shifts`
+    (minutes, later = positive), all other answers unchanged, in one
+    score_batch call. `inputs` holds the score_batch arguments of the
+    respondent (times in minutes). Returns 2-D arrays (wake x bed) of MSFsc,
+    SDweek and SJL; NaN where a shifted schedule is not scorable.
+    """
+    dw, df = np.meshgrid(np.asarray(wake_shifts, dtype=float), np.asarray(bed_shifts, dtype=float), indexing="ij")
+    args = dict(inputs)
+    args['SEw'] = np.mod(args['SEw'] + dw.ravel(), MINUTES_PER_DAY)
+    args['SPrepf'] = np.mod(args['SPrepf'] + df.ravel(), MINUTES_PER_DAY)
+    res = score_batch(**args)
+    return {k: np.broadcast_to(res[k], dw.size).reshape(dw.shape) for k in ('MSFsc', 'SDweek', 'SJL')}
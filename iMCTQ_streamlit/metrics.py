@@ -0,0 +1,296 @@
+# Process-wide metrics and structured logs for the submit/save path.
+#
+# Counters, gauges and histograms live in one registry and are exported in
+# the Prometheus text format, either on a local HTTP endpoint or as a file
+# (for node_exporter's textfile collector):
+#   IMCTQ_METRICS_PORT=9464        -> http://localhost:9464/metrics
+#   IMCTQ_METRICS_FILE=metrics.prom -> rewritten every few seconds
+# (or metrics_port / metrics_file in st.secrets). Log records of the
+# "imctq.*" loggers are written as one JSON object per line.
+# Standard library only, so importing it costs nothing noticeable.
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger("imctq.metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_one(key, value))
+        return lines
+
+    def _render_one(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {value}"]
+
+    def snapshot(self):
+        with self._lock:
+            return {",".join(k) or "": v for k, v in self._values.items()}
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the `with` block (also when it raises)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _render_one(self, key, state):
+        lines = []
+        for bound, n in zip(self.buckets, state["buckets"]):
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {n}")
+        lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {state['count']}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {state['sum']}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return {",".join(k) or "": {"count": v["count"], "sum": v["sum"]} for k, v in self._values.items()}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def add_collector(self, fn, key=None):
+        """`fn()` is called before every export, e.g. to refresh gauges; a new `key` replaces the old one."""
+        self._collectors[key if key is not None else id(fn)] = fn
+
+    def collect(self):
+        for fn in list(self._collectors.values()):
+            try:
+                fn()
+            except Exception:
+                log.exception("metrics collector failed")
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        self.collect()
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """All metrics as a plain dict (for JSON logs / debugging)."""
+        self.collect()
+        return {name: m.snapshot() for name, m in self._metrics.items()}
+
+
+REGISTRY = Registry()
+
+# --- Metrics of the submit/save path ---
+
+PHASE_SECONDS = Histogram(
+    "imctq_phase_seconds", "Duration of one phase of the submit/save path.", ["phase"])
+SUBMITS = Counter(
+    "imctq_submits_total", "Form submissions by outcome (scored, invalid, error).", ["outcome"])
+SAVES = Counter(
+    "imctq_saves_total", "Records written to a storage sink, by outcome (success, failure).", ["sink", "outcome"])
+SAVE_RETRIES = Counter(
+    "imctq_save_retries_total", "Records written again after a failed attempt.", ["sink"])
+QUOTA_ERRORS = Counter(
+    "imctq_quota_errors_total", "Storage writes rejected for quota / rate limits (HTTP 429).", ["sink"])
+SUBMIT_TO_SAVED = Histogram(
+    "imctq_submit_to_saved_seconds", "Time from submit (spooled) until stored in the sink.", ["sink"])
+SPOOL_PENDING = Gauge(
+    "imctq_spool_pending", "Records waiting in a sink's spool.", ["sink"])
+BREAKER_STATE = Gauge(
+    "imctq_breaker_state", "Circuit breaker of a sink: 0 closed, 1 half-open, 2 open.", ["sink"])
+BREAKER_OPENS = Counter(
+    "imctq_breaker_opens_total", "Times a sink's circuit breaker opened.", ["sink"])
+LIMITER_TOKENS = Gauge(
+    "imctq_limiter_tokens", "Write requests a sink's token bucket would admit right now.", ["sink"])
+WRITES_DEFERRED = Counter(
+    "imctq_writes_deferred_total", "Records kept in the spool by admission control (breaker, rate_limit).",
+    ["sink", "reason"])
+
+
+def is_quota_error(error):
+    """True for gspread APIError 429 (and anything else carrying code 429)."""
+    return getattr(error, "code", None) == 429
+
+
+# --- Export ---
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Serves /metrics on a daemon thread; returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, name="imctq-metrics-http", daemon=True).start()
+    return server
+
+
+def start_file_writer(path, interval=15.0, registry=REGISTRY):
+    """Rewrites `path` with the current metrics every `interval` seconds (atomic replace)."""
+    def run():
+        while True:
+            try:
+                tmp = f"{path}.tmp"
+                with open(tmp, "w") as f:
+                    f.write(registry.render())
+                os.replace(tmp, path)
+            except Exception:
+                log.exception("writing metrics file failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="imctq-metrics-file", daemon=True)
+    thread.start()
+    return thread
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra={...}` fields are included."""
+
+    _skip = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        out = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        out.update({k: v for k, v in vars(record).items() if k not in self._skip})
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+def configure_json_logging(level=logging.INFO, stream=None):
+    """Sends the "imctq.*" loggers to `stream` (stderr) as JSON lines."""
+    logger = logging.getLogger("imctq")
+    if not any(isinstance(h.formatter, JsonFormatter) for h in logger.handlers):
+        handler = logging.StreamHandler(stream or sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def start_exporters(port=None, path=None):
+    """
+    Starts JSON logging plus the configured exporters (arguments override the
+    environment). Safe to call again, e.g. after st.cache_resource.clear():
+    exporters that are already running are reused.
+    """
+    configure_json_logging()
+    port = port or os.environ.get("IMCTQ_METRICS_PORT")
+    path = path or os.environ.get("IMCTQ_METRICS_FILE")
+    with _exporters_lock:
+        if port and "http" not in _exporters:
+            _exporters["http"] = start_http_server(port)
+            log.info("metrics endpoint started", extra={"port": int(port)})
+        if path and "file" not in _exporters:
+            _exporters["file"] = start_file_writer(path)
+            log.info("metrics file writer started", extra={"path": str(path)})
+        return dict(_exporters)
@@ -0,0 +1,174 @@
+# Opt-in profiling of app reruns (for admins, off by default).
+#
+# With a [profiling] section in st.secrets, a rerun of app.py (widgets,
+# scoring, the Sheets/spool calls made from the script thread) runs under
+# cProfile when either
+#   enabled = true                  - every rerun of every session, e.g. on staging
+#   token = "..."                   - only sessions opened with ?profile=<token>
+# Each profiled rerun is written as a pstats file ("rerun" or "submit" in the
+# name) to `dir` (default data/profiles, newest `keep` files are kept). Its
+# top hot spots are shown in the sidebar, under the build version, only to
+# sessions opened with ?profile=<token>, never to respondents.
+# Without the section nothing is imported or wrapped.
+#
+# cProfile allows one active profiler per process (on Python 3.12+ it
+# registers through the global sys.monitoring), so reruns are profiled one at
+# a time: a rerun that overlaps a profiled one is simply not profiled.
+#
+#   [profiling]
+#   token = "change-me"
+#   dir = "/tmp/imctq-profiles"
+#   keep = 200
+# Inspecting a file:
+#   python -m pstats data/profiles/20251024T125000-submit-1a2b3c.prof
+#   snakeviz data/profiles/20251024T125000-submit-1a2b3c.prof
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import threading
+import time
+import uuid
+from datetime import datetime as dt
+from pathlib import Path
+
+TOP_N = 12
+DEFAULT_KEEP = 200
+# A profile still holding the process-wide slot after this many seconds was
+# left by an interrupted rerun whose session never came back; it is stopped
+STALE_AFTER = 120.0
+
+log = logging.getLogger("imctq.profiling")
+
+# Session state key of the profile still running in this session (interrupted reruns)
+ACTIVE_KEY = "_profiling_active"
+
+
+def authorized(config, query_value):
+    """True if ?profile= equals the configured `token` (the session may see the report)."""
+    token = (config or {}).get("token")
+    return bool(token) and query_value is not None and hmac.compare_digest(str(query_value), str(token))
+
+
+def requested(config, query_value):
+    """True if this rerun should be profiled: `enabled`, or an authorized ?profile=."""
+    if not config:
+        return False
+    return bool(config.get("enabled")) or authorized(config, query_value)
+
+
+def profile_dir(config):
+    import storage
+
+    return Path(config.get("dir") or os.environ.get("IMCTQ_PROFILE_DIR") or storage.DATA_DIR / "profiles")
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == "~":
+        # Built-ins: "<built-in method time.sleep>"
+        return name
+    return f"{Path(filename).name}:{line}({name})"
+
+
+def hot_spots(stats, n=TOP_N):
+    """The `n` functions with the most own time: function, calls, self_ms, total_ms."""
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:n]
+    return [
+        {"function": _label(func), "calls": nc, "self_ms": round(tt * 1000, 2), "total_ms": round(ct * 1000, 2)}
+        for func, (cc, nc, tt, ct, callers) in rows
+    ]
+
+
+# The one profiler slot of the process and the RunProfile holding it
+_slot = threading.Lock()
+_holder = None
+
+
+class RunProfile:
+    """cProfile of one rerun, running on the script thread from `start()` to `finish()`."""
+
+    def __init__(self, config):
+        self.config = config
+        self.profile = cProfile.Profile()
+        self.started = None
+        self._held = False
+        self._state = threading.Lock()
+
+    def start(self):
+        """Takes the process-wide slot and enables the profiler; None if the slot is busy."""
+        global _holder
+        self.started = time.perf_counter()
+        if not _slot.acquire(blocking=False):
+            holder = _holder
+            if holder is None or self.started - holder.started < STALE_AFTER:
+                return None
+            holder.stop()
+            if not _slot.acquire(blocking=False):
+                return None
+        _holder = self
+        self._held = True
+        try:
+            self.profile.enable()
+        except ValueError as e:
+            # Another profiler (not ours) is active in this process
+            log.warning("profiling skipped: %s", e)
+            self.stop()
+            return None
+        return self
+
+    def stop(self):
+        """Disables the profiler and frees the slot (once, from whichever thread gets here first)."""
+        global _holder
+        with self._state:
+            if not self._held:
+                return
+            self._held = False
+            try:
+                self.profile.disable()
+            except ValueError as e:
+                log.warning("profiler could not be disabled: %s", e)
+            if _holder is self:
+                _holder = None
+            _slot.release()
+
+    def finish(self, kind="rerun"):
+        """Stops profiling, writes the pstats file; returns the summary shown in the sidebar."""
+        self.stop()
+        elapsed = time.perf_counter() - self.started
+        stats = pstats.Stats(self.profile)
+        directory = profile_dir(self.config)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{dt.now().strftime('%Y%m%dT%H%M%S')}-{kind}-{uuid.uuid4().hex[:6]}.prof"
+        stats.dump_stats(path)
+        _prune(directory, int(self.config.get("keep", DEFAULT_KEEP)))
+        return {"kind": kind, "ms": round(elapsed * 1000, 1), "path": str(path), "top": hot_spots(stats)}
+
+
+def _prune(directory, keep):
+    files = sorted(directory.glob("*.prof"), key=lambda p: p.stat().st_mtime)
+    for old in files[:-keep] if keep > 0 else []:
+        old.unlink(missing_ok=True)
+
+
+def begin(session_state, config, query_value):
+    """
+    Starts profiling this rerun if requested and no other rerun of the
+    process is being profiled; returns the RunProfile or None. A profile left
+    running by an interrupted rerun (st.rerun, st.stop) is discarded first.
+    """
+    leftover = session_state.pop(ACTIVE_KEY, None)
+    if leftover is not None:
+        leftover.stop()
+    if not requested(config, query_value):
+        return None
+    run = RunProfile(config).start()
+    if run is not None:
+        session_state[ACTIVE_KEY] = run
+    return run
+
+
+def end(session_state, run, kind="rerun"):
+    session_state.pop(ACTIVE_KEY, None)
+    return run.finish(kind)
@@ -0,0 +1,304 @@
+# Batch re-scoring of stored or imported MCTQ responses.
+#
+# Streams a CSV/XLSX file (or the live response sheet, all partitions) in fixed-size chunks,
+# validates each chunk with the same rules as the form, scores it through
+# mctq.score_batch and writes the result out chunk by chunk, so memory use
+# does not grow with the input. Each row records the cut-offs that classified
+# it (thresholds_version), and with a postal column the sun-time chronotype
+# MSFsc_sun is recomputed from the new MSFsc (geo.py, with the clock offset of
+# the response date in the ID). --write-back updates all of these in the
+# sheet, so a rescored row stays consistent with itself.
+#
+# Examples:
+#   python rescore.py responses.csv -o scored.parquet
+#   python rescore.py paper_export.xlsx -o scored.csv --workers 4
+#   python rescore.py --sheet --credentials sa.json --write-back
+import argparse
+import datetime
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import geo
+import mctq
+from thresholds import BUILTIN_VERSION
+
+DEFAULT_CHUNK = 10_000
+
+TIME_COLUMNS = ['SPrepw', 'SEw', 'SPrepf', 'SEf', 'Bastart', 'Baend_time']
+FLAG_COLUMNS = ['Alarmf', 'BAlarmf', 'BAlarmw', 'Baend_past_midnight']
+# Columns written by the re-scoring, in addition to the input columns
+SCORE_COLUMNS = ['MSFsc', 'SJL', 'Bamid', 'SDweek', 'chronotype', 'bamid_class', 'sjl_class',
+                 'thresholds_version', 'error']
+# Written as well when the input has a postal column
+SUN_COLUMN = 'MSFsc_sun'
+# Columns updated in place when writing back to the sheet
+SHEET_COLUMNS = ['MSFsc', 'SJL', 'SDweek', 'Bamid', SUN_COLUMN, 'thresholds_version']
+
+
+# --- Column coercion ---
+
+def _minutes(col):
+    """Time column -> minutes since midnight; accepts 'HH-MM'/'HH:MM' strings and datetime.time."""
+    values = col.to_numpy(dtype=object)
+    is_time = np.fromiter((isinstance(v, datetime.time) for v in values), bool, len(values))
+    out = mctq.parse_hm(np.where(is_time, "", values))
+    if is_time.any():
+        out[is_time] = [mctq.to_minutes(v) for v in values[is_time]]
+    return out
+
+
+def _flags(col):
+    """0/1 column from 0/1, True/False or the 'TRUE'/'FALSE' strings Sheets returns."""
+    s = col.astype(str).str.strip().str.upper()
+    return s.isin(['1', '1.0', 'TRUE']).to_numpy(dtype=np.int8)
+
+
+def _numbers(col):
+    """Numeric column; missing or non-numeric values become NaN (and fail validation)."""
+    return pd.to_numeric(col, errors='coerce').to_numpy(dtype=float)
+
+
+# --- Scoring ---
+
+def score_chunk(df, thresholds=None, version=None):
+    """
+    Validates and scores one chunk; returns the chunk with SCORE_COLUMNS
+    (and SUN_COLUMN, if it has a postal column) added/replaced. Classes use
+    `thresholds` (the cut-offs of threshold table `version`, see
+    thresholds.py) or mctq.py's built-in ones.
+    """
+    if version is None:
+        if thresholds is not None:
+            raise ValueError("score_chunk needs the version of the threshold table it classifies with.")
+        version = BUILTIN_VERSION
+    df = df.copy()
+    for name in TIME_COLUMNS + FLAG_COLUMNS + ['WD', 'SLatwi', 'SLatfi']:
+        if name not in df.columns:
+            df[name] = None
+
+    WD = pd.to_numeric(df['WD'], errors='coerce').to_numpy(dtype=float)
+    times = {name: _minutes(df[name]) for name in TIME_COLUMNS}
+    SLatw, SLatf = _numbers(df['SLatwi']), _numbers(df['SLatfi'])
+
+    res = mctq.score_batch(
+        np.nan_to_num(WD, nan=8), times['SPrepw'], SLatw, times['SEw'], times['SPrepf'], SLatf, times['SEf'],
+        _flags(df['Alarmf']), _flags(df['BAlarmf']), _flags(df['BAlarmw']),
+        times['Bastart'], times['Baend_time'], _flags(df['Baend_past_midnight']), thresholds,
+    )
+
+    # Same rules as the form: 0 <= WD <= 8, non-negative latencies, times and
+    # latencies present for the blocks that apply, plausible sleep durations
+    errors = np.full(len(df), '', dtype=object)
+    has_w = (WD > 0) & (WD < 8)
+    has_f = (WD >= 0) & (WD < 7)
+    checks = [
+        (np.isnan(WD) | (WD < 0) | (WD > 8) | (WD != np.round(WD)), 'WD'),
+        (res['irregular'], 'irregular'),
+        ((SLatw < 0) | (SLatf < 0), 'SLat'),
+        (has_w & (np.isnan(times['SPrepw']) | np.isnan(times['SEw'])), 'missing_w'),
+        (has_f & (np.isnan(times['SPrepf']) | np.isnan(times['SEf'])), 'missing_f'),
+        ((has_w & np.isnan(SLatw)) | (has_f & np.isnan(SLatf)), 'missing_slat'),
+        (~res['SDw_ok'], 'SDw'),
+        (~res['SDf_ok'], 'SDf'),
+    ]
+    for mask, label in checks:
+        errors = np.where(mask, np.where(errors == '', label, errors + ';' + label), errors)
+    bad = errors != ''
+
+    for name in ['MSFsc', 'SJL', 'Bamid', 'SDweek']:
+        df[name] = np.where(bad, np.nan, np.round(res[name], 3))
+    for name in ['chronotype', 'bamid_class', 'sjl_class']:
+        df[name] = np.where(bad, -1, res[name]).astype(np.int8)
+    df['thresholds_version'] = version
+    df['error'] = errors
+    if 'postal' in df.columns:
+        sun = geo.add_region_columns(df[[c for c in ('ID', 'postal', 'MSFsc') if c in df.columns]])
+        df[SUN_COLUMN] = np.round(sun['MSFsc_sun'].to_numpy(dtype=float), 3)
+    return df
+
+
+# --- Readers ---
+
+def read_chunks(path, chunk_size):
+    """Yields DataFrame chunks of a CSV or XLSX file."""
+    path = Path(path)
+    if path.suffix.lower() in ('.xlsx', '.xlsm'):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(path, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h) for h in next(rows)]
+        buf = []
+        for row in rows:
+            buf.append(row)
+            if len(buf) == chunk_size:
+                yield pd.DataFrame(buf, columns=header)
+                buf = []
+        if buf:
+            yield pd.DataFrame(buf, columns=header)
+        wb.close()
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+
+
+def read_sheet_chunks(connection, chunk_size):
+    """
+    Yields ((worksheet connection, first_row), DataFrame) chunks of every
+    partition of the live sheet, oldest first, using bounded range reads.
+    """
+    for title in connection.partition_titles():
+        sheet = connection.for_worksheet(title)
+        header = list(sheet.header)
+        last_col = _column_letter(len(header))
+        start = 2
+        while True:
+            end = start + chunk_size - 1
+            values = sheet.worksheet.get(f"A{start}:{last_col}{end}")
+            if not values:
+                break
+            rows = [list(r) + [''] * (len(header) - len(r)) for r in values]
+            yield (sheet, start), pd.DataFrame(rows, columns=header)
+            if len(values) < chunk_size:
+                break
+            start = end + 1
+
+
+def _column_letter(n):
+    """1-based column index -> A1 letters."""
+    letters = ''
+    while n:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+# --- Writers ---
+
+class ChunkWriter:
+    """Appends scored chunks to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.parquet = self.path.suffix.lower() == '.parquet'
+        self._writer = None
+        self._first = True
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # Inputs are read as text; keep a stable schema across chunks
+            df = df.assign(**{c: df[c].fillna('').astype(str) for c in df.columns
+                              if c not in SCORE_COLUMNS and c != SUN_COLUMN})
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            df.to_csv(self.path, mode='w' if self._first else 'a', header=self._first, index=False)
+        self._first = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def write_back(connection, first_row, df):
+    """Updates the score columns of one chunk in a worksheet with a single batch_update."""
+    index = connection.header_index
+    updates = []
+    last_row = first_row + len(df) - 1
+    for name in SHEET_COLUMNS:
+        if name not in index or name not in df.columns:
+            continue
+        col = _column_letter(index[name] + 1)
+        # Same convention as the form: 'N/A' when the value cannot be determined
+        values = [['N/A' if pd.isna(v) else v if isinstance(v, str) else float(v)] for v in df[name]]
+        updates.append({'range': f"{col}{first_row}:{col}{last_row}", 'values': values})
+    if updates:
+        connection.worksheet.batch_update(updates, value_input_option='USER_ENTERED')
+
+
+# --- Driver ---
+
+def _scored(chunks, workers, thresholds=None, version=None):
+    """Scores chunks in order, optionally in a process pool with a bounded number in flight."""
+    if workers <= 1:
+        for key, df in chunks:
+            yield key, score_chunk(df, thresholds, version)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for key, df in chunks:
+            pending.append((key, pool.submit(score_chunk, df, thresholds, version)))
+            if len(pending) >= 2 * workers:
+                key0, fut = pending.popleft()
+                yield key0, fut.result()
+        while pending:
+            key0, fut = pending.popleft()
+            yield key0, fut.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-score MCTQ responses in chunks.")
+    parser.add_argument('input', nargs='?', help="CSV or XLSX file (omit with --sheet)")
+    parser.add_argument('-o', '--output', help="Output .csv or .parquet file")
+    parser.add_argument('--sheet', action='store_true', help="Read the live response sheet instead of a file")
+    parser.add_argument('--credentials', help="Service account JSON file (for --sheet)")
+    parser.add_argument('--write-back', action='store_true',
+                        help="Update the scores, MSFsc_sun and thresholds_version in the sheet (with --sheet)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK)
+    parser.add_argument('--workers', type=int, default=1, help="Score chunks in a process pool")
+    parser.add_argument('--thresholds', help="Threshold table to classify with (thresholds.py; default: built-in cut-offs)")
+    args = parser.parse_args(argv)
+
+    if args.sheet == bool(args.input):
+        parser.error("give either an input file or --sheet")
+    if args.write_back and not args.sheet:
+        parser.error("--write-back needs --sheet")
+    if not (args.output or args.write_back):
+        parser.error("nothing to do: give --output and/or --write-back")
+
+    if args.sheet:
+        import sheets
+
+        if not args.credentials:
+            parser.error("--sheet needs --credentials")
+        connection = sheets.SheetsConnection(Path(args.credentials).read_text())
+        chunks = read_sheet_chunks(connection, args.chunk_size)
+    else:
+        chunks = enumerate(read_chunks(args.input, args.chunk_size))
+
+    cut = version = None
+    if args.thresholds:
+        import thresholds
+
+        table = thresholds.load(args.thresholds)
+        cut, version = table['thresholds'], table['version']
+
+    writer = ChunkWriter(args.output) if args.output else None
+    total = invalid = 0
+    try:
+        for key, df in _scored(chunks, args.workers, cut, version):
+            if writer:
+                writer.write(df)
+            if args.write_back:
+                write_back(*key, df)
+            total += len(df)
+            invalid += int((df['error'] != '').sum())
+            print(f"\r{total} rows scored, {invalid} invalid", end='', file=sys.stderr)
+    finally:
+        if writer:
+            writer.close()
+    print(file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
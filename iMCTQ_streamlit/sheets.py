@@ -0,0 +1,471 @@
+# Shared Google Sheets connection for the iMCTQ app.
+#
+# Streamlit re-runs app.py for every interaction and every session, so the
+# authorized client, the worksheet handles and the header rows are kept here,
+# once per process, instead of being rebuilt on every submit.
+#
+# Responses are partitioned by time into one worksheet per year (default) or
+# per month, named iMCTQ_streamlit_responses_2025, ..._2026 or ..._2026-01, by
+# the submit date in the record ID. The worksheet of a new period is created
+# on its first write, with the header row of the latest existing partition.
+# Readers union the partitions and skip those outside the requested dates:
+#   [sheets]
+#   partition = "year"   # or "month"
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+import gspread
+import requests
+
+from metrics import PHASE_SECONDS
+
+SHEET_ID = "10FfTOk_hLShUk1EEQi9ndBlZcbsME1ORfs7btm6IjDc"
+SHEET_PREFIX = "iMCTQ_streamlit_responses_"
+# The original single worksheet, now simply the 2025 partition
+SHEET_NAME = SHEET_PREFIX + "2025"
+
+PARTITIONS = ("year", "month")
+DEFAULT_PARTITION = "year"
+
+# Re-read the header / re-authorize at least this often (seconds)
+DEFAULT_TTL = 30 * 60
+
+# HTTP codes that mean the cached handles are stale (auth, missing sheet, schema)
+_STALE_CODES = {400, 401, 403, 404}
+
+# Base URL of a local Sheets API stand-in (benchmarks/fake_sheets_server.py);
+# when set, no credentials are needed and nothing goes to Google
+EMULATOR_ENV = "IMCTQ_SHEETS_EMULATOR"
+GOOGLE_API = "https://sheets.googleapis.com"
+
+
+def load_service_account(gcp_sa):
+    """Returns the service account info as a dict (st.secrets may hold a JSON string)."""
+    if gcp_sa is None:
+        raise RuntimeError("st.secrets['gcp_service_account'] not found. See instructions for setting secrets.")
+
+    # gspread.service_account_from_dict expects a dict. If it's a JSON string, parse it.
+    if isinstance(gcp_sa, str):
+        try:
+            gcp_sa = json.loads(gcp_sa)
+        except Exception:
+            raise RuntimeError("gcp_service_account in st.secrets is a string but not valid JSON.")
+    return dict(gcp_sa)
+
+
+# --- Time partitions ---
+
+def period_of(when, partition=DEFAULT_PARTITION):
+    """'2025' (year) or '2025-10' (month) for a date/datetime."""
+    return f"{when.year:04d}" if partition == "year" else f"{when.year:04d}-{when.month:02d}"
+
+
+def record_date(record_id):
+    """Submit date encoded at the start of a record ID ('2025-10-24_12-50-00...'), or None."""
+    try:
+        return datetime.date.fromisoformat(str(record_id)[:10])
+    except ValueError:
+        return None
+
+
+def period_bounds(period):
+    """First day of the period and first day after it."""
+    if len(period) == 4:
+        year = int(period)
+        return datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+    year, month = int(period[:4]), int(period[5:7])
+    return datetime.date(year, month, 1), datetime.date(year + month // 12, month % 12 + 1, 1)
+
+
+def parse_title(title, prefix=SHEET_PREFIX):
+    """Period of a partition worksheet title, or None for any other worksheet."""
+    if title.startswith(prefix) and re.fullmatch(r"\d{4}(-(0[1-9]|1[0-2]))?", title[len(prefix):]):
+        return title[len(prefix):]
+    return None
+
+
+def _overlaps(period, start, end):
+    first, after = period_bounds(period)
+    return (start is None or after > start) and (end is None or first <= end)
+
+
+class _EmulatorSession(requests.Session):
+    """Sends gspread's Sheets API calls to `base_url` instead of Google."""
+
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(GOOGLE_API):
+            url = self.base_url + url[len(GOOGLE_API):]
+        return super().request(method, url, *args, **kwargs)
+
+
+class SheetsConnection:
+    """
+    Process-wide handle to the response worksheets.
+
+    Holds the authorized client, the workbook and, per worksheet, the handle
+    and a precompiled header map. The handles expire after `ttl` seconds and
+    are dropped whenever the API reports an auth or schema problem, so the
+    next call reconnects. Safe to share between concurrent Streamlit sessions.
+
+    With `sheet_name` the connection is pinned to that one worksheet;
+    otherwise records go to the time partition (`partition` = "year" or
+    "month") of their ID, and `header` / `worksheet` refer to the current one.
+
+    `service_account` is the raw st.secrets value; it is parsed on first connect.
+    """
+
+    name = "sheets"
+
+    def __init__(self, service_account, sheet_id=SHEET_ID, sheet_name=None, ttl=DEFAULT_TTL,
+                 partition=DEFAULT_PARTITION, prefix=SHEET_PREFIX):
+        if partition not in PARTITIONS:
+            raise ValueError(f"Unknown sheet partition '{partition}'; use one of {PARTITIONS}.")
+        self.service_account = service_account
+        self.sheet_id = sheet_id
+        self.sheet_name = sheet_name
+        self.partition = partition
+        self.prefix = prefix
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._client_handle = None
+        self._workbook = None
+        self._workbook_expires = 0.0
+        self._sheets = {}  # title -> (worksheet, header, header_index, expires)
+        self._tail_rows = {}  # title -> last row of this process's latest append (from the API reply)
+
+    # --- Partitions ---
+
+    def title_for(self, record_id=None):
+        """Worksheet a record (by its ID; now without one) belongs to."""
+        if self.sheet_name:
+            return self.sheet_name
+        when = record_date(record_id) if record_id else None
+        return self.prefix + period_of(when or datetime.date.today(), self.partition)
+
+    @property
+    def current_title(self):
+        return self.title_for()
+
+    def partition_titles(self, start=None, end=None):
+        """
+        Existing partition worksheets, oldest first, skipping periods entirely
+        before `start` or after `end` (dates, inclusive). A year and a month
+        partition of the same period (after switching to monthly) are both kept.
+        """
+        if self.sheet_name:
+            return [self.sheet_name]
+        with self._lock:
+            workbook = self._get_workbook()
+        try:
+            titles = [ws.title for ws in workbook.worksheets()]
+        except Exception as e:
+            self._handle_error(e)
+            raise
+        periods = [(p, t) for t in titles if (p := parse_title(t, self.prefix)) and _overlaps(p, start, end)]
+        return [t for _, t in sorted(periods)]
+
+    def for_worksheet(self, title):
+        """A connection pinned to one worksheet, sharing this one's client."""
+        other = type(self).__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.sheet_name = title
+        other._lock = threading.Lock()
+        other._sheets = {}
+        return other
+
+    # --- Connection state ---
+
+    def _client(self):
+        """The authorized gspread client (created once, dropped by `invalidate`)."""
+        gc = self._client_handle
+        if gc is None:
+            with PHASE_SECONDS.time(phase="sheets_auth"):
+                emulator = os.environ.get(EMULATOR_ENV)
+                if emulator:
+                    gc = gspread.Client(None, session=_EmulatorSession(emulator))
+                else:
+                    gc = gspread.service_account_from_dict(load_service_account(self.service_account))
+            self._client_handle = gc
+        return gc
+
+    def _open_workbook(self):
+        gc = self._client()
+        with PHASE_SECONDS.time(phase="sheets_open"):
+            return gc.open_by_key(self.sheet_id)
+
+    def _get_workbook(self):
+        # Caller holds self._lock
+        if self._workbook is None or time.monotonic() >= self._workbook_expires:
+            self._workbook = self._open_workbook()
+            self._workbook_expires = time.monotonic() + self.ttl
+        return self._workbook
+
+    def _template_header(self, workbook):
+        """
+        Header for a new partition: that of the latest existing one plus any
+        record fields added since, else the app's record fields.
+        """
+        import storage
+
+        partitions = sorted((p, ws) for ws in workbook.worksheets() if (p := parse_title(ws.title, self.prefix)))
+        if partitions:
+            header = partitions[-1][1].row_values(1)
+            if header:
+                return header + [f for f in storage.RECORD_FIELDS if f not in header]
+        return list(storage.RECORD_FIELDS)
+
+    def _create_worksheet(self, workbook, title):
+        header = self._template_header(workbook)
+        try:
+            with PHASE_SECONDS.time(phase="sheets_create"):
+                worksheet = workbook.add_worksheet(title, rows=1000, cols=len(header))
+                worksheet.append_rows([header], value_input_option="RAW")
+        except gspread.exceptions.APIError:
+            # Another process created it first
+            worksheet = workbook.worksheet(title)
+        return worksheet
+
+    def _connect(self, title, create):
+        workbook = self._get_workbook()
+
+        # Try to get worksheet by name; if missing, create the partition or list available sheets for debugging
+        try:
+            with PHASE_SECONDS.time(phase="sheets_worksheet"):
+                worksheet = workbook.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            if not create:
+                available = [s.title for s in workbook.worksheets()]
+                raise RuntimeError(f"Worksheet named '{title}' not found. Available sheets: {available}")
+            worksheet = self._create_worksheet(workbook, title)
+
+        with PHASE_SECONDS.time(phase="sheets_header"):
+            header = tuple(worksheet.row_values(1))
+        if not header:
+            raise RuntimeError("Header row (row 1) is empty. Please add header names to the first row in the sheet.")
+
+        entry = (worksheet, header, {key: i for i, key in enumerate(header)}, time.monotonic() + self.ttl)
+        self._sheets[title] = entry
+        return entry
+
+    def _entry(self, title=None, create=False):
+        """(worksheet, header, header_index), reconnecting if the cached handles are missing or expired."""
+        title = title or self.current_title
+        with self._lock:
+            entry = self._sheets.get(title)
+            if entry is None or time.monotonic() >= entry[3]:
+                # New periods are created on their first write, not on reads
+                entry = self._connect(title, create and not self.sheet_name)
+            return entry[:3]
+
+    def _ensure(self, title=None, create=False):
+        """Returns (worksheet, header) of a worksheet (the current partition by default)."""
+        return self._entry(title, create)[:2]
+
+    def invalidate(self):
+        """Drops the cached client, workbook, worksheets and headers; the next call reconnects."""
+        with self._lock:
+            self._client_handle = None
+            self._workbook = None
+            self._workbook_expires = 0.0
+            self._sheets = {}
+
+    def _handle_error(self, error):
+        # Quota errors (429) and server hiccups keep the handles; anything that
+        # points at credentials or the sheet layout forces a reconnect.
+        code = getattr(error, "code", None)
+        if not isinstance(error, gspread.exceptions.APIError) or code in _STALE_CODES:
+            self.invalidate()
+
+    # --- Public API ---
+
+    @property
+    def header(self):
+        return self._ensure()[1]
+
+    @property
+    def header_index(self):
+        """Maps header name -> 0-based column index."""
+        return self._entry()[2]
+
+    @property
+    def worksheet(self):
+        return self._ensure()[0]
+
+    def row_for(self, record, header=None):
+        """Maps a record dict into the order of the sheet header."""
+        header = header if header is not None else self.header
+        return [record.get(key, "") for key in header]
+
+    def batch_get(self, ranges, title=None):
+        """
+        Reads several A1 ranges of a worksheet ('1:1', 'A2:K100', ...; the
+        current one by default) in a single API call, without the metadata
+        lookups of opening the sheet. A range may also be a (title, range)
+        pair. Returns one list of rows per range; numbers and booleans come
+        back unformatted (not as locale-formatted text).
+        """
+        title = title or self.current_title
+        absolute = [gspread.utils.absolute_range_name(*(r if isinstance(r, tuple) else (title, r))) for r in ranges]
+        try:
+            with PHASE_SECONDS.time(phase="sheets_batch_get"):
+                response = self._client().http_client.values_batch_get(
+                    self.sheet_id, absolute,
+                    params={"valueRenderOption": "UNFORMATTED_VALUE", "dateTimeRenderOption": "FORMATTED_STRING"},
+                )
+        except Exception as e:
+            self._handle_error(e)
+            raise
+        return [vr.get("values", []) for vr in response.get("valueRanges", [])]
+
+    def last_row(self, title=None, probes=64):
+        """
+        Number of the last filled row of a worksheet (1 = only the header),
+        found by a k-ary search over the ID column: each step reads `probes`
+        single cells in one batchGet, so 500 000 rows take about three calls
+        (plus one metadata call for the grid size). Relies on rows being
+        appended without gaps, as the app and the sinks do.
+        """
+        title = title or self.current_title
+        _, _, index = self._entry(title)
+        column = gspread.utils.rowcol_to_a1(1, index.get("ID", 0) + 1)[:-1]
+        with self._lock:
+            workbook = self._get_workbook()
+        try:
+            with PHASE_SECONDS.time(phase="sheets_worksheet"):
+                grid_rows = workbook.worksheet(title).row_count
+        except Exception as e:
+            self._handle_error(e)
+            raise
+        # Row `low` is filled, rows after `high` are empty
+        low, high = 1, grid_rows
+        while high > low:
+            step = (high - low) / min(probes, high - low)
+            rows = sorted({low + max(1, round(step * (k + 1))) for k in range(min(probes, high - low))} | {high})
+            cells = self.batch_get([f"{column}{r}" for r in rows], title)
+            filled = [r for r, got in zip(rows, cells) if got and got[0] and got[0][0] != ""]
+            if not filled:
+                high = rows[0] - 1
+                continue
+            low = filled[-1]
+            later = [r for r in rows if r > low]
+            high = later[0] - 1 if later else high
+        return low
+
+    def read_records(self, start=None, end=None, chunk_size=5_000):
+        """
+        Yields the stored responses as dicts, across all partitions whose
+        period overlaps `start`..`end` (dates, inclusive; None = open), in
+        bounded range reads. Rows whose ID date is outside the range are skipped.
+        """
+        for title in self.partition_titles(start, end):
+            header = None
+            first = 2
+            while True:
+                ranges = [f"{first}:{first + chunk_size - 1}"]
+                if header is None:
+                    # The header comes with the first chunk, in the same call
+                    ranges.insert(0, "1:1")
+                got = self.batch_get(ranges, title)
+                if header is None:
+                    header = [str(h) for h in (got[0][0] if got[0] else [])]
+                rows = got[-1]
+                for r in rows:
+                    record = dict(zip(header, list(r) + [""] * (len(header) - len(r))))
+                    day = record_date(record.get("ID"))
+                    if day is None or ((start is None or day >= start) and (end is None or day <= end)):
+                        yield record
+                if len(rows) < chunk_size:
+                    break
+                first += chunk_size
+
+    def append(self, record):
+        """Appends one record (dict keyed by header names)."""
+        self.append_many([record])
+
+    def _note_tail(self, title, response):
+        # append reply: {"updates": {"updatedRange": "'Sheet'!A101:AS110", "updatedRows": 10}}
+        updates = (response or {}).get("updates") or {}
+        m = re.search(r"!\$?[A-Za-z]+\$?(\d+)", updates.get("updatedRange", ""))
+        if m and updates.get("updatedRows"):
+            self._tail_rows[title] = int(m.group(1)) + int(updates["updatedRows"]) - 1
+
+    def resume_points(self, ids):
+        """
+        {id: last row of the record's partition as of this process's last
+        acknowledged append}, or None where that is not known (e.g. right
+        after a restart). An append of the records can only land below it.
+        """
+        return {i: self._tail_rows.get(self.title_for(i)) for i in ids}
+
+    def existing_ids(self, ids, since=None):
+        """
+        Returns the subset of `ids` already present in the ID column of their
+        partitions. `since` ({id: row}, from resume_points before the first
+        attempt) limits the read to the rows after the smallest resume point
+        of a partition (one bounded call); the whole column is read when any
+        record of the partition has none.
+        """
+        since = since or {}
+        by_title = {}
+        for i in ids:
+            by_title.setdefault(self.title_for(i), []).append(i)
+        found = set()
+        for title, group in by_title.items():
+            try:
+                worksheet, header, index = self._entry(title)
+            except RuntimeError:
+                continue  # The partition does not exist yet, so none of these were saved
+            if "ID" not in index:
+                continue
+            points = [since.get(i) for i in group]
+            try:
+                with PHASE_SECONDS.time(phase="sheets_existing_ids"):
+                    if all(points):
+                        column = gspread.utils.rowcol_to_a1(1, index["ID"] + 1)[:-1]
+                        saved = [r[0] for r in self.batch_get([f"{column}{min(points) + 1}:{column}"], title)[0] if r]
+                    else:
+                        saved = worksheet.col_values(index["ID"] + 1)
+            except Exception as e:
+                self._handle_error(e)
+                raise
+            found |= set(group) & {str(v) for v in saved}
+        return found
+
+    def request_count(self, ids, check_existing=False):
+        """
+        API requests writing the records `ids` takes, for the write limiter
+        (admission.py): one append per partition, plus one to open (or, at a
+        period boundary, create) a partition not connected yet, plus one
+        `existing_ids` read per partition when `check_existing`.
+        """
+        titles = {self.title_for(i) for i in ids}
+        with self._lock:
+            connected = {t for t in titles if t in self._sheets and time.monotonic() < self._sheets[t][3]}
+        return len(titles) * (2 if check_existing else 1) + len(titles - connected)
+
+    def append_many(self, records):
+        """Appends records with a single API call per partition (normally just one)."""
+        if not records:
+            return
+        by_title = {}
+        for r in records:
+            by_title.setdefault(self.title_for(r.get("ID")), []).append(r)
+        for title, group in by_title.items():
+            worksheet, header = self._ensure(title, create=True)
+            rows = [self.row_for(r, header) for r in group]
+            try:
+                # USER_ENTERED so Google parses numbers/dates
+                with PHASE_SECONDS.time(phase="sheets_append"):
+                    response = worksheet.append_rows(rows, value_input_option='USER_ENTERED')
+            except Exception as e:
+                self._handle_error(e)
+                raise
+            self._note_tail(title, response)
@@ -0,0 +1,449 @@
+# Durable write-behind spool for questionnaire responses.
+#
+# A submit only inserts the record into a local SQLite file (WAL mode) and
+# returns. A background Flusher drains the spool in batches into the sink
+# (Google Sheets) with one append call per batch, retrying with exponential
+# backoff. Records carry a unique ID so a replayed batch is not saved twice:
+# before a record's first write the spool notes where the sink ended (its
+# resume point), and whichever process replays the record later checks the
+# sink from there.
+#
+# Several processes may share a spool file (the app and the API's worker
+# processes do by default). Only one flusher per file writes to the sink at a
+# time, the one holding the file's writer lock (spool-sheets.sqlite3.lock);
+# the others leave their records to it and take over when it exits, so the
+# sink's write quota is spent by one process only.
+import json
+import logging
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from datetime import datetime as dt
+from pathlib import Path
+
+import admission
+import metrics
+
+DEFAULT_PATH = Path(__file__).resolve().parent / "data" / "spool.sqlite3"
+
+# A batch claimed by a flusher that died is handed out again after this many seconds
+CLAIM_LEASE = 120
+
+# The flusher deletes saved records older than SAVED_RETENTION every PURGE_INTERVAL seconds
+PURGE_INTERVAL = 3600.0
+SAVED_RETENTION = 24 * 3600
+
+log = logging.getLogger("imctq.spool")
+
+QUEUED, INFLIGHT, RETRYING, SAVED = "queued", "inflight", "retrying", "saved"
+
+
+def default_path():
+    """Spool location: $IMCTQ_SPOOL_PATH or iMCTQ_streamlit/data/spool.sqlite3."""
+    return Path(os.environ.get("IMCTQ_SPOOL_PATH") or DEFAULT_PATH)
+
+
+def sink_path(base, sink_name):
+    """Spool file of one storage sink: spool.sqlite3 -> spool-sheets.sqlite3 etc."""
+    base = Path(base)
+    return base.with_name(f"{base.stem}-{sink_name}{base.suffix}")
+
+
+def new_record_id(now=None):
+    """Timestamp ID (same format as before) plus a random suffix, unique across sessions."""
+    now = now or dt.now()
+    return f"{now.strftime('%Y-%m-%d_%H-%M-%S.%f')}_{secrets.token_hex(4)}"
+
+
+class WriterLock:
+    """
+    Exclusive, non-blocking lock on a file, held by the one flusher that
+    drains a spool. The OS releases it when the holding process exits, and
+    a second holder in the same process is refused too.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self):
+        """True if this lock is (now) held, False while someone else holds it."""
+        if self._file is not None:
+            return True
+        f = open(self.path, "a+")
+        try:
+            if os.name == "nt":
+                import msvcrt
+
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if os.name == "nt":
+            import msvcrt
+
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        # Closing the file drops the flock
+        self._file.close()
+        self._file = None
+
+
+def _json_default(value):
+    # numpy scalars and anything else with .item()
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class Spool:
+    """SQLite-backed queue of records waiting to be written to the sink."""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else default_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " id TEXT PRIMARY KEY,"
+            " payload TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'queued',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " claimed REAL,"
+            " saved REAL,"
+            " last_error TEXT,"
+            " resume_row INTEGER)"
+        )
+        columns = {r[1] for r in self._db.execute("PRAGMA table_info(records)")}
+        if "resume_row" not in columns:
+            # Spools created before resume points were kept
+            self._db.execute("ALTER TABLE records ADD COLUMN resume_row INTEGER")
+        self._db.execute("CREATE INDEX IF NOT EXISTS records_status ON records (status, created)")
+
+    def put(self, record):
+        """Stores a record (must have an 'ID'); returns the ID. Re-putting the same ID is a no-op."""
+        record_id = record["ID"]
+        payload = json.dumps(record, default=_json_default, ensure_ascii=False)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO records (id, payload, created) VALUES (?, ?, ?)",
+                (record_id, payload, time.time()),
+            )
+        return record_id
+
+    def claim(self, limit):
+        """
+        Atomically hands out up to `limit` unsaved records as
+        [(id, record, attempts, created, resume_row)]. Records claimed by
+        another flusher stay reserved until CLAIM_LEASE expires.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, payload, attempts, created, resume_row FROM records"
+                    " WHERE status IN (?, ?) OR (status = ? AND claimed < ?)"
+                    " ORDER BY created LIMIT ?",
+                    (QUEUED, RETRYING, INFLIGHT, now - CLAIM_LEASE, limit),
+                ).fetchall()
+                self._db.executemany(
+                    "UPDATE records SET status = ?, claimed = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(INFLIGHT, now, r[0]) for r in rows],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return [(r[0], json.loads(r[1]), r[2] + 1, r[3], r[4]) for r in rows]
+
+    def set_resume_points(self, points):
+        """Stores {id: sink row} noted before the first write of the records (None = unknown)."""
+        with self._lock:
+            self._db.executemany("UPDATE records SET resume_row = ? WHERE id = ?",
+                                 [(row, i) for i, row in points.items()])
+
+    def mark_saved(self, ids):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE records SET status = ?, saved = ?, last_error = NULL WHERE id = ?",
+                [(SAVED, time.time(), i) for i in ids],
+            )
+
+    def mark_failed(self, ids, error):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE records SET status = ?, claimed = NULL, last_error = ? WHERE id = ?",
+                [(RETRYING, str(error)[:500], i) for i in ids],
+            )
+
+    def release(self, ids):
+        """Hands claimed records back untouched (the attempt is not counted)."""
+        with self._lock:
+            self._db.executemany(
+                "UPDATE records SET status = CASE WHEN attempts > 1 THEN ? ELSE ? END,"
+                " claimed = NULL, attempts = attempts - 1 WHERE id = ? AND status = ?",
+                [(RETRYING, QUEUED, i, INFLIGHT) for i in ids],
+            )
+
+    def status(self, record_id):
+        """Returns 'queued' / 'inflight' / 'retrying' / 'saved', or None for an unknown ID."""
+        with self._lock:
+            row = self._db.execute("SELECT status FROM records WHERE id = ?", (record_id,)).fetchone()
+        return row[0] if row else None
+
+    def pending(self):
+        """Number of records not saved yet."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM records WHERE status != ?", (SAVED,)).fetchone()[0]
+
+    def counts(self):
+        """Number of records per status."""
+        with self._lock:
+            return dict(self._db.execute("SELECT status, COUNT(*) FROM records GROUP BY status").fetchall())
+
+    def purge_saved(self, older_than=7 * 24 * 3600):
+        """Deletes records saved more than `older_than` seconds ago."""
+        with self._lock:
+            self._db.execute("DELETE FROM records WHERE status = ? AND saved < ?", (SAVED, time.time() - older_than))
+
+
+class Flusher:
+    """
+    Background thread that drains a Spool into a sink.
+
+    The sink needs `append_many(records)`; if it also has
+    `existing_ids(ids, since)`, records that were already attempted are
+    checked against it first, so a batch whose outcome was lost (crash,
+    timeout) is not appended twice. `since` holds the resume point of each
+    record ({id: row}, from the sink's `resume_points(ids)` before the first
+    attempt, by whichever process made it), so only rows written after it
+    need to be read.
+    `on_saved(records)`, if given, is called with every batch once it is stored.
+    Saved records are purged from the spool after `retention` seconds, checked
+    every `purge_interval` seconds.
+
+    `limiter` (admission.TokenBucket) and `breaker` (admission.CircuitBreaker)
+    guard a rate-limited sink: a batch they hold back stays in the spool and
+    is tried again later, without counting as a failed attempt.
+
+    The background thread only writes while it holds the spool's WriterLock;
+    without it, it checks again every `interval` seconds.
+    """
+
+    def __init__(self, spool, sink, batch_size=200, interval=2.0, base_backoff=2.0, max_backoff=300.0, on_saved=None,
+                 limiter=None, breaker=None, purge_interval=PURGE_INTERVAL, retention=SAVED_RETENTION):
+        self.spool = spool
+        self.sink = sink
+        self.on_saved = on_saved
+        self.limiter = limiter
+        self.breaker = breaker
+        self.batch_size = batch_size
+        self.interval = interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.purge_interval = purge_interval
+        self.retention = retention
+        self._last_purge = time.monotonic()
+        self.writer_lock = WriterLock(spool.path.with_name(spool.path.name + ".lock"))
+        self.failures = 0
+        self.last_error = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        sink_name = getattr(sink, "name", type(sink).__name__)
+        metrics.REGISTRY.add_collector(
+            lambda: metrics.SPOOL_PENDING.set(spool.pending(), sink=sink_name), key=("spool_pending", sink_name))
+        if breaker is not None:
+            metrics.REGISTRY.add_collector(
+                lambda: metrics.BREAKER_STATE.set(admission.STATE_VALUES[breaker.state], sink=sink_name),
+                key=("breaker_state", sink_name))
+        if limiter is not None:
+            metrics.REGISTRY.add_collector(
+                lambda: metrics.LIMITER_TOKENS.set(round(limiter.tokens, 2), sink=sink_name),
+                key=("limiter_tokens", sink_name))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="imctq-spool-flusher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def writing(self):
+        """True if this flusher holds the spool's writer lock (it is the one draining it)."""
+        return self.writer_lock.held
+
+    def wake(self):
+        """Asks the flusher to drain the spool now instead of at the next poll."""
+        self._wake.set()
+
+    @property
+    def deferred(self):
+        """True while the circuit breaker keeps writes in the spool."""
+        return self.breaker is not None and self.breaker.state != admission.CLOSED
+
+    def held_for(self):
+        """Seconds until the limiter / breaker would let the next write through."""
+        wait = 0.0
+        if self.breaker is not None:
+            wait = self.breaker.retry_after()
+        if self.limiter is not None:
+            wait = max(wait, self.limiter.wait_time())
+        return wait
+
+    def _cost(self, ids, replayed):
+        """API requests the sink will make for this batch (its `request_count`, else one)."""
+        if hasattr(self.sink, "request_count"):
+            return self.sink.request_count(ids, check_existing=bool(replayed))
+        return 1
+
+    def _admit(self, ids, sink, cost=1):
+        """
+        Checks the breaker, then takes `cost` limiter tokens; hands the batch
+        back to the spool if either says no. No token is spent on a batch the
+        breaker refuses, and a trial the breaker allowed is given back if the
+        limiter then holds the batch.
+        """
+        reason = None
+        if self.breaker is not None and not self.breaker.allow():
+            reason = "breaker"
+        elif self.limiter is not None and not self.limiter.try_acquire(min(cost, self.limiter.capacity)):
+            reason = "rate_limit"
+            if self.breaker is not None:
+                self.breaker.cancel()
+        if reason is None:
+            return True
+        self.spool.release(ids)
+        metrics.WRITES_DEFERRED.inc(len(ids), sink=sink, reason=reason)
+        return False
+
+    def flush_once(self):
+        """Writes one batch; returns the number of records saved (0 if deferred). Raises on sink errors."""
+        if self.breaker is not None and self.breaker.state == admission.OPEN:
+            return 0
+        batch = self.spool.claim(self.batch_size)
+        if not batch:
+            return 0
+        sink = getattr(self.sink, "name", type(self.sink).__name__)
+        ids = [b[0] for b in batch]
+        replayed = {b[0]: b[4] for b in batch if b[2] > 1}
+        if not self._admit(ids, sink, self._cost(ids, replayed)):
+            return 0
+        records = saved = [b[1] for b in batch]
+        if replayed:
+            metrics.SAVE_RETRIES.inc(len(replayed), sink=sink)
+        t0 = time.perf_counter()
+        try:
+            if replayed and hasattr(self.sink, "existing_ids"):
+                done = set(self.sink.existing_ids(list(replayed), since=replayed))
+                records = [r for r in records if r["ID"] not in done]
+            first = [b[0] for b in batch if b[2] == 1]
+            if first and hasattr(self.sink, "resume_points"):
+                # Noted before the write: if its outcome is lost, a replay looks from here on
+                self.spool.set_resume_points(self.sink.resume_points(first))
+            with metrics.PHASE_SECONDS.time(phase=f"{sink}_batch"):
+                self.sink.append_many(records)
+        except Exception as e:
+            self.spool.mark_failed(ids, e)
+            metrics.SAVES.inc(len(ids), sink=sink, outcome="failure")
+            if metrics.is_quota_error(e):
+                metrics.QUOTA_ERRORS.inc(sink=sink)
+                if self.limiter is not None:
+                    # The quota is used up (maybe by another process): stop sending until it refills
+                    self.limiter.drain()
+            self._record(False, time.perf_counter() - t0, sink)
+            raise
+        self._record(True, time.perf_counter() - t0, sink)
+        self.spool.mark_saved(ids)
+        now = time.time()
+        metrics.SAVES.inc(len(ids), sink=sink, outcome="success")
+        for b in batch:
+            metrics.SUBMIT_TO_SAVED.observe(now - b[3], sink=sink)
+        if self.on_saved is not None:
+            try:
+                self.on_saved(saved)
+            except Exception:
+                log.exception("on_saved callback failed")
+        return len(ids)
+
+    def _record(self, ok, duration, sink):
+        if self.breaker is None:
+            return
+        was_open = self.breaker.state == admission.OPEN
+        if not self.breaker.record(ok, duration) and not was_open and self.breaker.state == admission.OPEN:
+            metrics.BREAKER_OPENS.inc(sink=sink)
+            log.warning("Circuit breaker opened; writes stay in the spool", extra={"sink": sink})
+
+    def maybe_purge(self):
+        """Deletes old saved records if `purge_interval` has passed since the last purge."""
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            self.spool.purge_saved(self.retention)
+        except sqlite3.Error:
+            log.exception("Spool purge failed")
+
+    def _backoff(self):
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (self.failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            self.writer_lock.release()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            # Polling every `interval` lets a burst of submits land in the same batch;
+            # while the limiter / breaker hold writes back there is no point waking earlier
+            held = self.held_for()
+            if held:
+                self._stop.wait(held)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self.writer_lock.acquire():
+                # Another process (or an older flusher) drains this spool
+                continue
+            try:
+                while self.flush_once() == self.batch_size:
+                    pass
+                self.failures = 0
+                self.last_error = None
+            except Exception as e:
+                self.failures += 1
+                self.last_error = e
+                log.warning("Spool flush failed (%d in a row): %s", self.failures, e,
+                            extra={"sink": getattr(self.sink, "name", None), "failures": self.failures})
+                self._stop.wait(self._backoff())
+            self.maybe_purge()
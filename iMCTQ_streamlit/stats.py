@@ -0,0 +1,344 @@
+# Running population statistics for the "where do you stand" display.
+#
+# For MSFsc, SJL, SDweek and Bamid we keep one fixed-range histogram at
+# 1-minute resolution per population slice (everyone, sex, age band,
+# education). Such a histogram is a mergeable quantile sketch for these
+# bounded clock-hour values: updates are O(1), two sketches merge by adding
+# counts, and ranks/quantiles are exact to within one bin (1 minute).
+# Coarser histograms for display are derived from the same counts.
+#
+# The aggregates are updated as batches are saved (spool.Flusher.on_saved),
+# persisted to JSON periodically and can be rebuilt from stored responses.
+# Without a stats file, shared() starts from empty stats and rebuilds them
+# from the local sink on a background thread, never on a respondent's rerun;
+# for a large sink, rather run the rebuild beforehand:
+#   python stats.py rebuild --sqlite data/responses.sqlite3
+#   python stats.py rebuild --parquet data/responses_parquet
+#   python stats.py rebuild --csv export.csv
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger("imctq.stats")
+
+# metric -> (low, high) in hours; values outside are counted in the edge bins
+METRICS = {
+    'MSFsc': (-6.0, 24.0),
+    'SJL': (0.0, 12.0),
+    'SDweek': (0.0, 24.0),
+    'Bamid': (0.0, 24.0),
+}
+BINS_PER_HOUR = 60
+
+AGE_BANDS = (20, 30, 40, 50, 60)  # <20, 20-29, ..., 60+
+
+# Don't show a percentile computed from fewer respondents than this
+MIN_COUNT = 30
+
+
+def age_band(age):
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return None
+    lo = 0
+    for edge in AGE_BANDS:
+        if age < edge:
+            return f"{lo}-{edge - 1}" if lo else f"<{edge}"
+        lo = edge
+    return f"{AGE_BANDS[-1]}+"
+
+
+def slices_for(record):
+    """Population slices a record belongs to, as (dimension, value) keys."""
+    keys = [('all', '')]
+    if record.get('sex') not in (None, ''):
+        keys.append(('sex', str(record['sex'])))
+    band = age_band(record.get('age'))
+    if band:
+        keys.append(('age', band))
+    if record.get('educ') not in (None, ''):
+        keys.append(('educ', str(record['educ'])))
+    return keys
+
+
+def _value(v):
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        return np.nan  # 'N/A', None, ''
+    return v
+
+
+class QuantileSketch:
+    """Fixed-range histogram with 1-minute bins; see the module comment."""
+
+    def __init__(self, low, high, counts=None):
+        self.low = low
+        self.high = high
+        n = int(round((high - low) * BINS_PER_HOUR))
+        self.counts = np.zeros(n, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def _bin(self, values):
+        idx = np.floor((np.asarray(values, dtype=float) - self.low) * BINS_PER_HOUR).astype(np.int64)
+        return np.clip(idx, 0, len(self.counts) - 1)
+
+    def add(self, values):
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.counts += np.bincount(self._bin(values), minlength=len(self.counts))
+
+    def merge(self, other):
+        self.counts += other.counts
+        return self
+
+    def rank(self, value):
+        """Fraction of recorded values below `value` (half of its own bin counted as below)."""
+        total = self.count
+        if not total or np.isnan(value):
+            return None
+        i = int(self._bin(value))
+        return float((self.counts[:i].sum() + self.counts[i] / 2) / total)
+
+    def quantile(self, q):
+        """Value below which a fraction q of the recorded values lies (bin midpoint)."""
+        total = self.count
+        if not total:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), q * total, side="left"))
+        return self.low + (min(i, len(self.counts) - 1) + 0.5) / BINS_PER_HOUR
+
+    def histogram(self, step=0.5):
+        """(bin start in hours, count) pairs for bins of `step` hours, trimmed to the occupied range."""
+        width = max(1, int(round(step * BINS_PER_HOUR)))
+        n = -(-len(self.counts) // width)
+        padded = np.zeros(n * width, dtype=np.int64)
+        padded[:len(self.counts)] = self.counts
+        coarse = padded.reshape(n, width).sum(axis=1)
+        nz = np.flatnonzero(coarse)
+        if not len(nz):
+            return []
+        return [(self.low + i * step, int(coarse[i])) for i in range(nz[0], nz[-1] + 1)]
+
+    def to_dict(self):
+        # Store sparse: most minute bins are empty
+        nz = np.flatnonzero(self.counts)
+        return {'low': self.low, 'high': self.high, 'bins': nz.tolist(), 'counts': self.counts[nz].tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['low'], d['high'])
+        sketch.counts[np.asarray(d['bins'], dtype=np.int64)] = d['counts']
+        return sketch
+
+
+class PopulationStats:
+    """Per-slice sketches of METRICS, shared by all sessions of the process."""
+
+    def __init__(self, path=None, save_every=60.0):
+        self.path = Path(path) if path else None
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._sketches = {}
+        self._dirty = False
+        self._rebuilding = False
+        self._last_save = time.monotonic()
+
+    def _sketch(self, slice_key, metric):
+        key = (slice_key, metric)
+        if key not in self._sketches:
+            self._sketches[key] = QuantileSketch(*METRICS[metric])
+        return self._sketches[key]
+
+    def add_batch(self, records):
+        """Adds saved records (dicts with MSFsc/SJL/SDweek/Bamid, 'N/A' allowed)."""
+        groups = {}
+        for r in records:
+            values = [_value(r.get(m)) for m in METRICS]
+            for key in slices_for(r):
+                groups.setdefault(key, []).append(values)
+        with self._lock:
+            for key, rows in groups.items():
+                cols = np.asarray(rows, dtype=float)
+                for j, metric in enumerate(METRICS):
+                    self._sketch(key, metric).add(cols[:, j])
+            self._dirty = True
+        self.maybe_save()
+
+    def merge(self, other):
+        with self._lock, other._lock:
+            for (key, metric), sketch in other._sketches.items():
+                self._sketch(key, metric).merge(sketch)
+            self._dirty = True
+        return self
+
+    def count(self, metric, slice_key=('all', '')):
+        with self._lock:
+            sketch = self._sketches.get((slice_key, metric))
+            return sketch.count if sketch else 0
+
+    def rank(self, metric, value, slice_key=('all', ''), min_count=MIN_COUNT):
+        """Fraction of the slice with a lower value, or None if the slice is too small."""
+        with self._lock:
+            sketch = self._sketches.get((slice_key, metric))
+            if sketch is None or sketch.count < min_count:
+                return None
+            return sketch.rank(value)
+
+    def quantile(self, metric, q, slice_key=('all', '')):
+        with self._lock:
+            sketch = self._sketches.get((slice_key, metric))
+            return sketch.quantile(q) if sketch else None
+
+    def histogram(self, metric, slice_key=('all', ''), step=0.5):
+        with self._lock:
+            sketch = self._sketches.get((slice_key, metric))
+            return sketch.histogram(step) if sketch else []
+
+    # --- Persistence ---
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'version': 1,
+                'sketches': [
+                    {'dim': key[0], 'value': key[1], 'metric': metric, **sketch.to_dict()}
+                    for (key, metric), sketch in self._sketches.items()
+                ],
+            }
+
+    @classmethod
+    def from_dict(cls, d, **kwargs):
+        stats = cls(**kwargs)
+        for s in d.get('sketches', []):
+            stats._sketches[((s['dim'], s['value']), s['metric'])] = QuantileSketch.from_dict(s)
+        return stats
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Loads persisted stats, or returns an empty instance if there is no file yet."""
+        path = Path(path)
+        if path.exists():
+            return cls.from_dict(json.loads(path.read_text()), path=path, **kwargs)
+        return cls(path=path, **kwargs)
+
+    def save(self, path=None):
+        path = Path(path or self.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(self.to_dict()))
+        os.replace(tmp, path)
+        with self._lock:
+            self._dirty = False
+            self._last_save = time.monotonic()
+
+    def maybe_save(self):
+        """Saves if there are unsaved updates and `save_every` seconds have passed."""
+        if self.path and self._dirty and not self._rebuilding and time.monotonic() - self._last_save >= self.save_every:
+            self.save()
+
+    def rebuild_in_background(self, records):
+        """
+        Adds the stored responses `records()` on a background thread, then
+        saves. Until then the stats hold only what was added since and are not
+        saved, so a partial file cannot stop the rebuild on the next start.
+        """
+        self._rebuilding = True
+
+        def run():
+            try:
+                self.merge(PopulationStats.rebuild(records()))
+            except Exception:
+                log.exception("rebuilding population stats failed")
+                return
+            self._rebuilding = False
+            if self.path:
+                self.save()
+
+        thread = threading.Thread(target=run, name="imctq-stats-rebuild", daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def rebuild(cls, records, batch_size=10_000, **kwargs):
+        """Builds stats from an iterable of stored records."""
+        stats = cls(**kwargs)
+        batch = []
+        for r in records:
+            batch.append(r)
+            if len(batch) == batch_size:
+                stats.add_batch(batch)
+                batch = []
+        stats.add_batch(batch)
+        return stats
+
+
+def default_path():
+    import storage
+
+    return storage.DATA_DIR / "population_stats.json"
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared(path=None, records=None):
+    """
+    The process-wide stats persisted at `path` (default_path()), loaded on
+    first use; later calls, e.g. after st.cache_resource.clear(), return the
+    same object, so two instances never overwrite each other's file. When
+    there is no file yet, the stats start empty and `records()` (stored
+    responses), if given, are added in the background.
+    """
+    path = Path(path or default_path())
+    with _shared_lock:
+        if path not in _shared:
+            _shared[path] = PopulationStats.load(path)
+            if not path.exists() and records is not None:
+                _shared[path].rebuild_in_background(records)
+        return _shared[path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild population statistics from stored responses.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild")
+    source = rebuild.add_mutually_exclusive_group(required=True)
+    source.add_argument("--sqlite", help="SQLite sink database")
+    source.add_argument("--parquet", help="Parquet sink directory")
+    source.add_argument("--csv", help="CSV/XLSX export of the sheet")
+    rebuild.add_argument("-o", "--output", help="Stats file (default: data/population_stats.json)")
+    args = parser.parse_args(argv)
+
+    import storage
+
+    if args.sqlite:
+        records = storage.SQLiteSink(args.sqlite).iter_records()
+    elif args.parquet:
+        records = storage.ParquetSink(args.parquet).iter_records()
+    else:
+        import rescore
+
+        records = (r for chunk in rescore.read_chunks(args.csv, 10_000) for r in chunk.to_dict("records"))
+
+    stats = PopulationStats.rebuild(records)
+    stats.save(args.output or default_path())
+    print(f"{stats.count('MSFsc')} MSFsc values, {stats.count('SJL')} SJL values", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+# Response storage backends ("sinks").
+#
+# Every sink takes the `vd` record dicts built by app.py through
+# `append_many(records)`. Each active sink gets its own spool and flusher
+# (spool.py), so a slow or failing sink does not hold back the others.
+# Available sinks:
+#   sheets  - the Google Sheet (sheets.SheetsConnection)
+#   sqlite  - a local SQLite table, one column per record field
+#   parquet - an append-only Parquet dataset (one file per batch), for analytics
+#
+# Which sinks are active comes from st.secrets:
+#   [storage]
+#   sinks = ["sheets", "sqlite"]
+#   sqlite_path = "data/responses.sqlite3"
+#   parquet_dir = "data/responses_parquet"
+# or the IMCTQ_SINKS environment variable ("sqlite,parquet"). Without either,
+# the sheet is used when Google credentials are configured and SQLite otherwise,
+# so local development and tests need no Google account.
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime as dt
+from pathlib import Path
+
+DATA_DIR = Path(os.environ.get("IMCTQ_DATA_DIR") or Path(__file__).resolve().parent / "data")
+DEFAULT_SQLITE_PATH = DATA_DIR / "responses.sqlite3"
+DEFAULT_PARQUET_DIR = DATA_DIR / "responses_parquet"
+
+# Fields of a stored response, in the order app.py writes them (the header
+# of a new sheet partition when there is no older one to copy it from)
+RECORD_FIELDS = [
+    'ID', 'age', 'sex', 'height', 'weight', 'postal', 'educ', 'WD', 'FD',
+    'BTw', 'SPrepw', 'SLatwi', 'SEw', 'Alarmw', 'BAlarmw', 'SIw', 'LEw',
+    'BTf', 'SPrepf', 'SLatfi', 'SEf', 'Alarmf', 'BAlarmf', 'SIf', 'LEf',
+    'Slequal', 'Bastart', 'Baend_time', 'Baend_past_midnight',
+    'MSFsc', 'SJL', 'SDweek', 'Bamid', 'Shift', 'Shifts', 'Shifts_past_midnight',
+    'Shifte', 'Shifte_past_midnight', 'Travel',
+    # From the PSČ (geo.py)
+    'district', 'region', 'lon', 'MSFsc_sun',
+    # Cut-off table that classified the response (thresholds.py)
+    'thresholds_version',
+]
+
+# Column types for the typed (columnar) copies; unknown fields are stored as text.
+# 'N/A' in the score columns becomes a null.
+FLOAT_FIELDS = {'height', 'weight', 'LEw', 'LEf', 'MSFsc', 'SJL', 'SDweek', 'Bamid', 'lon', 'MSFsc_sun'}
+INT_FIELDS = {'age', 'educ', 'WD', 'FD', 'SLatwi', 'Alarmw', 'BAlarmw', 'SIw',
+              'SLatfi', 'Alarmf', 'BAlarmf', 'SIf', 'Slequal', 'Shift', 'Travel'}
+BOOL_FIELDS = {'Baend_past_midnight', 'Shifts_past_midnight', 'Shifte_past_midnight'}
+# Clock times stored as 'HH-MM' text; typed copies may turn them into time columns
+TIME_FIELDS = {'BTw', 'SPrepw', 'SEw', 'BTf', 'SPrepf', 'SEf', 'Bastart', 'Baend_time', 'Shifts', 'Shifte'}
+
+
+def _typed(field, value):
+    """Coerces one record value to the column type used by the local sinks."""
+    if value is None or value == '' or value == 'N/A':
+        return None
+    try:
+        if field in FLOAT_FIELDS:
+            return float(value)
+        if field in INT_FIELDS:
+            # Sheets may hand back whole numbers as 5.0
+            return int(float(value))
+    except (TypeError, ValueError):
+        return None
+    if field in BOOL_FIELDS:
+        return value if isinstance(value, bool) else str(value).strip().upper() in ('TRUE', '1')
+    return value if isinstance(value, str) else str(value)
+
+
+def _clock(value):
+    """'HH-MM' / 'HH:MM' -> datetime.time, anything else -> None."""
+    import datetime
+
+    text = str(value).strip() if value is not None else ''
+    if len(text) == 5 and text[2] in '-:' and text[:2].isdigit() and text[3:].isdigit():
+        hours, minutes = int(text[:2]), int(text[3:])
+        if hours < 24 and minutes < 60:
+            return datetime.time(hours, minutes)
+    return None
+
+
+def to_arrow(records, parse_times=False):
+    """
+    Typed pyarrow Table of record dicts (columns in first-seen order). With
+    `parse_times`, the 'HH-MM' fields become time32 columns instead of text.
+    """
+    import pyarrow as pa
+
+    fields = list(dict.fromkeys(k for r in records for k in r))
+    columns = {}
+    for f in fields:
+        if parse_times and f in TIME_FIELDS:
+            columns[f] = pa.array([_clock(r.get(f)) for r in records], type=pa.time32('ms'))
+            continue
+        values = [_typed(f, r.get(f)) for r in records]
+        if f in FLOAT_FIELDS:
+            columns[f] = pa.array(values, type=pa.float64())
+        elif f in INT_FIELDS:
+            columns[f] = pa.array(values, type=pa.int64())
+        elif f in BOOL_FIELDS:
+            columns[f] = pa.array(values, type=pa.bool_())
+        else:
+            columns[f] = pa.array(values, type=pa.string())
+    return pa.table(columns)
+
+
+class Sink:
+    """Base class: a sink writes batches of record dicts."""
+
+    name = "sink"
+
+    def append_many(self, records):
+        raise NotImplementedError
+
+    def append(self, record):
+        self.append_many([record])
+
+
+class SQLiteSink(Sink):
+    """
+    Local SQLite table `responses` keyed by ID. New record fields become new
+    columns; re-writing an existing ID is ignored, so replays are harmless.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path=None):
+        self.path = Path(path or DEFAULT_SQLITE_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (ID TEXT PRIMARY KEY)")
+        self._columns = [r[1] for r in self._db.execute("PRAGMA table_info(responses)")]
+
+    def _ensure_columns(self, fields):
+        for field in fields:
+            if field not in self._columns:
+                self._db.execute(f'ALTER TABLE responses ADD COLUMN "{field.replace(chr(34), "")}"')
+                self._columns.append(field)
+
+    def append_many(self, records):
+        if not records:
+            return
+        with self._lock:
+            fields = list(dict.fromkeys(k for r in records for k in r))
+            self._ensure_columns(fields)
+            cols = ", ".join(f'"{f}"' for f in fields)
+            marks = ", ".join("?" for _ in fields)
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    f"INSERT OR IGNORE INTO responses ({cols}) VALUES ({marks})",
+                    [[_typed(f, r.get(f)) for f in fields] for r in records],
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def iter_records(self, batch_size=10_000):
+        """Yields stored records as dicts, in insertion order (own read connection, WAL lets writers continue)."""
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=30)
+        try:
+            cur = db.execute("SELECT * FROM responses ORDER BY rowid")
+            names = [d[0] for d in cur.description]
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(names, row))
+        finally:
+            db.close()
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ParquetSink(Sink):
+    """
+    Append-only Parquet dataset: each batch becomes one file named by its
+    write time, with typed columns. Read it with `read_table()` (or any
+    Arrow/pandas/DuckDB reader); duplicate IDs from replays are dropped there.
+    """
+
+    name = "parquet"
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory or DEFAULT_PARQUET_DIR)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def append_many(self, records):
+        if not records:
+            return
+        import pyarrow.parquet as pq
+
+        table = to_arrow(records)
+        name = f"part-{dt.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp = self.directory / f".{name}.tmp"
+        pq.write_table(table, tmp)
+        # Readers never see a half-written file
+        os.replace(tmp, self.directory / name)
+
+    def read_table(self, columns=None):
+        """All stored responses as a pyarrow Table (deduplicated on ID), or None when empty."""
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        files = sorted(str(p) for p in self.directory.glob("part-*.parquet"))
+        if not files:
+            return None
+        # Later batches may carry fields the first ones did not have
+        schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+        table = ds.dataset(files, schema=schema, format="parquet").to_table(columns=columns)
+        if columns is None or "ID" in columns:
+            first = {}
+            for i, v in enumerate(table.column("ID").to_pylist()):
+                first.setdefault(v, i)
+            if len(first) < table.num_rows:
+                table = table.take(sorted(first.values()))
+        return table
+
+    def iter_records(self, batch_size=10_000):
+        table = self.read_table()
+        if table is None:
+            return
+        for batch in table.to_batches(batch_size):
+            yield from batch.to_pylist()
+
+
+# --- Configuration ---
+
+def sink_names(config=None, has_google_credentials=False):
+    """Active sink names from the [storage] secrets section or $IMCTQ_SINKS."""
+    config = dict(config or {})
+    names = config.get("sinks") or os.environ.get("IMCTQ_SINKS")
+    if isinstance(names, str):
+        names = [n.strip() for n in names.split(",") if n.strip()]
+    if not names:
+        names = ["sheets"] if has_google_credentials else ["sqlite"]
+    unknown = set(names) - {"sheets", "sqlite", "parquet"}
+    if unknown:
+        raise ValueError(f"Unknown storage sinks {sorted(unknown)}; use sheets, sqlite or parquet.")
+    return list(dict.fromkeys(names))
+
+
+def build_sink(name, config=None, sheets_connection=None):
+    """Creates one sink by name; `sheets_connection` is used for 'sheets'."""
+    config = dict(config or {})
+    if name == "sheets":
+        if sheets_connection is None:
+            raise ValueError("The 'sheets' sink needs a SheetsConnection.")
+        return sheets_connection
+    if name == "sqlite":
+        return SQLiteSink(config.get("sqlite_path"))
+    if name == "parquet":
+        return ParquetSink(config.get("parquet_dir"))
+    raise ValueError(f"Unknown storage sink '{name}'.")
+
+
+def start_flushers(names, config=None, spool_base=None, sheets_connection=None, sheets_config=None, on_saved=None):
+    """
+    Builds the sinks `names` and starts a spool + flusher for each; returns
+    {name: spool.Flusher} in the given order. `on_saved` is attached to the
+    first (primary) sink only. The sheet gets the process-wide write-quota
+    limiter and circuit breaker configured by `sheets_config` (see admission.py).
+    Stop the flushers (Flusher.stop) before starting new ones for the same spools.
+    """
+    import admission
+    import spool
+
+    base = spool_base or spool.default_path()
+    flushers = {}
+    for name in names:
+        sink = build_sink(name, config, sheets_connection if name == "sheets" else None)
+        guards = {}
+        if name == "sheets":
+            guards = dict(zip(("limiter", "breaker"), admission.shared(name, sheets_config)))
+        flushers[name] = spool.Flusher(
+            spool.Spool(spool.sink_path(base, name)), sink,
+            on_saved=on_saved if not flushers else None, **guards).start()
+    return flushers
@@ -0,0 +1,289 @@
+# Incremental sync of the response sheets into a local Parquet snapshot.
+#
+# The snapshot is a Hive-partitioned dataset, one directory per month of the
+# response ID (month=2025-10/...), with typed columns: numbers, booleans,
+# 'N/A' -> null, and the 'HH-MM' clock times as time columns. A small state
+# file remembers, per partition worksheet (sheets.py), the next sheet row and
+# the ID of the last synced row, so a run reads only rows added since the
+# previous one. Header and new rows come in a single values:batchGet call.
+# Partitions whose period had ended (plus a day of grace) when they were last
+# synced are closed and not read again. The list of partition worksheets is
+# kept in the state file too and only fetched again (open_by_key + sheet
+# metadata) when the current period's worksheet is not on it, so a run that
+# finds nothing new costs one values:batchGet per open partition (normally
+# one, two for a day after a period ends).
+# Each run adds one file per touched month; months with many small files are
+# compacted into one (deduplicated on ID).
+#
+#   python sync.py --credentials sa.json                 # -> data/responses_snapshot
+#   python sync.py --credentials sa.json --compact       # force compaction of all months
+#   python sync.py --credentials sa.json --full          # rebuild from scratch
+# Reading it for analysis (memory-mapped):
+#   import sync; table = sync.read_snapshot(columns=['ID', 'MSFsc'], months=('2025-09', '2025-12'))
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import storage
+
+DEFAULT_DIR = storage.DATA_DIR / "responses_snapshot"
+STATE_FILE = "_sync_state.json"
+
+DEFAULT_CHUNK = 5_000
+# Compact a month once it has more files than this
+COMPACT_AFTER = 16
+# A partition still takes late writes (clock skew, spooled retries) this long after its period
+CLOSE_GRACE = datetime.timedelta(days=1)
+
+
+# --- State ---
+
+def load_state(directory):
+    """{"worksheets": {title: {"next_row", "last_id", "header", "synced_at"}}, "partitions": [title, ...]}"""
+    path = Path(directory) / STATE_FILE
+    if not path.exists():
+        return {"worksheets": {}}
+    state = json.loads(path.read_text())
+    if "worksheets" not in state:
+        # Snapshots from before the partitioning synced the single worksheet
+        import sheets
+
+        state = {"worksheets": {sheets.SHEET_NAME: state}}
+    return state
+
+
+def _new_worksheet_state():
+    return {"next_row": 2, "last_id": None, "header": None}
+
+
+def is_closed(title, ws_state):
+    """True if the partition's period had ended (plus CLOSE_GRACE) at its last sync."""
+    import sheets
+
+    period = sheets.parse_title(title)
+    if period is None or not ws_state.get("synced_at"):
+        return False
+    synced = datetime.datetime.fromisoformat(ws_state["synced_at"]).date()
+    return synced >= sheets.period_bounds(period)[1] + CLOSE_GRACE
+
+
+def save_state(directory, state):
+    path = Path(directory) / STATE_FILE
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state, indent=1))
+    os.replace(tmp, path)
+
+
+# --- Dataset ---
+
+def _month(record_id):
+    # IDs start with the submit date: 2025-10-24_12-50-00.123456_ab12cd34
+    text = str(record_id or '')
+    return text[:7] if len(text) >= 7 and text[4] == '-' and text[:4].isdigit() else 'unknown'
+
+
+def _write_file(table, path):
+    import pyarrow.parquet as pq
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table, tmp)
+    # Readers never see a half-written file
+    os.replace(tmp, path)
+
+
+def write_rows(directory, records, first_row, source=""):
+    """
+    Appends records (rows from `first_row` on of worksheet partition `source`)
+    as one file per month; returns the months touched.
+    """
+    by_month = {}
+    for record in records:
+        by_month.setdefault(_month(record.get('ID')), []).append(record)
+    last_row = first_row + len(records) - 1
+    # Rows of different worksheets can land in the same month
+    suffix = f"-s{source.replace('-', '')}" if source else ""
+    for month, rows in by_month.items():
+        name = f"part-{first_row:09d}-{last_row:09d}{suffix}.parquet"
+        _write_file(storage.to_arrow(rows, parse_times=True), Path(directory) / f"month={month}" / name)
+    return sorted(by_month)
+
+
+def _read_files(files):
+    """Reads and concatenates Parquet files whose schemas may differ (columns added later)."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = [pq.read_table(f, memory_map=True) for f in files]
+    return pa.concat_tables(tables, promote_options="default")
+
+
+def _dedupe(table):
+    if "ID" not in table.column_names:
+        return table
+    first = {}
+    for i, v in enumerate(table.column("ID").to_pylist()):
+        first.setdefault(v, i)
+    return table.take(sorted(first.values())) if len(first) < table.num_rows else table
+
+
+def compact(directory, months=None, min_files=2):
+    """Rewrites each month with at least `min_files` files as one deduplicated file; returns the months compacted."""
+    directory = Path(directory)
+    done = []
+    for part in sorted(directory.glob("month=*")):
+        month = part.name.split("=", 1)[1]
+        if months is not None and month not in months:
+            continue
+        files = sorted(part.glob("part-*.parquet"))
+        if len(files) < min_files:
+            continue
+        table = _dedupe(_read_files(files))
+        first = files[0].name.split("-")[1]
+        last = files[-1].name.split("-")[2].split(".")[0]
+        # Written under a name no reader globs for yet, then swapped in
+        merged = part / f"part-{first}-{last}-c{uuid.uuid4().hex[:6]}.parquet"
+        _write_file(table, merged)
+        for f in files:
+            f.unlink()
+        done.append(month)
+    return done
+
+
+def read_snapshot(directory=None, columns=None, months=None):
+    """
+    The snapshot as one pyarrow Table (memory-mapped reads, duplicates dropped),
+    or None when empty. `months` = (first, last) inclusive, e.g. ('2025-09', '2025-12'),
+    reads only those partitions.
+    """
+    directory = Path(directory or DEFAULT_DIR)
+    files = []
+    for part in sorted(directory.glob("month=*")):
+        month = part.name.split("=", 1)[1]
+        if months and month != 'unknown' and not (months[0] <= month <= months[1]):
+            continue
+        files.extend(sorted(part.glob("part-*.parquet")))
+    if not files:
+        return None
+    table = _dedupe(_read_files(files))
+    if columns is not None:
+        table = table.select([c for c in columns if c in table.column_names])
+    return table
+
+
+# --- Sync ---
+
+def _records(header, rows):
+    # Rows shorter than the header had trailing empty cells
+    return [dict(zip(header, list(r) + [''] * (len(header) - len(r)))) for r in rows]
+
+
+def _sync_worksheet(connection, title, ws_state, directory, chunk_size, save, log):
+    """Fetches the new rows of one worksheet; returns (rows synced, months touched)."""
+    import sheets
+
+    source = sheets.parse_title(title) or ""
+    total = 0
+    touched = set()
+    while True:
+        start = ws_state["next_row"]
+        # Re-read the last synced row as well, to check it is still the same response
+        check = start - 1 if ws_state["last_id"] else start
+        header_rows, rows = connection.batch_get(["1:1", f"{check}:{start + chunk_size - 1}"], title)
+        header = [str(h) for h in (header_rows[0] if header_rows else [])]
+        if not header:
+            raise RuntimeError(f"Header row (row 1) of '{title}' is empty.")
+        if ws_state["last_id"]:
+            known = _records(header, rows[:1])
+            if not known or str(known[0].get("ID")) != ws_state["last_id"]:
+                raise RuntimeError(
+                    f"Row {check} of '{title}' no longer holds ID {ws_state['last_id']}; "
+                    f"the sheet was edited. Re-sync with --full.")
+            rows = rows[1:]
+        ws_state["synced_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if rows:
+            records = _records(header, rows)
+            touched.update(write_rows(directory, records, start, source))
+            ws_state.update(next_row=start + len(rows), last_id=str(records[-1].get("ID")), header=header)
+            total += len(rows)
+            if log:
+                log(f"{title}: {total} new rows")
+        save()
+        if len(rows) < chunk_size:
+            return total, touched
+
+
+def partition_titles(connection, state):
+    """The partition worksheets, from the state file unless the current period's one is missing there."""
+    titles = state.get("partitions")
+    if connection.sheet_name:
+        return [connection.sheet_name]
+    if not titles or connection.current_title not in titles:
+        titles = state["partitions"] = connection.partition_titles()
+    return titles
+
+
+def sync(connection, directory=None, chunk_size=DEFAULT_CHUNK, compact_after=COMPACT_AFTER, log=None):
+    """
+    Fetches the rows added since the last run, from every open partition of
+    the sheet (or the one worksheet `connection` is pinned to), into the
+    snapshot. Returns the number of new rows. Raises RuntimeError when a
+    worksheet no longer matches the saved state (rows deleted or re-sorted);
+    rerun with a fresh directory.
+    """
+    directory = Path(directory or DEFAULT_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    state = load_state(directory)
+    worksheets = state["worksheets"]
+    total = 0
+    touched = set()
+    for title in partition_titles(connection, state):
+        ws_state = worksheets.setdefault(title, _new_worksheet_state())
+        if is_closed(title, ws_state):
+            continue
+        n, months = _sync_worksheet(connection, title, ws_state, directory, chunk_size,
+                                    lambda: save_state(directory, state), log)
+        total += n
+        touched |= months
+    for month in sorted(touched):
+        if len(list((directory / f"month={month}").glob("part-*.parquet"))) > compact_after:
+            compact(directory, months={month})
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incrementally sync the response sheet into a Parquet snapshot.")
+    parser.add_argument("-o", "--output", help=f"Snapshot directory (default: {DEFAULT_DIR})")
+    parser.add_argument("--credentials", help="Service account JSON file (not needed with IMCTQ_SHEETS_EMULATOR)")
+    parser.add_argument("--worksheet", help="Sync only this worksheet (default: all time partitions)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK, help="Rows per API call")
+    parser.add_argument("--compact", action="store_true", help="Compact every month with more than one file")
+    parser.add_argument("--full", action="store_true", help="Discard the snapshot and sync everything again")
+    args = parser.parse_args(argv)
+
+    import sheets
+
+    directory = Path(args.output or DEFAULT_DIR)
+    if args.full and directory.exists():
+        shutil.rmtree(directory)
+    if not (args.credentials or os.environ.get(sheets.EMULATOR_ENV)):
+        parser.error("--credentials is required")
+    credentials = Path(args.credentials).read_text() if args.credentials else None
+    connection = sheets.SheetsConnection(credentials, sheet_name=args.worksheet)
+
+    n = sync(connection, directory, args.chunk_size, log=lambda m: print(f"\r{m}", end="", file=sys.stderr))
+    print(f"\r{n} new rows synced into {directory}", file=sys.stderr)
+    if args.compact:
+        months = compact(directory)
+        print(f"compacted {len(months)} months", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
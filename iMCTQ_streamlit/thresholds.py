@@ -0,0 +1,304 @@
+# Classification cut-offs (MSFsc, Bamid, SJL) and their recalibration.
+#
+# mctq.py ships the published MCTQ cut-offs. The recalibration job replaces
+# them with quantiles of our own respondents:
+#   1. sketch  - every shard of stored responses (a Parquet file of the sync.py
+#                snapshot, a sink, a CSV export) becomes one mergeable
+#                QuantileSketch per metric (stats.py: 1-minute histograms that
+#                merge by adding counts), in parallel worker processes or on
+#                other machines (`sketch` writes a shard file)
+#   2. merge   - the shard sketches are added up
+#   3. publish - the quantiles at LEVELS become a new threshold table, written
+#                as thresholds-<version>.json next to the live thresholds.json,
+#                which is then atomically replaced
+# The app and the API load the live table once and re-read it when its
+# modification time changes (ThresholdReloader). Every saved record carries
+# the 'thresholds_version' that classified it ("builtin" = mctq.py's cut-offs).
+#
+#   python thresholds.py recalibrate --workers 8                   # sync.py snapshot -> data/thresholds.json
+#   python thresholds.py sketch --parquet shard-07/ -o s07.json    # one shard
+#   python thresholds.py recalibrate --shards s*.json              # merge shard files and publish
+#   python thresholds.py show
+# The app reads the table from st.secrets `thresholds_path` or $IMCTQ_THRESHOLDS
+# (default data/thresholds.json).
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from pathlib import Path
+
+import numpy as np
+
+import mctq
+import stats
+
+log = logging.getLogger("imctq.thresholds")
+
+# Population quantiles used as cut-offs, one per class boundary of the result
+# messages in app.py (7 chronotype, 3 Bamid and 3 SJL classes)
+LEVELS = {
+    'MSFsc': (0.025, 0.10, 0.25, 0.75, 0.90, 0.975),
+    'Bamid': (0.25, 0.75),
+    'SJL': (0.40, 0.85),
+}
+BUILTIN = {'MSFsc': mctq.MSFSC_THRESHOLDS, 'Bamid': mctq.BAMID_THRESHOLDS, 'SJL': mctq.SJL_THRESHOLDS}
+BUILTIN_VERSION = "builtin"
+
+# Refuse to publish quantiles of fewer values than this per metric
+MIN_COUNT = 1_000
+
+
+def default_path():
+    import storage
+
+    return Path(os.environ.get("IMCTQ_THRESHOLDS") or storage.DATA_DIR / "thresholds.json")
+
+
+# --- Threshold tables ---
+
+def builtin_table():
+    return {'version': BUILTIN_VERSION, 'thresholds': {m: list(t) for m, t in BUILTIN.items()}}
+
+
+def validate(table):
+    """Raises ValueError unless `table` has ascending cut-offs for every metric, as many as the built-in ones."""
+    cuts = table.get('thresholds') if isinstance(table, dict) else None
+    if not isinstance(cuts, dict) or not table.get('version'):
+        raise ValueError("A threshold table needs 'version' and 'thresholds'.")
+    for metric, builtin in BUILTIN.items():
+        values = cuts.get(metric)
+        if not isinstance(values, list) or len(values) != len(builtin):
+            raise ValueError(f"'{metric}' needs {len(builtin)} cut-offs.")
+        if any(not isinstance(v, (int, float)) for v in values) or list(values) != sorted(values):
+            raise ValueError(f"'{metric}' cut-offs must be ascending numbers.")
+    return table
+
+
+def load(path):
+    return validate(json.loads(Path(path).read_text()))
+
+
+def publish(table, path=None):
+    """Writes the versioned copy, then atomically swaps it in as the live table; returns the live path."""
+    validate(table)
+    path = Path(path or default_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    text = json.dumps(table, indent=1)
+    (path.parent / f"{path.stem}-{table['version']}.json").write_text(text)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+    return path
+
+
+class ThresholdReloader:
+    """
+    The live threshold table, re-read when the file's modification time
+    changes (one stat() per call). Without a file, or while it is unreadable,
+    the last good table (at first the built-in one) stays in use.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path or default_path())
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._table = builtin_table()
+
+    def current(self):
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            return self._table
+        with self._lock:
+            if mtime != self._mtime:
+                self._mtime = mtime
+                try:
+                    self._table = load(self.path)
+                    log.info("threshold table loaded", extra={"version": self._table['version']})
+                except (OSError, ValueError) as e:
+                    log.error("threshold table not usable, keeping %s: %s", self._table['version'], e)
+            return self._table
+
+
+# --- Sketches ---
+
+def new_sketches():
+    return {m: stats.QuantileSketch(*stats.METRICS[m]) for m in LEVELS}
+
+
+def _column(values):
+    # 'N/A', '' and None become NaN (skipped by the sketch)
+    import pandas as pd
+
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float)
+
+
+def sketch_frame(df):
+    """Sketches of one DataFrame (or dict of columns) of stored responses."""
+    sketches = new_sketches()
+    for metric, sketch in sketches.items():
+        if metric in df:
+            sketch.add(_column(df[metric]))
+    return sketches
+
+
+def sketch_records(records, batch_size=10_000):
+    import pandas as pd
+
+    sketches = new_sketches()
+    batch = []
+    for r in records:
+        batch.append(r)
+        if len(batch) == batch_size:
+            merge_into(sketches, sketch_frame(pd.DataFrame.from_records(batch)))
+            batch = []
+    if batch:
+        merge_into(sketches, sketch_frame(pd.DataFrame.from_records(batch)))
+    return sketches
+
+
+def sketch_parquet_file(path):
+    """Shard task for the worker pool: sketches of one Parquet file, as a dict (picklable, small)."""
+    import pyarrow.parquet as pq
+
+    names = set(pq.read_schema(path).names)
+    table = pq.read_table(path, columns=[m for m in LEVELS if m in names], memory_map=True)
+    return to_dict(sketch_frame({name: table.column(name).to_numpy(zero_copy_only=False)
+                                 for name in table.column_names}))
+
+
+def merge_into(sketches, other):
+    for metric, sketch in other.items():
+        sketches[metric].merge(sketch)
+    return sketches
+
+
+def to_dict(sketches):
+    return {metric: sketch.to_dict() for metric, sketch in sketches.items()}
+
+
+def from_dict(d):
+    sketches = new_sketches()
+    for metric, s in d.items():
+        if metric in sketches:
+            sketches[metric] = stats.QuantileSketch.from_dict(s)
+    return sketches
+
+
+def sketch_parquet_files(files, workers=1):
+    """Sketches of many Parquet files, one shard per file, merged as they complete."""
+    sketches = new_sketches()
+    if workers <= 1:
+        for f in files:
+            merge_into(sketches, from_dict(sketch_parquet_file(f)))
+        return sketches
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for shard in pool.map(sketch_parquet_file, files, chunksize=4):
+            merge_into(sketches, from_dict(shard))
+    return sketches
+
+
+def build_table(sketches, levels=LEVELS, min_count=MIN_COUNT, version=None):
+    """Threshold table from merged sketches; ValueError if a metric has fewer than `min_count` values."""
+    counts = {metric: sketches[metric].count for metric in levels}
+    small = [f"{m} ({n})" for m, n in counts.items() if n < min_count]
+    if small:
+        raise ValueError(f"Too few values to recalibrate: {', '.join(small)}; need {min_count}.")
+    table = {
+        'version': version or dt.now().strftime('%Y%m%dT%H%M%S'),
+        'created': dt.now().isoformat(timespec='seconds'),
+        'counts': counts,
+        'levels': {m: list(q) for m, q in levels.items()},
+        # Quantiles are bin midpoints of the 1-minute histograms
+        'thresholds': {m: [round(sketches[m].quantile(q), 4) for q in qs] for m, qs in levels.items()},
+    }
+    return validate(table)
+
+
+# --- CLI ---
+
+def _parquet_files(directory):
+    return sorted(p for p in Path(directory).rglob("part-*.parquet"))
+
+
+def _source_sketches(args):
+    """Sketches of the source given on the command line (default: the sync.py snapshot)."""
+    import storage
+
+    if args.sqlite:
+        return sketch_records(storage.SQLiteSink(args.sqlite).iter_records())
+    if args.csv:
+        import rescore
+
+        sketches = new_sketches()
+        for chunk in rescore.read_chunks(args.csv, 50_000):
+            merge_into(sketches, sketch_frame(chunk))
+        return sketches
+    import sync
+
+    files = _parquet_files(args.parquet or sync.DEFAULT_DIR)
+    if not files:
+        raise SystemExit(f"No Parquet files in {args.parquet or sync.DEFAULT_DIR}.")
+    return sketch_parquet_files(files, args.workers)
+
+
+def _add_source(parser):
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--parquet", help="Parquet directory: sync.py snapshot (default) or the parquet sink")
+    source.add_argument("--sqlite", help="SQLite sink database")
+    source.add_argument("--csv", help="CSV/XLSX export of the sheet")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes for Parquet shards")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recalibrate the MSFsc/Bamid/SJL classification cut-offs.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sketch = sub.add_parser("sketch", help="Sketch one shard of responses into a file")
+    _add_source(sketch)
+    sketch.add_argument("-o", "--output", required=True, help="Shard sketch file (.json)")
+    recal = sub.add_parser("recalibrate", help="Compute and publish a new threshold table")
+    _add_source(recal)
+    recal.add_argument("--shards", nargs="+", help="Merge these shard sketch files instead of reading responses")
+    recal.add_argument("--min-count", type=int, default=MIN_COUNT)
+    recal.add_argument("--dry-run", action="store_true", help="Print the table without publishing it")
+    recal.add_argument("-o", "--output", help="Live table path (default: data/thresholds.json)")
+    show = sub.add_parser("show", help="Print the live table and the built-in cut-offs")
+    show.add_argument("path", nargs="?")
+    args = parser.parse_args(argv)
+
+    if args.command == "show":
+        print(json.dumps({'live': ThresholdReloader(args.path).current(), 'builtin': builtin_table()}, indent=1))
+        return 0
+    if args.command == "sketch":
+        sketches = _source_sketches(args)
+        Path(args.output).write_text(json.dumps(to_dict(sketches)))
+        print(f"{sketches['MSFsc'].count} MSFsc values -> {args.output}", file=sys.stderr)
+        return 0
+
+    if args.shards:
+        sketches = new_sketches()
+        for shard in args.shards:
+            merge_into(sketches, from_dict(json.loads(Path(shard).read_text())))
+    else:
+        sketches = _source_sketches(args)
+    try:
+        table = build_table(sketches, min_count=args.min_count)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.dry_run:
+        print(json.dumps(table, indent=1))
+        return 0
+    path = publish(table, args.output)
+    print(f"published thresholds {table['version']} -> {path}", file=sys.stderr)
+    for metric, cuts in table['thresholds'].items():
+        print(f"  {metric}: {cuts}  (built-in {list(BUILTIN[metric])})", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())